@@ -1,18 +1,30 @@
 import sqlite3
-import hashlib
-import json
 
-def add_benchmark_run_to_db(stats_file_name, strategy_return, benchmark_return, strategy_parameters, tearsheet_html):
+from check_for_previous_run import get_backtest_engine, get_parameter_hash
+from create_strategy_database import add_missing_columns, get_column_names, get_other_parameters, results_database
+from sweep_scheduler import get_backtest_days
 
-    # Create a string representation of the sorted dictionary
-    sorted_dict_string = json.dumps(strategy_parameters, sort_keys=True, default=str)
+def add_benchmark_run_to_db(stats_file_name, strategy_return, benchmark_return, strategy_parameters, tearsheet_html, run_seconds=None, max_drawdown=None, backtest_engine=None):
 
-    # Create a hash object
-    parameter_hash = hashlib.sha256(sorted_dict_string.encode()).hexdigest()
+    parameter_hash = get_parameter_hash(strategy_parameters)
 
-    conn = sqlite3.connect('mwt_backtesting_machine_results.db')  # Connect to the database
+    conn = sqlite3.connect(results_database)  # Connect to the database
     cursor = conn.cursor()
 
+    # Make sure databases created before a column was added have the new columns
+    add_missing_columns(cursor)
+
+    # Number of days covered by the backtest, successive halving runs shorter windows of the same parameters
+    window_days = get_backtest_days(strategy_parameters)
+
+    # The engine that produced the results, the simulator reports itself even for parameters without backtest_engine
+    if backtest_engine is None:
+        backtest_engine = get_backtest_engine(strategy_parameters)
+
+    # Parameters like max_open_trades have no column, they are kept as JSON so results of different
+    # variants of a strategy can be told apart
+    other_parameters = get_other_parameters(strategy_parameters, get_column_names(cursor))
+
     tearsheet_content = None
     # Read the file tearsheet_html and insert it into the database
     if (tearsheet_html != ""):
@@ -51,8 +63,13 @@ def add_benchmark_run_to_db(stats_file_name, strategy_return, benchmark_return,
             trading_fee,
             stats_file_name,
             tearsheet_html,
-            parameter_hash)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+            parameter_hash,
+            run_seconds,
+            max_drawdown,
+            window_days,
+            backtest_engine,
+            other_parameters)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
             (strategy_parameters["symbol"],
             strategy_parameters["trade_strategy"],
             strategy_return,
@@ -82,7 +99,12 @@ def add_benchmark_run_to_db(stats_file_name, strategy_return, benchmark_return,
             strategy_parameters["trading_fee"],
             stats_file_name,
             tearsheet_content,
-            parameter_hash)
+            parameter_hash,
+            run_seconds,
+            max_drawdown,
+            window_days,
+            backtest_engine,
+            other_parameters)
     )
 
     # Commit the transaction
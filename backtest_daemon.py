@@ -0,0 +1,177 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Long running version of the backtest driver.  The daemon keeps a pool of worker processes alive that
+have already imported Lumibot, pandas, yfinance and pandas_datareader, and watches the strategy
+configurations directory.  New or changed TOML files are dispatched to the workers as soon as they
+are seen.
+
+Each worker is a separate single process pool so a backtest can be sent to a specific worker.  Runs
+of the same symbol go back to the worker that last ran the symbol, which keeps the data that worker
+has cached in memory for the symbol warm.
+
+    python backtest_driver.py --daemon --workers 4
+
+"""
+
+import os
+import time
+import toml
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import backtest_driver
+from backtest_driver import load_strategy_runs, record_backtest_results, run_strategy_backtest
+from check_for_previous_run import get_parameter_hash, get_previous_run_hashes
+from sweep_scheduler import load_run_history, order_runs_by_cost
+
+def warm_worker_initializer():
+    '''
+    Import the expensive modules once when the worker process starts instead of on the first backtest
+    '''
+    import pandas
+    import yfinance
+    import pandas_datareader
+    import lumibot.backtesting
+    import backtest_driver
+
+class WarmWorkerPool():
+
+    def __init__(self, max_workers):
+        self.workers = [ProcessPoolExecutor(max_workers=1, initializer=warm_worker_initializer) for i in range(max_workers)]
+        self.worker_futures = [None] * max_workers
+        self.worker_symbols = [None] * max_workers
+
+        # Start every worker process now so the imports happen before the first configuration arrives
+        for worker in self.workers:
+            worker.submit(os.getpid).result()
+
+    def idle_workers(self):
+        # A worker is idle once the result of its last backtest was collected, see release_worker
+        return [i for i, future in enumerate(self.worker_futures) if future is None]
+
+    def running_futures(self):
+        return [future for future in self.worker_futures if future is not None and not future.done()]
+
+    def select_worker(self, symbol):
+        '''
+        Prefer an idle worker that last ran this symbol, then an idle worker that has not run a
+        symbol, then any idle worker.  Returns None if every worker is busy.
+        '''
+        idle_workers = self.idle_workers()
+        for i in idle_workers:
+            if self.worker_symbols[i] == symbol:
+                return i
+        for i in idle_workers:
+            if self.worker_symbols[i] is None:
+                return i
+        if idle_workers:
+            return idle_workers[0]
+        return None
+
+    def submit(self, worker, strategy_file, strategy_parameters):
+        try:
+            future = self.workers[worker].submit(run_strategy_backtest, strategy_file, strategy_parameters)
+        except BrokenProcessPool:
+            # The worker process died while it was idle, start a new one for this backtest
+            print(f"****** Worker {worker} died while idle, restarting it")
+            self.restart_worker(worker)
+            future = self.workers[worker].submit(run_strategy_backtest, strategy_file, strategy_parameters)
+        self.worker_futures[worker] = future
+        self.worker_symbols[worker] = strategy_parameters["symbol"]
+        return future
+
+    def release_worker(self, worker):
+        # Called once the result of the worker's backtest has been collected
+        self.worker_futures[worker] = None
+
+    def restart_worker(self, worker):
+        '''
+        Replace a worker whose process died
+        '''
+        self.workers[worker].shutdown(wait=False)
+        self.workers[worker] = ProcessPoolExecutor(max_workers=1, initializer=warm_worker_initializer)
+        self.worker_futures[worker] = None
+        self.worker_symbols[worker] = None
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+
+def scan_strategy_configurations(known_files):
+    '''
+    Return the TOML files that are new or changed since the last scan.  known_files maps each file
+    name to the modification time and size seen on the last scan and is updated by this function.
+    '''
+    changed_files = []
+    for toml_file in sorted(os.listdir(backtest_driver.strategy_configuration_directory)):
+        if not toml_file.endswith('.toml'):
+            continue
+        file_stat = os.stat(os.path.join(backtest_driver.strategy_configuration_directory, toml_file))
+        file_signature = (file_stat.st_mtime, file_stat.st_size)
+        if known_files.get(toml_file) != file_signature:
+            known_files[toml_file] = file_signature
+            changed_files.append(toml_file)
+    return changed_files
+
+def run_backtest_daemon(max_workers=1, poll_seconds=2.0):
+    worker_pool = WarmWorkerPool(max(1, max_workers))
+    print(f">>>>> Backtest daemon watching {backtest_driver.strategy_configuration_directory} with {len(worker_pool.workers)} warm workers")
+
+    previous_run_hashes = get_previous_run_hashes()
+    known_files = {}
+    pending_runs = []
+    running_files = {}
+
+    try:
+        while True:
+            # Queue the backtests of new or changed configuration files
+            changed_files = scan_strategy_configurations(known_files)
+            for toml_file in changed_files:
+                try:
+                    pending_runs += load_strategy_runs(toml_file, previous_run_hashes)
+                except toml.TomlDecodeError as e:
+                    # The file may still be being written, look at it again on the next scan
+                    print(f"****** Unable to read {toml_file}: {e}")
+                    known_files.pop(toml_file, None)
+            if changed_files:
+                pending_runs, _ = order_runs_by_cost(pending_runs, load_run_history())
+
+            # Record the results of the backtests that finished
+            for future in list(running_files):
+                if not future.done():
+                    continue
+                worker, strategy_file, strategy_parameters = running_files.pop(future)
+                worker_pool.release_worker(worker)
+                try:
+                    record_backtest_results(future.result())
+                except BaseException as e:
+                    if isinstance(e, BrokenProcessPool):
+                        print(f"****** Worker process died running {strategy_file}: {e!r}")
+                        worker_pool.restart_worker(worker)
+                    else:
+                        # A failed run, including sys.exit() in the strategy, should not stop the daemon
+                        print(f"****** Backtest failed for {strategy_file}: {e!r}")
+                    # The hash was added when the run was queued, forget it so saving the file again retries the run
+                    previous_run_hashes.discard(get_parameter_hash(strategy_parameters))
+
+            # Send the pending backtests to the idle workers, most expensive first
+            for strategy_file, strategy_parameters in list(pending_runs):
+                worker = worker_pool.select_worker(strategy_parameters["symbol"])
+                if worker is None:
+                    break
+                pending_runs.remove((strategy_file, strategy_parameters))
+                print(f">>>>> Worker {worker} running {strategy_file}")
+                running_files[worker_pool.submit(worker, strategy_file, strategy_parameters)] = (worker, strategy_file, strategy_parameters)
+
+            # Wake up as soon as a backtest finishes, or at the next directory scan
+            running_futures = worker_pool.running_futures()
+            if running_futures:
+                wait(running_futures, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print(">>>>> Backtest daemon stopping")
+    finally:
+        worker_pool.shutdown()
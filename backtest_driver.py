@@ -13,6 +13,28 @@ of the backtest and to determine if the backtest has already been run.  If the b
 been run, the backtest is skipped.  The backtest is rerun if any of the parameters in the TOML file
 are changed.
 
+The configurations can be run one after another or in parallel in a pool of worker processes:
+
+    python backtest_driver.py --workers 4
+
+With --daemon the driver keeps the worker processes running and watches the strategy_configurations
+directory for new or changed TOML files, see backtest_daemon.py.
+
+With --node several drivers, on one or more machines, share the backtests of a sweep through a
+journal on a shared filesystem, see backtest_node.py.
+
+With --halving the parameter sets are pruned with successive halving, see successive_halving.py.
+
+With --optimize the parameters of configurations with an [optimizer] table are searched adaptively,
+see parameter_optimizer.py.
+
+With --prefetch the data of the whole sweep is downloaded before the backtests start, see sweep_prefetch.py.
+
+With --record-polygon and --replay-polygon the Polygon requests are recorded and replayed offline,
+see polygon_record_replay.py.
+
+With --time-slices each backtest is split into windows that run in parallel, see time_sliced_backtest.py.
+
 """
 
 """
@@ -39,28 +61,411 @@ if use_local_lumibot:
 ################################################################################
 
 
-# IMS moved all module includes to the top of the codels 
+# IMS moved all module includes to the top of the codels
 from credentials import POLYGON_CONFIG
 from datetime import datetime, timedelta
 from lumibot.backtesting import PolygonDataBacktesting
 from options_backtesting_machine import OptionsStrategyEngine
 from lumibot.entities import TradingFee
+import argparse
+import multiprocessing
 import os
 import sys
 import time
 import shutil
 import toml
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 from get_asset_return import get_asset_return
-from get_strategy_return import get_strategy_return
+from get_strategy_return import get_strategy_return, get_strategy_return_from_portfolio_values, get_max_drawdown_from_portfolio_values
 from add_benchmark_to_db import add_benchmark_run_to_db
-from check_for_previous_run import check_for_previous_run
+from check_for_previous_run import get_backtest_engine, get_parameter_hash, get_previous_run_hashes
+from parameter_grid import expand_parameter_grid
+from sweep_scheduler import order_runs_by_cost, print_sweep_eta
+import sweep_journal
+from sweep_journal import SweepJournal
+from successive_halving import halving_metrics, run_successive_halving
+from parameter_optimizer import run_parameter_optimizer
+from option_contract_cache import OptionContractCache
+from sweep_prefetch import default_prefetch_threads, run_sweep_prefetch
+from polygon_record_replay import PolygonRecordings, polygon_mode_variable, install_from_environment
+
+# Location of the strategy configuration files and the Lumibot log directory.  When running in
+# parallel each worker process writes its Lumibot log files to its own sub directory.
+strategy_configuration_directory = "/Users/irvshapiro/drvax-code-local/AAA Lumibot/lumibot_backtesting_machine/strategy_configurations/"
+lumibot_log_directory = "/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/"
+
+def get_worker_log_directory():
+    '''
+    The driver process uses the shared Lumibot log directory.  Each worker process gets
+    its own log directory so parallel runs do not delete or overwrite each other's files.
+    '''
+    if multiprocessing.current_process().name == "MainProcess":
+        return lumibot_log_directory
+    return os.path.join(lumibot_log_directory, f"worker-{os.getpid()}/")
+
+def get_lumibot_log_files(log_directory, basename):
+    '''
+    Build the names of the files Lumibot writes at the end of a backtest.  Passing explicit
+    names to backtest() keeps the files in the worker's log directory and ties them to the
+    TOML file that produced them.
+    '''
+    return {
+        "stats_file": os.path.join(log_directory, f"{basename}_stats.csv"),
+        "trades_file": os.path.join(log_directory, f"{basename}_trades.csv"),
+        "plot_file_html": os.path.join(log_directory, f"{basename}_trades.html"),
+        "indicators_file": os.path.join(log_directory, f"{basename}_indicators.html"),
+        "settings_file": os.path.join(log_directory, f"{basename}_settings.json"),
+        "tearsheet_file": os.path.join(log_directory, f"{basename}_tearsheet.html"),
+    }
+
+def collect_log_files(log_files, target_dir):
+    '''
+    Copy the files Lumibot wrote for this backtest to the strategy log directory.  Lumibot writes
+    and closes these files before backtest() returns, so there is no need to wait for them.  Files
+    Lumibot did not write, for example the tearsheet of a run without trades, are skipped.
+    The copies are left in the Lumibot log directory so the browser can display them.
+    '''
+    # Create the target directory if it does not exist
+    os.makedirs(target_dir, exist_ok=True)
+
+    artifact_files = {}
+    for file_type, source_file in log_files.items():
+        if not os.path.isfile(source_file):
+            continue
+        artifact_files[file_type] = shutil.copy(source_file, target_dir)
+
+    return artifact_files
+
+def run_strategy_backtest(strategy_file, strategy_parameters, capital_budget=None):
+    '''
+    Run the backtest for one strategy configuration and copy the Lumibot log files to the
+    strategy log directory.  This runs in the driver process or in a worker process so it
+    returns the results instead of writing them to the database.  capital_budget overrides the
+    starting cash, time sliced backtests use it to carry the capital of one window to the next.
+    '''
+    # Configurations with backtest_engine = "simulator" run on the daily bars of the option chain
+    # warehouse instead of Lumibot, see condor_simulator.py
+    if get_backtest_engine(strategy_parameters) == "simulator":
+        from condor_simulator import run_simulated_backtest
+        return run_simulated_backtest(strategy_file, strategy_parameters, capital_budget)
+
+    if capital_budget is None:
+        capital_budget =  (strategy_parameters["distance_of_wings"] * 100 * strategy_parameters["quantity_to_trade"] * 1.5)
+
+    backtesting_start = datetime.combine(strategy_parameters["starting_date"], datetime.min.time())
+    backtesting_end = datetime.combine(strategy_parameters["ending_date"], datetime.min.time())
+
+    # Override the parameters set in the OptionsStrategyEngine class
+    OptionsStrategyEngine.set_parameters(strategy_parameters)
+
+    strategy_name = f'mwt-{strategy_parameters["symbol"]}-{strategy_parameters["trade_strategy"]}'
+    print(f">>>>> Running strategy: {strategy_name} from {strategy_file}")
+
+    trading_fee = TradingFee(flat_fee=strategy_parameters["trading_fee"])  # Account for trading fees and slipage
+
+    # Clean out the log direcectory from the privious run.  We do this since at the end of each run
+    # we copy the log files to the strategy log directory.
+    source_dir = get_worker_log_directory()
+    os.makedirs(source_dir, exist_ok=True)
+    for file in os.listdir(source_dir):
+        # Skip the worker sub directories in the shared log directory
+        if os.path.isfile(os.path.join(source_dir, file)):
+            os.remove(os.path.join(source_dir, file))
+
+    strategy_directory = strategy_file.split(".")[0]
+    log_files = get_lumibot_log_files(source_dir, f"{strategy_name}_{strategy_directory}")
+
+    # Execute the strategy with the parameters from the TOML file
+    OptionsStrategyEngine.backtest_portfolio_values = []
+    OptionsStrategyEngine.backtest_trade_events = []
+    run_start_time = time.perf_counter()
+    backtest_analysis = OptionsStrategyEngine.backtest(
+        PolygonDataBacktesting,
+        backtesting_start,
+        backtesting_end,
+        benchmark_asset=strategy_parameters["symbol"],
+        buy_trading_fees=[trading_fee],
+        sell_trading_fees=[trading_fee],
+        polygon_api_key=POLYGON_CONFIG["API_KEY"],
+        polygon_has_paid_subscription=True,
+        name=strategy_name,
+        budget=capital_budget,
+        show_plot=False,
+        show_indicators=False,
+        show_tearsheet=False,
+        save_tearsheet=True,
+        **log_files,
+    )
+    run_seconds = time.perf_counter() - run_start_time
+
+    # Copy the log files to the strategy log directory
+    target_dir = f"strategy_logs/{strategy_directory}/"
+    artifact_files = collect_log_files(log_files, target_dir)
+
+    stats_file = ""
+    tearsheet_path = ""
+    if "stats_file" in artifact_files:
+        stats_file = os.path.basename(artifact_files["stats_file"])
+    if "tearsheet_file" in artifact_files:
+        tearsheet_path = artifact_files["tearsheet_file"]
+    print(f"Stats file {stats_file}")
+
+    # The strategy publishes its portfolio value series when the backtest ends.  Only fall back
+    # to parsing the stats file if the series is missing.
+    portfolio_values = OptionsStrategyEngine.backtest_portfolio_values
+    strategy_return = get_strategy_return_from_portfolio_values(portfolio_values)
+    if strategy_return is None and stats_file != "":
+        strategy_return = get_strategy_return(log_files["stats_file"])
+    print(f"Strategy Return: {strategy_return}")
+
+    return {
+        "strategy_file": strategy_file,
+        "strategy_parameters": strategy_parameters,
+        "stats_file": stats_file,
+        "tearsheet_path": tearsheet_path,
+        "strategy_return": strategy_return,
+        "portfolio_values": portfolio_values,
+        "backtest_analysis": backtest_analysis,
+        "run_seconds": run_seconds,
+        "ended_flat": OptionsStrategyEngine.backtest_ended_flat,
+        "trade_events": OptionsStrategyEngine.backtest_trade_events,
+    }
+
+def load_strategy_runs(strategy_file, previous_run_hashes):
+    '''
+    Read one TOML file and return the (strategy_file, strategy_parameters) backtests that still
+    need to be run.  previous_run_hashes holds the parameter hashes already in the database and
+    is updated with the runs returned so the same parameters are not queued twice.
+    '''
+    print(f"Strategy file found: {strategy_file}")
+
+    # Read parameters from a TOML file
+    strategy_parameters = toml.load(os.path.join(strategy_configuration_directory, strategy_file))
+
+    # Configurations with an optimizer table are only run by --optimize
+    if "optimizer" in strategy_parameters:
+        print(f"------ {strategy_file} has an [optimizer] table.  Run it with --optimize.")
+        return []
+    # print()
+    # print("**************************************************")
+    # print("Strategy Parameters read from TOML file")
+    # pp.pprint(strategy_parameters)
+    # print("**************************************************")
+    # print()
+
+    # A TOML file with a parameter_grid is expanded into one backtest per combination.
+    # Each combination gets its own log directory named after the TOML file and its hash.
+    expanded_parameters = expand_parameter_grid(strategy_parameters)
+    strategy_runs = []
+    skipped_runs = 0
+    for parameters in expanded_parameters:
+        parameter_hash = get_parameter_hash(parameters)
+
+        # Check if the data already exists in the database and skip this run if it does
+        if parameter_hash in previous_run_hashes:
+            skipped_runs += 1
+            continue
+
+        # Do not queue the same parameters twice in one sweep
+        previous_run_hashes.add(parameter_hash)
+
+        run_file = strategy_file
+        if "parameter_grid" in strategy_parameters:
+            run_file = f"{strategy_file.split('.')[0]}-{parameter_hash[:12]}.toml"
+        strategy_runs.append((run_file, parameters))
+
+    if skipped_runs > 0:
+        print (f"------ {skipped_runs} of {len(expanded_parameters)} parameter sets already exist in the database.  Skipping benchmark run.  Change at least one value to rerun the benchmark.")
+        print()
+
+    return strategy_runs
+
+def record_backtest_results(backtest_results):
+    '''
+    Add the results of one backtest to the database.  Only the driver process writes to the
+    results database, even when the backtests run in worker processes.
+    '''
+    strategy_parameters = backtest_results["strategy_parameters"]
+
+    benchmark_return = get_asset_return(strategy_parameters["symbol"], strategy_parameters["starting_date"], strategy_parameters["ending_date"])
+    print(f"{strategy_parameters['symbol']} Return: {benchmark_return}")
+
+    max_drawdown = get_max_drawdown_from_portfolio_values(backtest_results["portfolio_values"])
+
+    # Add the benchmark return to the database
+    add_benchmark_run_to_db(backtest_results["stats_file"], backtest_results["strategy_return"], benchmark_return, strategy_parameters, backtest_results["tearsheet_path"], backtest_results["run_seconds"], max_drawdown, backtest_results.get("backtest_engine"))
+
+def run_and_record_backtest(strategy_file, strategy_parameters, journal):
+    '''
+    Run one backtest in this process and record the result in the database and the journal
+    '''
+    journal.mark_running(strategy_parameters)
+    try:
+        backtest_results = run_strategy_backtest(strategy_file, strategy_parameters)
+
+        print("\033c", end='')  # clear the screen
+
+        record_backtest_results(backtest_results)
+    except KeyboardInterrupt:
+        # Leave the backtest as running so the next sweep starts it again
+        raise
+    except BaseException as e:
+        # A failed run, including sys.exit() in the strategy, should not stop the sweep
+        print(f"****** Backtest failed for {strategy_file}: {e!r}")
+        journal.mark_failed(strategy_parameters, e)
+        return
+
+    journal.mark_done(strategy_parameters)
+
+def record_lockstep_results(lockstep_results, journal):
+    '''
+    Record the result of every run of one lockstep simulation
+    '''
+    for strategy_file, strategy_parameters, backtest_results in lockstep_results:
+        try:
+            if isinstance(backtest_results, BaseException):
+                raise backtest_results
+            record_backtest_results(backtest_results)
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            print(f"****** Backtest failed for {strategy_file}: {e!r}")
+            journal.mark_failed(strategy_parameters, e)
+            continue
+
+        journal.mark_done(strategy_parameters)
+
+def run_lockstep_backtests(runs, max_workers, journal):
+    '''
+    Run the simulator configurations that share a symbol and dates in one pass over the trading
+    days, see run_lockstep_simulation in condor_simulator.py.  Each pass runs in this process, or
+    in a worker process when max_workers is greater than one.
+    '''
+    from condor_simulator import group_lockstep_runs, run_lockstep_simulation
+
+    run_groups = group_lockstep_runs(runs)
+    print(f">>>>> Simulating {len(runs)} backtests in {len(run_groups)} lockstep passes")
+    for strategy_file, strategy_parameters in runs:
+        journal.mark_running(strategy_parameters)
+
+    def mark_group_failed(run_group, e):
+        for strategy_file, strategy_parameters in run_group:
+            print(f"****** Backtest failed for {strategy_file}: {e!r}")
+            journal.mark_failed(strategy_parameters, e)
+
+    if max_workers <= 1:
+        for run_group in run_groups:
+            try:
+                lockstep_results = run_lockstep_simulation(run_group)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                mark_group_failed(run_group, e)
+                continue
+            record_lockstep_results(lockstep_results, journal)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_lockstep_simulation, run_group): run_group for run_group in run_groups}
+        for future in as_completed(futures):
+            try:
+                lockstep_results = future.result()
+            except BaseException as e:
+                mark_group_failed(futures[future], e)
+                continue
+            record_lockstep_results(lockstep_results, journal)
+
+def run_backtests(runs, max_workers, journal):
+    '''
+    Run the backtests one after another in this process, or in a pool of worker processes when
+    max_workers is greater than one.  The results are added to the database and the journal by
+    this process as each backtest finishes.
+    '''
+    # Configurations on the simulator share one pass over the market per symbol and dates
+    simulated_runs = [run for run in runs if get_backtest_engine(run[1]) == "simulator"]
+    if simulated_runs:
+        run_lockstep_backtests(simulated_runs, max_workers, journal)
+        runs = [run for run in runs if get_backtest_engine(run[1]) != "simulator"]
+        if len(runs) == 0:
+            return
+
+    if max_workers <= 1:
+        for strategy_file, strategy_parameters in runs:
+            run_and_record_backtest(strategy_file, strategy_parameters, journal)
+        return
+
+    print(f">>>>> Running {len(runs)} backtests with {max_workers} worker processes")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for strategy_file, strategy_parameters in runs:
+            journal.mark_running(strategy_parameters)
+            future = executor.submit(run_strategy_backtest, strategy_file, strategy_parameters)
+            futures[future] = (strategy_file, strategy_parameters)
+
+        for future in as_completed(futures):
+            strategy_file, strategy_parameters = futures[future]
+            try:
+                record_backtest_results(future.result())
+            except BaseException as e:
+                # A failed run, including sys.exit() in the strategy, should not stop the sweep
+                print(f"****** Backtest failed for {strategy_file}: {e!r}")
+                journal.mark_failed(strategy_parameters, e)
+                continue
+
+            journal.mark_done(strategy_parameters)
+
+def run_successive_halving_sweep(max_workers, max_attempts, journal_database, window_fractions, keep_fraction, metric):
+    '''
+    Run the configurations as a successive halving sweep, see successive_halving.py.  Every
+    parameter set is a candidate, including the ones already in the database, because their
+    results are needed to rank them.
+    '''
+    candidate_runs = []
+    for toml_file in sorted(os.listdir(strategy_configuration_directory)):
+        if toml_file.endswith('.toml'):
+            candidate_runs += load_strategy_runs(toml_file, set())
+
+    journal = SweepJournal(database=journal_database or sweep_journal.journal_database, max_attempts=max_attempts)
+    journal.reset_interrupted_runs()
+
+    def run_window_backtests(runs):
+        runs, estimated_seconds = order_runs_by_cost(runs)
+        print_sweep_eta(estimated_seconds, max_workers)
+        journal.enqueue_runs(runs)
+        run_backtests(runs, max_workers, journal)
+
+    run_successive_halving(candidate_runs, run_window_backtests, window_fractions=window_fractions, keep_fraction=keep_fraction, metric=metric)
+    journal.print_summary()
+
+def run_optimizer_sweep(max_workers, max_attempts, journal_database, seed=None):
+    '''
+    Run the parameter optimizer for every configuration with an [optimizer] table, see
+    parameter_optimizer.py.  Each batch of proposed parameters is run by the parallel runner.
+    '''
+    journal = SweepJournal(database=journal_database or sweep_journal.journal_database, max_attempts=max_attempts)
+    journal.reset_interrupted_runs()
+
+    def run_optimizer_backtests(runs):
+        journal.enqueue_runs(runs)
+        run_backtests(runs, max_workers, journal)
+
+    for toml_file in sorted(os.listdir(strategy_configuration_directory)):
+        if not toml_file.endswith('.toml'):
+            continue
+        strategy_parameters = toml.load(os.path.join(strategy_configuration_directory, toml_file))
+        if "optimizer" not in strategy_parameters:
+            continue
+        print(f">>>>> Optimizing {toml_file}")
+        run_parameter_optimizer(toml_file, strategy_parameters, run_optimizer_backtests, get_previous_run_hashes(), batch_size=max_workers, seed=seed)
+
+    journal.print_summary()
 
 class BacktestDriver():
 
-    def BacktestRunner():
+    def BacktestRunner(max_workers=1, max_attempts=3, journal_database=None, prefetch_threads=0):
 
         # These are just defining defaults that are overriden by the TOML file
         distance_of_wings = 15 # reference in multiple parameters below, in dollars not strikes
@@ -78,7 +483,7 @@ class BacktestDriver():
                 "quantity_to_trade": quantity_to_trade,  # The number of contracts to trade
                 "minimum_hold_period": 7,  # The of number days to wait before exiting a strategy -- this strategy only trades once a day
                 "distance_of_wings" : distance_of_wings, # Distance of the longs from the shorts in dollars -- the wings
-                "budget" : (distance_of_wings * 100 * quantity_to_trade * 1.5), # 
+                "budget" : (distance_of_wings * 100 * quantity_to_trade * 1.5), #
                 "strike_roll_distance" : 1.0, # How close to the short do we allow the price to move before rolling.
                 "max_loss_multiplier" : .75, # The maximum loss is the initial credit * max_loss_multiplier, set to 0 to disable
                 "roll_strategy" : "short", # short, delta, none # IMS not fully implemented
@@ -94,115 +499,103 @@ class BacktestDriver():
             }
 
         # Get a list of all files in the current directory
-        files = os.listdir("/Users/irvshapiro/drvax-code-local/AAA Lumibot/lumibot_backtesting_machine/strategy_configurations/")
+        files = os.listdir(strategy_configuration_directory)
+
+        # Load the parameter hashes of every backtest already in the database once, so a large
+        # parameter sweep does not need a database query per backtest
+        previous_run_hashes = get_previous_run_hashes()
+        database_hashes = set(previous_run_hashes)
 
         # Loop through all of the configurations files in the strategy configuration directory
-        # Then load the parameters and run the strategy backtest
+        # and collect the backtests that still need to be run
 
-        for toml_file in files:
+        pending_runs = []
+        for toml_file in sorted(files):
             # Check if the file is a TOML file
             if toml_file.endswith('.toml'):
-                strategy_file = toml_file
-                print(f"Strategy file found: {strategy_file}")
-
-                # Read parameters from a TOML file
-                strategy_parameters = toml.load(f"/Users/irvshapiro/drvax-code-local/AAA Lumibot/lumibot_backtesting_machine/strategy_configurations/{strategy_file}")
-                # print()
-                # print("**************************************************")
-                # print("Strategy Parameters read from TOML file")
-                # pp.pprint(strategy_parameters)
-                # print("**************************************************")
-                # print()
-
-                capital_budget =  (strategy_parameters["distance_of_wings"] * 100 * strategy_parameters["quantity_to_trade"] * 1.5)
-
-                backtesting_start = datetime.combine(strategy_parameters["starting_date"], datetime.min.time())
-                backtesting_end = datetime.combine(strategy_parameters["ending_date"], datetime.min.time())
-
-                # Override the parameters set in the OptionsStrategyEngine class
-                OptionsStrategyEngine.set_parameters(strategy_parameters)
+                pending_runs += load_strategy_runs(toml_file, previous_run_hashes)
+
+        # Start the most expensive backtests first, based on the run times of earlier backtests,
+        # so a long run does not finish alone at the end of the sweep
+        pending_runs, estimated_seconds = order_runs_by_cost(pending_runs)
+
+        # The journal remembers the state of every backtest in the sweep.  Backtests that were
+        # running when an earlier sweep stopped are queued again, and new backtests are added
+        # after the backtests that are still waiting from earlier sweeps.
+        journal = SweepJournal(database=journal_database or sweep_journal.journal_database, max_attempts=max_attempts)
+        journal.reset_interrupted_runs()
+        journal.enqueue_runs(pending_runs)
+
+        # Download the data of the whole sweep once before the backtests start
+        if prefetch_threads > 0:
+            run_sweep_prefetch(journal.get_runnable_runs(), max_threads=prefetch_threads)
+
+        while True:
+            runnable_runs = []
+            for strategy_file, strategy_parameters in journal.get_runnable_runs():
+                # The driver may have stopped after the results were saved but before the journal was updated
+                if get_parameter_hash(strategy_parameters) in database_hashes:
+                    journal.mark_done(strategy_parameters)
+                    continue
+                runnable_runs.append((strategy_file, strategy_parameters))
 
-                strategy_name = f'mwt-{strategy_parameters["symbol"]}-{strategy_parameters["trade_strategy"]}'
-                print(f">>>>> Running strategy: {strategy_name}")
+            if len(runnable_runs) == 0:
+                break
 
-                # Check if the data already exists in the database and skip this run if it does
-                if check_for_previous_run(strategy_parameters):
-                    print ("------ Data already exists in the database.  Skipping benchmark run.  Change at least one value to rerun the benchmark.")
-                    print()
-                    continue
+            _, estimated_seconds = order_runs_by_cost(runnable_runs)
+            print_sweep_eta(estimated_seconds, max_workers)
 
-                trading_fee = TradingFee(flat_fee=strategy_parameters["trading_fee"])  # Account for trading fees and slipage
-
-                # Clean out the log direcectory from the privious run.  We do this since at the end of each run
-                # we copy the log files to the strategy log directory.
-                if os.path.exists("/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/"):
-                    stats_file = ""
-                    files = os.listdir("/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/")
-                    # Delete each file in the log directory
-                    for file in files:
-                        os.remove(os.path.join("/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/", file))
-
-                # Execute the strategy with the parameters from the TOML file
-                OptionsStrategyEngine.backtest(
-                    PolygonDataBacktesting,
-                    backtesting_start,
-                    backtesting_end,
-                    benchmark_asset=strategy_parameters["symbol"],
-                    buy_trading_fees=[trading_fee],
-                    sell_trading_fees=[trading_fee],
-                    polygon_api_key=POLYGON_CONFIG["API_KEY"],
-                    polygon_has_paid_subscription=True,
-                    name=strategy_name,
-                    budget=capital_budget,
-                    show_plot=False,
-                    show_indicators=False,
-                    show_tearsheet=False,
-                    save_tearsheet=True,
-                )
-
-                # Copy the log files to the strategy log directory
-                source_dir = "/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/"
-                strategy_directory = strategy_file.split(".")[0]    
-                target_dir = f"strategy_logs/{strategy_directory}/"
-
-                # Create the target directory if it does not exist
-                os.makedirs(target_dir, exist_ok=True)
-
-                # Get a list of all files in Lumibot log directory
-                files = os.listdir(source_dir)
-                stats_file = ""
-                tearsheet_file = ""
-                for file in files:
-                    if "_stats.csv" in file:
-                        stats_file = file
-                    if "_tearsheet.html" in file:
-                        tearsheet_file = file
-
-                # Copy each file to the strategy log directory
-                # Leave in the original log directory so the browser can display it
-                for file in files:
-                    shutil.copy(os.path.join(source_dir, file), target_dir)
-
-                # Wait 3 seconds so lumibot can finish writing the log files before starting the next iteration
-                print("Waiting 3 seconds for Lumibot to finish writing log files")
-                time.sleep(3)
-
-                print("\033c", end='')  # clear the screen
-
-                print(f"Stats file {stats_file}")
-                strategy_return = get_strategy_return("/Users/irvshapiro/drvax-code-local/AAA Lumibot/logs/" + stats_file)
-                print(f"Strategy Return: {strategy_return}")
-
-                benchmark_return = get_asset_return(strategy_parameters["symbol"], strategy_parameters["starting_date"], strategy_parameters["ending_date"])
-                print(f"{strategy_parameters['symbol']} Return: {benchmark_return}")
-
-                tearsheet_path = ""
-                if tearsheet_file != "":
-                    tearsheet_path = f"strategy_logs/{strategy_directory}/{tearsheet_file}"
-                # Add the benchmark return to the database
-                add_benchmark_run_to_db(stats_file, strategy_return, benchmark_return, strategy_parameters, tearsheet_path)
+            run_backtests(runnable_runs, max_workers, journal)
 
+        journal.print_summary()
+        OptionContractCache().print_summary()
 
 if __name__ == "__main__":
-    backtest_reselts = BacktestDriver.BacktestRunner()
-
+    parser = argparse.ArgumentParser(description="Run the backtests defined in the strategy_configurations directory")
+    parser.add_argument("--workers", type=int, default=1, help="number of backtests to run at the same time in worker processes")
+    parser.add_argument("--daemon", action="store_true", help="keep the workers running and watch the strategy configurations directory for new or changed files")
+    parser.add_argument("--poll-seconds", type=float, default=2.0, help="how often the daemon checks the strategy configurations directory")
+    parser.add_argument("--max-attempts", type=int, default=3, help="number of times a failed backtest is run before it is quarantined")
+    parser.add_argument("--journal", default=None, help="path of the sweep journal database")
+    parser.add_argument("--node", action="store_true", help="claim backtests from a sweep journal shared with drivers on other machines")
+    parser.add_argument("--node-id", default=None, help="name of this node in the journal leases, defaults to <hostname>-<pid>")
+    parser.add_argument("--lease-seconds", type=float, default=300, help="how long a node's claim on a backtest lasts without a heartbeat")
+    parser.add_argument("--halving", action="store_true", help="prune the sweep with successive halving on longer and longer windows of the backtest period")
+    parser.add_argument("--halving-windows", default="0.25,0.5,1.0", help="comma separated fractions of the backtest period for each successive halving window")
+    parser.add_argument("--keep-fraction", type=float, default=0.5, help="fraction of the candidates kept after each successive halving window")
+    parser.add_argument("--halving-metric", default="strategy_return", choices=halving_metrics, help="how successive halving ranks the candidates")
+    parser.add_argument("--optimize", action="store_true", help="search the parameter bounds of configurations with an [optimizer] table")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the optimizer so a search can be repeated")
+    parser.add_argument("--prefetch", action="store_true", help="download the contracts and bars of the whole sweep before the backtests start")
+    parser.add_argument("--prefetch-threads", type=int, default=default_prefetch_threads, help="number of threads used by --prefetch")
+    parser.add_argument("--record-polygon", action="store_true", help="store every Polygon request and response so the backtests can be replayed offline")
+    parser.add_argument("--replay-polygon", action="store_true", help="answer the Polygon requests from the recordings without a network")
+    parser.add_argument("--time-slices", type=int, default=0, help="split each backtest into this many windows run in parallel")
+    parser.add_argument("--verify-slices", action="store_true", help="also run each time sliced backtest serially and report any divergence")
+    args = parser.parse_args()
+
+    # The worker processes read the mode from the environment
+    if args.record_polygon or args.replay_polygon:
+        os.environ[polygon_mode_variable] = "replay" if args.replay_polygon else "record"
+        install_from_environment()
+
+    if args.daemon:
+        from backtest_daemon import run_backtest_daemon
+        run_backtest_daemon(max_workers=args.workers, poll_seconds=args.poll_seconds)
+    elif args.halving:
+        window_fractions = [float(window_fraction) for window_fraction in args.halving_windows.split(",")]
+        run_successive_halving_sweep(args.workers, args.max_attempts, args.journal, window_fractions, args.keep_fraction, args.halving_metric)
+    elif args.optimize:
+        run_optimizer_sweep(args.workers, args.max_attempts, args.journal, seed=args.seed)
+    elif args.time_slices > 1:
+        from time_sliced_backtest import run_time_sliced_sweep
+        run_time_sliced_sweep(max_workers=args.workers, slices=args.time_slices, verify=args.verify_slices, max_attempts=args.max_attempts, journal_database=args.journal)
+    elif args.node:
+        from backtest_node import run_backtest_node
+        run_backtest_node(max_workers=args.workers, max_attempts=args.max_attempts, journal_database=args.journal, lease_seconds=args.lease_seconds, node_id=args.node_id)
+    else:
+        backtest_reselts = BacktestDriver.BacktestRunner(max_workers=args.workers, max_attempts=args.max_attempts, journal_database=args.journal,
+                                                         prefetch_threads=args.prefetch_threads if args.prefetch else 0)
+
+    if args.record_polygon or args.replay_polygon:
+        PolygonRecordings().print_report()
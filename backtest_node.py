@@ -0,0 +1,104 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Run the backtests of a sweep on several machines.  Every machine runs the driver in node mode
+against the same sweep journal on a shared filesystem.  Each node adds the configurations it finds
+to the journal, then claims backtests one at a time by taking a lease, runs them in its own worker
+processes and writes the results back.  A heartbeat thread renews the leases of the running
+backtests.  If a node crashes its leases expire and the other nodes claim those backtests again.
+
+    python backtest_driver.py --node --workers 4 --journal /shared/mwt_sweep_journal.db
+
+Several nodes can be tested on one machine by starting the same command in several terminals.
+
+"""
+
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import backtest_driver
+from backtest_driver import load_strategy_runs, record_backtest_results, run_strategy_backtest
+from check_for_previous_run import check_for_previous_run, get_previous_run_hashes
+from sweep_journal import SweepJournal
+from sweep_scheduler import order_runs_by_cost
+import sweep_journal
+
+def renew_leases_until_stopped(journal, node_id, lease_seconds, stop_event):
+    # Renew three times per lease period so one slow write does not let a lease expire
+    while not stop_event.wait(lease_seconds / 3):
+        try:
+            journal.renew_leases(node_id, lease_seconds)
+        except Exception as e:
+            print(f"****** Unable to renew leases for {node_id}: {e!r}")
+
+def run_backtest_node(max_workers=1, max_attempts=3, journal_database=None, lease_seconds=300, node_id=None):
+    if node_id is None:
+        node_id = f"{socket.gethostname()}-{os.getpid()}"
+    max_workers = max(1, max_workers)
+
+    journal = SweepJournal(database=journal_database or sweep_journal.journal_database, max_attempts=max_attempts)
+
+    # Backtests left running by a single machine sweep have no lease, queue them again
+    journal.reset_interrupted_runs()
+
+    # Add the configurations this node can see to the shared journal.  Backtests already in
+    # the journal keep their state, so every node can do this when it starts.
+    previous_run_hashes = get_previous_run_hashes()
+    pending_runs = []
+    for toml_file in sorted(os.listdir(backtest_driver.strategy_configuration_directory)):
+        if toml_file.endswith('.toml'):
+            pending_runs += load_strategy_runs(toml_file, previous_run_hashes)
+    pending_runs, _ = order_runs_by_cost(pending_runs)
+    journal.enqueue_runs(pending_runs)
+
+    print(f">>>>> Node {node_id} running backtests from {journal.database} with {max_workers} worker processes")
+
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=renew_leases_until_stopped, args=(journal, node_id, lease_seconds, stop_event), daemon=True)
+    heartbeat.start()
+
+    running_runs = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                # Claim a backtest for every idle worker
+                while len(running_runs) < max_workers:
+                    claimed_run = journal.claim_next_run(node_id, lease_seconds)
+                    if claimed_run is None:
+                        break
+                    strategy_file, strategy_parameters = claimed_run
+                    print(f">>>>> Node {node_id} claimed {strategy_file}")
+                    future = executor.submit(run_strategy_backtest, strategy_file, strategy_parameters)
+                    running_runs[future] = claimed_run
+
+                if len(running_runs) == 0:
+                    # Other nodes may still hold leases that can expire, so only stop when the
+                    # journal has nothing left to run anywhere
+                    if journal.count_active_runs() == 0:
+                        break
+                    stop_event.wait(lease_seconds / 3)
+                    continue
+
+                # Wait for a backtest to finish, or look for expired leases to claim
+                done_futures, _ = wait(list(running_runs), timeout=lease_seconds / 3, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    strategy_file, strategy_parameters = running_runs.pop(future)
+                    try:
+                        backtest_results = future.result()
+                        # Another node may have finished the backtest after this node's lease expired
+                        if not check_for_previous_run(strategy_parameters):
+                            record_backtest_results(backtest_results)
+                    except BaseException as e:
+                        # A failed run, including sys.exit() in the strategy, should not stop the node
+                        print(f"****** Backtest failed for {strategy_file}: {e!r}")
+                        journal.mark_failed(strategy_parameters, e)
+                        continue
+
+                    journal.mark_done(strategy_parameters)
+    finally:
+        stop_event.set()
+
+    journal.print_summary()
@@ -1,18 +1,32 @@
-def check_for_previous_run(strategy_parameters):
+import sqlite3
+import hashlib
+import json
+
+from create_strategy_database import add_missing_columns, results_database
+
+# Results of the Lumibot backtest and of the simulator, see condor_simulator.py, are not comparable
+default_backtest_engine = "lumibot"
+
+def get_backtest_engine(strategy_parameters):
+    return strategy_parameters.get("backtest_engine", default_backtest_engine)
+
+def get_parameter_hash(strategy_parameters):
     '''
-    Check if the data already exists in the database
+    The SHA-256 hash of the parameters is used to identify a backtest in the database
     '''
-    import sqlite3
-    import hashlib
-    import json
-
     # Create a string representation of the sorted dictionary
     sorted_dict_string = json.dumps(strategy_parameters, sort_keys=True, default=str)
 
     # Create a hash object
-    parameter_hash = hashlib.sha256(sorted_dict_string.encode()).hexdigest()
+    return hashlib.sha256(sorted_dict_string.encode()).hexdigest()
 
-    conn = sqlite3.connect('/Users/irvshapiro/drvax-code-local/AAA Lumibot/mwt_backtesting_machine_results.db')  # Connect to the database
+def check_for_previous_run(strategy_parameters):
+    '''
+    Check if the data already exists in the database
+    '''
+    parameter_hash = get_parameter_hash(strategy_parameters)
+
+    conn = sqlite3.connect(results_database)  # Connect to the database
     cursor = conn.cursor()
 
     # Check if the data already exists
@@ -20,9 +34,58 @@ def check_for_previous_run(strategy_parameters):
         SELECT * FROM mwt_benchmark_returns WHERE parameter_hash = ?
     ''', (f"{parameter_hash}",))
     data = cursor.fetchall()
-    
+    conn.close()
+
     if len(data) > 0:
         print("****** Data already exists in the database.  Skipping insert.")
         return True
-    
-    return False
\ No newline at end of file
+
+    return False
+
+def get_previous_run_hashes():
+    '''
+    Return the set of parameter hashes already in the database.  This lets the driver check a
+    large sweep against the database with one query instead of one query per backtest.
+    '''
+    conn = sqlite3.connect(results_database)  # Connect to the database
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT parameter_hash FROM mwt_benchmark_returns
+    ''')
+    parameter_hashes = {row[0] for row in cursor.fetchall()}
+    conn.close()
+
+    return parameter_hashes
+
+def get_previous_run_results(parameter_hashes):
+    '''
+    Return {parameter_hash: {"strategy_return", "benchmark_return", "max_drawdown", "backtest_engine"}}
+    for the parameter hashes that are already in the database
+    '''
+    conn = sqlite3.connect(results_database)  # Connect to the database
+    cursor = conn.cursor()
+
+    # Older databases do not have the max_drawdown column
+    add_missing_columns(cursor)
+    conn.commit()
+
+    parameter_hashes = list(parameter_hashes)
+    previous_run_results = {}
+    # Query in chunks to stay under the SQLite limit on the number of parameters
+    for i in range(0, len(parameter_hashes), 500):
+        chunk = parameter_hashes[i:i + 500]
+        cursor.execute(f'''
+            SELECT parameter_hash, strategy_return, benchmark_return, max_drawdown, backtest_engine FROM mwt_benchmark_returns
+            WHERE parameter_hash IN ({",".join("?" * len(chunk))})
+        ''', chunk)
+        for parameter_hash, strategy_return, benchmark_return, max_drawdown, backtest_engine in cursor.fetchall():
+            previous_run_results[parameter_hash] = {
+                "strategy_return": strategy_return,
+                "benchmark_return": benchmark_return,
+                "max_drawdown": max_drawdown,
+                "backtest_engine": backtest_engine or default_backtest_engine,
+            }
+    conn.close()
+
+    return previous_run_results
@@ -0,0 +1,694 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+A fast simulation of the OptionsStrategyEngine rules on the daily bars of the option chain warehouse.
+The strategy trades once a day, yet a Lumibot backtest takes every simulated day through its broker,
+order and event machinery and prices the options from minute data.  The simulator loads the daily
+closes of the underlying and of every contract of an expiration once, as price tables per day, and
+runs the same rules over them in a plain loop:
+
+    - the short strikes are found by delta, with the same bisection and warm start
+    - the spreads are opened, rolled on distance to the short or on delta, and closed
+      days_before_expiry_to_buy_back days before the expiration
+    - max_loss_multiplier and maximum_rolls closes, and the max_symbol_volitility skips
+    - max_open_trades, entry_spacing_days and the time slice entry dates
+    - trigger_gating, with the guard bands of guard_bands.py
+
+The trades are kept in a PositionBook, the strikes in a StrikeLadder and the deltas come from the
+vectorized Black-Scholes model, the same code the strategy uses.  Orders fill at the close of the day
+with the flat trading fee of each order.  Lumibot prices at the time of the iteration, so the two
+equity curves differ by the intraday moves.  simulator_parity.py runs both and reports how close the
+trades and the equity curves are.
+
+A configuration runs on the simulator with backtest_engine = "simulator" in its TOML file.  The
+warehouse must hold the expirations of the backtest, see option_chain_warehouse.py.  The driver runs
+the simulator configurations of a sweep that share a symbol and dates in lockstep: one pass over the
+trading days loads each day's prices and deltas once and trades a VirtualPortfolio per configuration.
+
+    python condor_simulator.py strategy_configurations/spy-condor.toml
+
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+import toml
+
+from check_for_previous_run import get_parameter_hash
+from get_strategy_return import get_strategy_return_from_portfolio_values
+from guard_bands import get_guard_bands, is_inside_guard_bands
+from option_chain_warehouse import fetch_daily_bars, load_option_bars, warehouse_directory
+from parameter_grid import expand_parameter_grid
+from position_book import PositionBook, get_leg_key, get_trade_event
+from strike_ladder import StrikeLadder, find_first_index
+from sweep_scheduler import get_date, get_monthly_expiration_after_date
+from vectorized_greeks import get_ladder_greeks, get_scalar_delta, get_years_to_expiration, greeks_batch_size, implied_volatility
+
+# Lumibot uses the 13 week treasury yield, the simulator a constant rate for the whole backtest
+default_risk_free_rate = 0.05
+
+# An option leg of the simulator, with the fields of a Lumibot Asset the position book reads
+SimulatedOption = namedtuple("SimulatedOption", ["symbol", "expiration", "strike", "right", "asset_type"], defaults=["option"])
+
+class SimulationMarket():
+    '''
+    The daily closes of a symbol and of the contracts of its expirations, loaded once and shared by
+    every portfolio simulated over the same days
+    '''
+
+    def __init__(self, symbol, first_day, last_day, risk_free_rate=default_risk_free_rate, directory=warehouse_directory):
+        self.symbol = symbol
+        self.first_day = get_date(first_day)
+        self.last_day = get_date(last_day)
+        self.risk_free_rate = risk_free_rate
+        self.directory = directory
+
+        # Lumibot stops at the start of ending_date, so the last trading day is the day before
+        underlying_bars = fetch_daily_bars(symbol, self.first_day, self.last_day)
+        self.underlying_prices = {datetime.utcfromtimestamp(bar["t"] / 1000).date(): bar["c"] for bar in underlying_bars}
+        self.trading_days = sorted(day for day in self.underlying_prices if self.first_day <= day < self.last_day)
+
+        symbol_directory = os.path.join(directory, f"symbol={symbol}")
+        self.expiration_dates = []
+        if os.path.isdir(symbol_directory):
+            self.expiration_dates = sorted(get_date(name.split("=")[-1]) for name in os.listdir(symbol_directory) if name.startswith("expiration="))
+
+        # expiration -> {day: {right: {strike: close}}}, with the closes carried forward on days a
+        # contract did not trade, as Lumibot's last price would be
+        self.chains = {}
+        self.strike_ladders = {}
+        # (day, expiration, right) -> {strike: delta}, filled as the deltas are asked for
+        self.strike_deltas = {}
+        # (day, expiration, right, strike) -> implied volatility, for the guard bands
+        self.volatilities = {}
+
+    def load_chain(self, expiration):
+        bars = load_option_bars(self.symbol, expiration, self.first_day, self.last_day, directory=self.directory)
+        day_bars = {}
+        strikes = {"call": set(), "put": set()}
+        for bar_date, contract_type, strike, close in zip(bars["date"], bars["contract_type"], bars["strike_price"], bars["close"]):
+            day_bars.setdefault(bar_date, []).append((contract_type, float(strike), float(close)))
+            strikes[contract_type].add(float(strike))
+        day_bars = {get_date(bar_date): bars_of_day for bar_date, bars_of_day in day_bars.items()}
+
+        chain = {}
+        last_closes = {"call": {}, "put": {}}
+        for day in self.trading_days:
+            if day > expiration:
+                break
+            for contract_type, strike, close in day_bars.get(day, ()):
+                last_closes[contract_type][strike] = close
+            chain[day] = {right: dict(closes) for right, closes in last_closes.items()}
+
+        self.chains[expiration] = chain
+        self.strike_ladders[expiration] = StrikeLadder(self.symbol, expiration, strikes["call"], strikes["put"])
+
+    def get_strike_ladder(self, expiration):
+        if expiration not in self.strike_ladders:
+            self.load_chain(expiration)
+        return self.strike_ladders[expiration]
+
+    def get_underlying_price(self, day):
+        return self.underlying_prices[day]
+
+    def get_option_price(self, day, expiration, right, strike):
+        # An expired option is worth its intrinsic value
+        right = str(right).lower()
+        if day > expiration:
+            underlying_price = self.get_underlying_price(day)
+            return max(underlying_price - strike, 0) if right == "call" else max(strike - underlying_price, 0)
+        if expiration not in self.chains:
+            self.load_chain(expiration)
+        return self.chains[expiration].get(day, {}).get(right, {}).get(float(strike))
+
+    def get_deltas(self, day, expiration, right, strikes):
+        '''
+        The deltas of strikes of an expiration and right on day, None for a strike without a close.
+        Each delta is computed once and shared by every portfolio on the market.  NumPy only pays
+        off for several strikes, a single strike is solved with the scalar model.
+        '''
+        strike_deltas = self.strike_deltas.setdefault((day, expiration, right), {})
+        missing_strikes = [strike for strike in strikes if strike not in strike_deltas]
+        if len(missing_strikes) == 1:
+            strike = missing_strikes[0]
+            option_price = self.get_option_price(day, expiration, right, strike)
+            strike_deltas[strike] = None
+            if option_price is not None and option_price > 0:
+                strike_deltas[strike] = get_scalar_delta(self.get_underlying_price(day), strike, option_price, (expiration - day).days, self.risk_free_rate, right)
+        elif missing_strikes:
+            option_prices = [self.get_option_price(day, expiration, right, strike) for strike in missing_strikes]
+            greeks = get_ladder_greeks(self.get_underlying_price(day), missing_strikes, option_prices, (expiration - day).days, self.risk_free_rate, right)
+            for strike, delta in zip(missing_strikes, greeks["delta"]):
+                strike_deltas[strike] = None if math.isnan(delta) else float(delta)
+        return [strike_deltas[strike] for strike in strikes]
+
+    def get_volatility(self, day, expiration, right, strike):
+        # The implied volatility of one contract on day, None without a close
+        key = (day, expiration, right, strike)
+        if key not in self.volatilities:
+            self.volatilities[key] = None
+            option_price = self.get_option_price(day, expiration, right, strike)
+            if option_price is not None and option_price > 0:
+                volatility = implied_volatility(np.array([option_price]), self.get_underlying_price(day), np.array([float(strike)]),
+                                                get_years_to_expiration((expiration - day).days), self.risk_free_rate, right == "call")[0]
+                self.volatilities[key] = None if math.isnan(volatility) else float(volatility)
+        return self.volatilities[key]
+
+    def get_next_expiration_date(self, day, option_duration):
+        # The first expiration in the warehouse on or after the monthly expiration option_duration
+        # days away, within 5 days like the strategy's expiration calendar
+        suggested_date = get_monthly_expiration_after_date(day + timedelta(days=option_duration))
+        index = bisect_left(self.expiration_dates, suggested_date)
+        if index == len(self.expiration_dates) or self.expiration_dates[index] > suggested_date + timedelta(days=5):
+            return suggested_date
+        return self.expiration_dates[index]
+
+class VirtualPortfolio():
+    '''
+    The cash, trades and state of one backtest of the strategy rules on a SimulationMarket.
+    trade_day is on_trading_iteration, with the same rules in the same order.
+    '''
+
+    def __init__(self, strategy_parameters, capital_budget):
+        self.parameters = strategy_parameters
+        self.cash = capital_budget
+        self.position_book = PositionBook()
+        self.hold_length = 0
+        self.skipped_days_counter = 0
+        self.stay_out_of_market = False
+        self.historical_price = []
+        self.max_move_hit_flag = False
+        self.portfolio_blew_up = False
+        self.target_delta_strikes = {}
+        # leg key -> last price, used when a held contract has no close
+        self.last_prices = {}
+        self.portfolio_value_history = []
+        self.trade_events = []
+
+    def entries_allowed(self, dt):
+        today = dt.date().isoformat()
+        first_entry_date = self.parameters.get("first_entry_date")
+        last_entry_date = self.parameters.get("last_entry_date")
+        if first_entry_date is not None and today < str(first_entry_date)[:10]:
+            return False
+        if last_entry_date is not None and today >= str(last_entry_date)[:10]:
+            return False
+        return True
+
+    def get_leg_price(self, market, day, asset):
+        key = get_leg_key(asset)
+        price = market.get_option_price(day, asset.expiration, asset.right, asset.strike)
+        if price is None:
+            price = self.last_prices.get(key, 0.0)
+        self.last_prices[key] = price
+        return price
+
+    def get_portfolio_value(self, market, day):
+        positions_value = 0
+        for trade in self.position_book.get_open_trades():
+            for asset, quantity in trade.get_legs():
+                positions_value += quantity * self.get_leg_price(market, day, asset) * 100
+        return self.cash + positions_value
+
+    def fill_order(self, price, quantity):
+        # A positive quantity is bought, a negative quantity sold, each order pays the flat fee
+        self.cash -= quantity * price * 100 + self.parameters["trading_fee"]
+
+    def cost_to_close_position(self, market, day, trade, side="both"):
+        cost_to_close = 0
+        for asset, quantity in trade.get_legs(None if side == "both" else side):
+            last_price = self.get_leg_price(market, day, asset)
+            if quantity >= 0:
+                cost_to_close += -last_price
+            else:
+                cost_to_close += last_price
+        return round(cost_to_close, 2)
+
+    def close_spread(self, market, day, right, trade):
+        for asset, quantity in self.position_book.remove_legs(trade, right):
+            self.fill_order(self.get_leg_price(market, day, asset), -quantity)
+
+    def close_trade(self, market, day, trade):
+        for right in ["call", "put"]:
+            self.close_spread(market, day, right, trade)
+        self.position_book.close_trade(trade)
+
+    def update_guard_bands(self, market, day):
+        # The bands of OptionsStrategyEngine.set_guard_bands, from the closes of the day
+        underlying_price = market.get_underlying_price(day)
+        for trade in self.position_book.get_open_trades():
+            if trade.guard_bands is None and trade.has_legs():
+                cost_to_close = self.cost_to_close_position(market, day, trade) if self.parameters["max_loss_multiplier"] != 0 else 0
+                get_volatility = lambda asset: market.get_volatility(day, asset.expiration, asset.right, asset.strike)
+                trade.guard_bands = get_guard_bands(trade, underlying_price, day, self.parameters, market.risk_free_rate, get_volatility, cost_to_close)
+
+    def find_target_delta_strike(self, market, day, expiry, strikes, right, delta_required):
+        # The search of OptionsStrategyEngine.find_target_delta_strike over the deltas of the day
+        if right == "call":
+            is_reached = lambda delta: delta <= delta_required
+        else:
+            is_reached = lambda delta: delta >= -delta_required
+
+        if self.parameters.get("delta_search", "bisection") == "bisection":
+            previous_strike = self.target_delta_strikes.get((str(expiry), right))
+            start_index = strikes.index(previous_strike) if previous_strike in strikes else None
+
+            deltas = {}
+            def is_index_reached(index):
+                deltas[index] = market.get_deltas(day, expiry, right, [strikes[index]])[0]
+                return None if deltas[index] is None else is_reached(deltas[index])
+
+            index = find_first_index(len(strikes), is_index_reached, start_index)
+            if index is not None:
+                if index == len(strikes):
+                    return None, None
+                self.target_delta_strikes[(str(expiry), right)] = strikes[index]
+                return strikes[index], deltas[index]
+
+        for batch_start in range(0, len(strikes), greeks_batch_size):
+            batch_strikes = strikes[batch_start:batch_start + greeks_batch_size]
+            for strike, delta in zip(batch_strikes, market.get_deltas(day, expiry, right, batch_strikes)):
+                if delta is not None and is_reached(delta):
+                    self.target_delta_strikes[(str(expiry), right)] = strike
+                    return strike, delta
+        return None, None
+
+    def get_spread(self, market, day, symbol, expiry, right, short_strike, distance_of_wings):
+        # The short and long legs of the spread with their prices, or None if either has no price
+        wing_strike = short_strike + distance_of_wings if right == "call" else short_strike - distance_of_wings
+        sell_price = market.get_option_price(day, expiry, right, short_strike)
+        buy_price = market.get_option_price(day, expiry, right, wing_strike)
+        if sell_price is None or buy_price is None:
+            return None
+        return (SimulatedOption(symbol, expiry, short_strike, right), sell_price), (SimulatedOption(symbol, expiry, wing_strike, right), buy_price)
+
+    def create_legs(self, market, day, expiry, side, last_trade_size, roll, trade):
+        symbol = self.parameters["symbol"]
+        strike_step_size = self.parameters["strike_step_size"]
+        distance_of_wings = self.parameters["distance_of_wings"]
+        quantity_to_trade = self.parameters["quantity_to_trade"]
+        maximum_portfolio_allocation = self.parameters["maximum_portfolio_allocation"]
+        underlying_price = market.get_underlying_price(day)
+        rounded_underlying_price = round(underlying_price / strike_step_size) * strike_step_size
+
+        revised_quantity_to_trade = quantity_to_trade
+        if roll:
+            revised_quantity_to_trade = last_trade_size
+        else:
+            portfolio_value = self.get_portfolio_value(market, day)
+            if distance_of_wings * 100 * quantity_to_trade > portfolio_value * maximum_portfolio_allocation:
+                revised_quantity_to_trade = int((portfolio_value * maximum_portfolio_allocation) / (distance_of_wings * 100))
+
+        if revised_quantity_to_trade <= 0:
+            print("****** invalid trade size")
+            sys.exit(1)
+
+        strike_ladder = market.get_strike_ladder(expiry)
+        max_strikes = self.parameters["max_strikes"]
+
+        call_strikes = sorted(strike for strike in strike_ladder.get_strike_window("call", rounded_underlying_price, max_strikes) if strike > underlying_price)
+        call_strike, last_call_delta = self.find_target_delta_strike(market, day, expiry, call_strikes, "call", self.parameters["call_delta_required"])
+        if call_strike is None and (side == "call" or side == "both"):
+            return "no call strike found", 0, 0, 0, 0, 0, 0
+
+        put_strikes = sorted((strike for strike in strike_ladder.get_strike_window("put", rounded_underlying_price, max_strikes) if strike < underlying_price), reverse=True)
+        put_strike, last_put_delta = self.find_target_delta_strike(market, day, expiry, put_strikes, "put", self.parameters["put_delta_required"])
+        if put_strike is None and (side == "put" or side == "both"):
+            return "no put strike found", 0, 0, 0, 0, 0, 0
+
+        call_strike_adjustment = 0
+        call_spread, put_spread = None, None
+        if side == "call" or side == "both":
+            for short_strike, _ in strike_ladder.get_spread_candidates("call", call_strike, distance_of_wings):
+                call_spread = self.get_spread(market, day, symbol, expiry, "call", short_strike, distance_of_wings)
+                if call_spread is not None:
+                    call_strike_adjustment = short_strike - call_strike
+                    break
+
+        if side == "put" or side == "both":
+            for short_strike, _ in strike_ladder.get_spread_candidates("put", put_strike - call_strike_adjustment, distance_of_wings):
+                put_spread = self.get_spread(market, day, symbol, expiry, "put", short_strike, distance_of_wings)
+                if put_spread is not None:
+                    break
+
+        maximum_credit = 0
+        for spread in [call_spread, put_spread]:
+            if spread is None:
+                continue
+            (sell_asset, sell_price), (buy_asset, buy_price) = spread
+            self.fill_order(sell_price, -revised_quantity_to_trade)
+            self.fill_order(buy_price, revised_quantity_to_trade)
+            self.position_book.add_leg(trade, sell_asset, -revised_quantity_to_trade)
+            self.position_book.add_leg(trade, buy_asset, revised_quantity_to_trade)
+            self.last_prices[get_leg_key(sell_asset)] = sell_price
+            self.last_prices[get_leg_key(buy_asset)] = buy_price
+            maximum_credit += sell_price - buy_price
+        maximum_credit = round(maximum_credit, 2)
+
+        if side == "both" and (call_spread is None or put_spread is None):
+            return "failed to place condor", call_strike, put_strike, 0, 0, 0, 0
+        elif side == "call" and call_spread is None:
+            return "failed to roll call side", call_strike, put_strike, 0, 0, 0, 0
+        elif side == "put" and put_spread is None:
+            return "failed to roll put side", call_strike, put_strike, 0, 0, 0, 0
+
+        status_messages = {
+            "call": "Success: rolled the call side",
+            "put": "Success: rolled the put side",
+            "both": "Success the Condor"}
+        return status_messages[side], call_strike, put_strike, maximum_credit, revised_quantity_to_trade, last_call_delta, last_put_delta
+
+    def trade_day(self, market, day):
+        '''
+        One trading iteration of the strategy on day
+        '''
+        parameters = self.parameters
+        option_duration = parameters["option_duration"]
+        days_before_expiry_to_buy_back = parameters["days_before_expiry_to_buy_back"]
+        distance_of_wings = parameters["distance_of_wings"]
+        minimum_hold_period = parameters["minimum_hold_period"]
+        strike_roll_distance = parameters["strike_roll_distance"]
+        maximum_rolls = parameters["maximum_rolls"]
+        max_loss_multiplier = parameters["max_loss_multiplier"]
+        roll_strategy = parameters["roll_strategy"]
+        delta_threshold = parameters["delta_threshold"]
+        days_to_stay_out_of_market = parameters["max_loss_trade_days_to_skip"]
+        skip_on_max_rolls = parameters["skip_on_max_rolls"]
+        max_symbol_volitility = parameters["max_symbol_volitility"]
+        max_volitility_days_to_skip = parameters["max_volitility_days_to_skip"]
+        sides = {"bull-put-spread": "put", "bear-call-spread": "call"}.get(parameters["trade_strategy"], "both")
+        days_to_skip = days_to_stay_out_of_market
+
+        dt = datetime.combine(day, datetime.min.time())
+        underlying_price = market.get_underlying_price(day)
+
+        self.hold_length += 1
+        for trade in self.position_book.get_open_trades():
+            trade.hold_length += 1
+
+        self.portfolio_value_history.append({"datetime": dt, "portfolio_value": self.get_portfolio_value(market, day)})
+        self.historical_price.append(round(underlying_price, 0))
+
+        # The max move check
+        if len(self.historical_price) > 2:
+            if (self.historical_price[-1] * (1 + max_symbol_volitility) < self.historical_price[-2]) or (self.historical_price[-1] * (1 - max_symbol_volitility) > self.historical_price[-2]):
+                self.max_move_hit_flag = True
+                self.skipped_days_counter = 0
+                days_to_skip = max_volitility_days_to_skip
+            else:
+                self.max_move_hit_flag = False
+                days_to_skip = days_to_stay_out_of_market
+
+        self.skipped_days_counter += 1
+        if not (self.stay_out_of_market and self.skipped_days_counter < days_to_skip):
+            self.stay_out_of_market = False
+            self.skipped_days_counter = 0
+
+        max_open_trades = parameters.get("max_open_trades", 1)
+        entry_spacing_days = parameters.get("entry_spacing_days", 0)
+        trigger_gating = parameters.get("trigger_gating", False)
+        get_option_price = lambda asset: market.get_option_price(day, asset.expiration, asset.right, asset.strike)
+
+        trade_closed = False
+        for trade in self.position_book.get_open_trades():
+            if trigger_gating and is_inside_guard_bands(trade.guard_bands, underlying_price, day, days_before_expiry_to_buy_back, self.max_move_hit_flag, market.risk_free_rate, get_option_price):
+                continue
+            trade.guard_bands = None
+
+            roll_call_short = False
+            roll_put_short = False
+            sell_the_condor = False
+            original_expiration_date = None
+
+            for asset, quantity in trade.get_legs():
+                roll_call_short = False
+                roll_put_short = False
+                sell_the_condor = False
+
+                original_expiration_date = asset.expiration
+                if (asset.expiration - day).days <= days_before_expiry_to_buy_back:
+                    sell_the_condor = True
+                    break
+
+                if quantity < 0:
+                    if roll_strategy == "delta":
+                        delta = market.get_deltas(day, asset.expiration, asset.right, [asset.strike])[0]
+                        if delta is not None and abs(delta) > abs(delta_threshold):
+                            if asset.right == "call":
+                                roll_call_short = True
+                            else:
+                                roll_put_short = True
+                            break
+                    if roll_strategy == "short":
+                        if asset.right == "call" and underlying_price >= asset.strike - strike_roll_distance:
+                            roll_call_short = True
+                            break
+                        if asset.right == "put" and underlying_price <= asset.strike + strike_roll_distance:
+                            roll_put_short = True
+                            break
+
+            if roll_call_short or roll_put_short:
+                trade.roll_count += 1
+                if trade.roll_count > maximum_rolls:
+                    sell_the_condor = True
+                    roll_call_short = False
+                    roll_put_short = False
+                    if skip_on_max_rolls:
+                        self.stay_out_of_market = True
+                        self.skipped_days_counter = 0
+
+            if self.max_move_hit_flag and trade.has_legs():
+                sell_the_condor = True
+                roll_call_short = False
+                roll_put_short = False
+                self.stay_out_of_market = True
+                self.skipped_days_counter = 0
+
+            if max_loss_multiplier != 0 and self.cost_to_close_position(market, day, trade) > trade.purchase_credit * max_loss_multiplier:
+                if trade.has_legs():
+                    sell_the_condor = True
+                    roll_call_short = False
+                    roll_put_short = False
+                    self.stay_out_of_market = True
+                    self.skipped_days_counter = 0
+
+            if sell_the_condor:
+                self.trade_events.append(get_trade_event(dt, "close", "both", trade))
+                self.close_trade(market, day, trade)
+                trade_closed = True
+                self.hold_length = 0
+
+                if self.stay_out_of_market or not self.entries_allowed(dt):
+                    continue
+                if not self.position_book.can_open_trade(dt, max_open_trades, entry_spacing_days):
+                    continue
+
+                new_expiry = market.get_next_expiration_date(day, option_duration)
+                new_trade = self.position_book.open_trade(dt)
+                condor_status, _, _, purchase_credit, last_trade_size, _, _ = self.create_legs(market, day, new_expiry, sides, trade.last_trade_size, False, new_trade)
+                new_trade.purchase_credit = purchase_credit
+                new_trade.last_trade_size = last_trade_size
+                if not new_trade.has_legs():
+                    self.position_book.close_trade(new_trade)
+                if "Success" in condor_status:
+                    self.trade_events.append(get_trade_event(dt, "open", sides, new_trade))
+
+            elif roll_call_short or roll_put_short:
+                if (int(trade.hold_length) < int(minimum_hold_period)) and (not self.max_move_hit_flag):
+                    continue
+
+                if roll_call_short:
+                    side = "call"
+                    self.close_spread(market, day, side, trade)
+                if roll_put_short:
+                    side = "put"
+                    self.close_spread(market, day, side, trade)
+                trade.hold_length = 0
+
+                condor_status, _, _, _, _, _, _ = self.create_legs(market, day, original_expiration_date, side, trade.last_trade_size, True, trade)
+                if "Success" in condor_status:
+                    self.trade_events.append(get_trade_event(dt, "roll", side, trade))
+
+        if trigger_gating:
+            self.update_guard_bands(market, day)
+
+        if (
+            self.position_book.can_open_trade(dt, max_open_trades, entry_spacing_days)
+            and not trade_closed
+            and not self.stay_out_of_market
+            and not self.portfolio_blew_up
+        ):
+            if not self.entries_allowed(dt):
+                return
+
+            self.portfolio_blew_up = self.cash < distance_of_wings * 100
+            if self.portfolio_blew_up:
+                return
+
+            expiry = market.get_next_expiration_date(day, option_duration)
+            trade = self.position_book.open_trade(dt)
+            trade.hold_length = self.hold_length
+            condor_status, _, _, purchase_credit, last_trade_size, _, _ = self.create_legs(market, day, expiry, sides, trade.last_trade_size, False, trade)
+            trade.purchase_credit = purchase_credit
+            trade.last_trade_size = last_trade_size
+            if not trade.has_legs():
+                self.position_book.close_trade(trade)
+            elif trigger_gating:
+                self.update_guard_bands(market, day)
+            if "Success" in condor_status:
+                self.trade_events.append(get_trade_event(dt, "open", sides, trade))
+
+    def finish(self, market):
+        # The value at the end of the backtest, like on_strategy_end
+        last_day = market.trading_days[-1]
+        self.portfolio_value_history.append({"datetime": datetime.combine(last_day, datetime.min.time()), "portfolio_value": self.get_portfolio_value(market, last_day)})
+
+    def get_results(self, strategy_file, run_seconds):
+        '''
+        The results in the form returned by run_strategy_backtest
+        '''
+        return {
+            "strategy_file": strategy_file,
+            "strategy_parameters": self.parameters,
+            "stats_file": write_stats_file(strategy_file, self.portfolio_value_history),
+            "tearsheet_path": "",
+            "strategy_return": get_strategy_return_from_portfolio_values(self.portfolio_value_history),
+            "portfolio_values": self.portfolio_value_history,
+            "backtest_analysis": None,
+            "run_seconds": run_seconds,
+            "ended_flat": sum(len(trade.legs) for trade in self.position_book.get_open_trades()) < 2,
+            "trade_events": self.trade_events,
+            "backtest_engine": "simulator",
+        }
+
+def write_stats_file(strategy_file, portfolio_values):
+    '''
+    Write the portfolio values to the strategy log directory, like the stats file of a Lumibot
+    backtest, and return the file name
+    '''
+    strategy_directory = strategy_file.split(".")[0]
+    target_dir = f"strategy_logs/{strategy_directory}/"
+    os.makedirs(target_dir, exist_ok=True)
+    stats_file = f"{strategy_directory}_simulated_stats.csv"
+    with open(os.path.join(target_dir, stats_file), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["datetime", "portfolio_value"])
+        for value in portfolio_values:
+            writer.writerow([value["datetime"].isoformat(), value["portfolio_value"]])
+    return stats_file
+
+def get_default_budget(strategy_parameters):
+    return strategy_parameters["distance_of_wings"] * 100 * strategy_parameters["quantity_to_trade"] * 1.5
+
+def run_simulated_backtest(strategy_file, strategy_parameters, capital_budget=None, market=None):
+    '''
+    Run one configuration on the simulator and return results in the same form as
+    run_strategy_backtest.  A market already loaded for the same symbol and dates can be passed in.
+    '''
+    if capital_budget is None:
+        capital_budget = get_default_budget(strategy_parameters)
+
+    run_start_time = time.perf_counter()
+    if market is None:
+        market = SimulationMarket(strategy_parameters["symbol"], strategy_parameters["starting_date"], strategy_parameters["ending_date"])
+    if len(market.trading_days) == 0:
+        raise ValueError(f"No {strategy_parameters['symbol']} trading days between {strategy_parameters['starting_date']} and {strategy_parameters['ending_date']}")
+
+    portfolio = VirtualPortfolio(strategy_parameters, capital_budget)
+    for day in market.trading_days:
+        portfolio.trade_day(market, day)
+    portfolio.finish(market)
+
+    run_seconds = time.perf_counter() - run_start_time
+    results = portfolio.get_results(strategy_file, run_seconds)
+    print(f">>>>> Simulated {strategy_file}: return {results['strategy_return']}, {len(portfolio.trade_events)} trade events in {run_seconds:.2f} seconds")
+    return results
+
+def get_lockstep_key(strategy_parameters):
+    # Any option_duration can share a market, the expirations are loaded as they are traded
+    return (strategy_parameters["symbol"], str(get_date(strategy_parameters["starting_date"])), str(get_date(strategy_parameters["ending_date"])))
+
+def group_lockstep_runs(runs):
+    '''
+    Group the (strategy_file, strategy_parameters) runs that can share one pass over the market
+    '''
+    run_groups = {}
+    for strategy_file, strategy_parameters in runs:
+        run_groups.setdefault(get_lockstep_key(strategy_parameters), []).append((strategy_file, strategy_parameters))
+    return list(run_groups.values())
+
+def run_lockstep_simulation(runs):
+    '''
+    Run configurations with the same symbol and dates in one pass over the trading days.  The
+    market, with its option chains and deltas, is loaded once and every day each configuration
+    trades its own VirtualPortfolio, with its own trades, rolls and skip counters.  Returns
+    (strategy_file, strategy_parameters, results) for every run, with the exception in place of
+    the results for a run that failed, so one failed configuration does not stop the others.
+    '''
+    run_start_time = time.perf_counter()
+    first_parameters = runs[0][1]
+    if any(get_lockstep_key(strategy_parameters) != get_lockstep_key(first_parameters) for _, strategy_parameters in runs):
+        raise ValueError("Lockstep runs must share the symbol, starting_date and ending_date")
+
+    market = SimulationMarket(first_parameters["symbol"], first_parameters["starting_date"], first_parameters["ending_date"])
+    if len(market.trading_days) == 0:
+        raise ValueError(f"No {first_parameters['symbol']} trading days between {first_parameters['starting_date']} and {first_parameters['ending_date']}")
+
+    portfolios = [VirtualPortfolio(strategy_parameters, get_default_budget(strategy_parameters)) for _, strategy_parameters in runs]
+    failures = {}
+    for day in market.trading_days:
+        for index, portfolio in enumerate(portfolios):
+            if index in failures:
+                continue
+            try:
+                portfolio.trade_day(market, day)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                # Includes sys.exit() on an invalid trade size, as in the strategy
+                failures[index] = e
+
+    # The pass is shared, each run is charged an equal part of it
+    run_seconds = (time.perf_counter() - run_start_time) / len(runs)
+    lockstep_results = []
+    for index, ((strategy_file, strategy_parameters), portfolio) in enumerate(zip(runs, portfolios)):
+        if index in failures:
+            lockstep_results.append((strategy_file, strategy_parameters, failures[index]))
+            continue
+        portfolio.finish(market)
+        lockstep_results.append((strategy_file, strategy_parameters, portfolio.get_results(strategy_file, run_seconds)))
+
+    print(f">>>>> Simulated {len(runs)} {first_parameters['symbol']} configurations in one pass of {len(market.trading_days)} days, {len(failures)} failed, {time.perf_counter() - run_start_time:.2f} seconds")
+    return lockstep_results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run strategy configurations on the simulator")
+    parser.add_argument("strategy_files", nargs="+", help="paths of the TOML files to simulate")
+    args = parser.parse_args()
+
+    runs = []
+    for strategy_path in args.strategy_files:
+        strategy_file = os.path.basename(strategy_path)
+        configuration = toml.load(strategy_path)
+        for strategy_parameters in expand_parameter_grid(configuration):
+            # Grid combinations are named like the driver names them, so their stats files do not collide
+            run_file = strategy_file
+            if "parameter_grid" in configuration:
+                run_file = f"{strategy_file.split('.')[0]}-{get_parameter_hash(strategy_parameters)[:12]}.toml"
+            runs.append((run_file, strategy_parameters))
+
+    for run_group in group_lockstep_runs(runs):
+        for strategy_file, strategy_parameters, results in run_lockstep_simulation(run_group):
+            if isinstance(results, BaseException):
+                print(f"****** Simulation failed for {strategy_file}: {results!r}")
+            else:
+                print(f">>>>> {strategy_file}: return {results['strategy_return']}, {len(results['trade_events'])} trade events")
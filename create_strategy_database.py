@@ -1,7 +1,39 @@
+import json
 import sqlite3
 
+# All the backtest results are kept in one database, whatever directory a sweep is run from
+results_database = '/Users/irvshapiro/drvax-code-local/AAA Lumibot/mwt_backtesting_machine_results.db'
+
+# Columns added after the table was first created.  Existing databases are updated
+# by add_missing_columns so older results are kept.
+added_columns = [
+    ("run_seconds", "REAL"),  # Wall clock time of the backtest, used to estimate the cost of future runs
+    ("max_drawdown", "REAL"),  # Largest drop of the portfolio value from a previous high as a decimal
+    ("window_days", "INTEGER"),  # Number of days from starting_date to ending_date, see successive_halving.py
+    ("backtest_engine", "TEXT"),  # lumibot or simulator, rows written before the column are lumibot
+    ("other_parameters", "TEXT"),  # JSON of the parameters without a column, NULL on rows written before the column
+]
+
+def add_missing_columns(cursor):
+    existing_columns = get_column_names(cursor)
+    for column_name, column_type in added_columns:
+        if column_name not in existing_columns:
+            cursor.execute(f"ALTER TABLE mwt_benchmark_returns ADD COLUMN {column_name} {column_type}")
+
+def get_column_names(cursor):
+    cursor.execute("PRAGMA table_info(mwt_benchmark_returns)")
+    return {row[1] for row in cursor.fetchall()}
+
+def get_other_parameters(strategy_parameters, column_names):
+    '''
+    The parameters without a column of their own, such as max_open_trades or trigger_gating, as the
+    JSON stored in other_parameters
+    '''
+    other_parameters = {key: value for key, value in strategy_parameters.items() if key not in column_names}
+    return json.dumps(other_parameters, sort_keys=True, default=str)
+
 def create_database_and_table():
-    conn = sqlite3.connect('mwt_backtesting_machine_results.db')  # Creates a new database if not exists
+    conn = sqlite3.connect(results_database)  # Creates a new database if not exists
     cursor = conn.cursor()
 
     # Create table
@@ -36,10 +68,18 @@ def create_database_and_table():
             trading_fee REAL,
             stats_file_name TEXT,
             tearsheet_html TEXT,
-            parameter_hash TEXT
+            parameter_hash TEXT,
+            run_seconds REAL,
+            max_drawdown REAL,
+            window_days INTEGER,
+            backtest_engine TEXT,
+            other_parameters TEXT
         )
     ''')
 
+    add_missing_columns(cursor)
+    conn.commit()
+
     print("Table created successfully")
 
     # Close connection
@@ -0,0 +1,131 @@
+# expiration_calendar
+#
+# Description: The listed option expirations of a symbol, kept sorted so "the first listed expiration
+# on or after a day" is a bisect search.  The calendar is built from the Polygon contract reference,
+# once per symbol and date range.  Ranges that have passed are stored in the option contract cache
+# database, so later backtests and sweeps read the calendar without calling Polygon, and each process
+# keeps the calendars it has loaded in memory so every backtest in a worker shares them.
+
+import sqlite3
+from bisect import bisect_left
+from datetime import date, timedelta
+
+from option_contract_cache import contract_cache_database
+from polygon_http_client import get_json
+from sweep_scheduler import get_date
+
+# Calendars loaded by this process, keyed by symbol
+_expiration_calendars = {}
+
+def fetch_expiration_dates(symbol, first_day, last_day, api_key, expired=True):
+    '''
+    The distinct expiration dates of the symbol's call contracts between first_day and last_day
+    '''
+    expiration_dates = set()
+    options_url = (f"https://api.polygon.io/v3/reference/options/contracts?underlying_ticker={symbol}&contract_type=call&expired={str(expired).lower()}"
+                   f"&expiration_date.gte={first_day}&expiration_date.lte={last_day}&limit=1000&apiKey={api_key}")
+    while True:
+        data = get_json(options_url)
+        expiration_dates.update(option["expiration_date"] for option in data.get("results", []))
+        if data.get('next_url'):
+            options_url = f"{data['next_url']}&apiKey={api_key}"
+        else:
+            break
+    return expiration_dates
+
+class ExpirationCalendar():
+
+    def __init__(self, symbol, expiration_dates=(), database=contract_cache_database):
+        self.symbol = symbol
+        self.database = database
+        self.expiration_dates = sorted({get_date(expiration_date) for expiration_date in expiration_dates})
+        self.covered_ranges = []
+
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expiration_calendar (
+                symbol TEXT,
+                expiration_date TEXT,
+                PRIMARY KEY (symbol, expiration_date)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expiration_calendar_ranges (
+                symbol TEXT,
+                first_day TEXT,
+                last_day TEXT
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, parameters=()):
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def load(self):
+        '''
+        Read the stored expirations and the date ranges they cover
+        '''
+        rows = self.execute("SELECT expiration_date FROM expiration_calendar WHERE symbol = ?", (self.symbol,))
+        self.add_expiration_dates(expiration_date for expiration_date, in rows)
+        self.covered_ranges = [(get_date(first_day), get_date(last_day)) for first_day, last_day in
+                               self.execute("SELECT first_day, last_day FROM expiration_calendar_ranges WHERE symbol = ?", (self.symbol,))]
+
+    def add_expiration_dates(self, expiration_dates):
+        self.expiration_dates = sorted(set(self.expiration_dates) | {get_date(expiration_date) for expiration_date in expiration_dates})
+
+    def is_covered(self, first_day, last_day):
+        return any(covered_first <= first_day and last_day <= covered_last for covered_first, covered_last in self.covered_ranges)
+
+    def ensure_range(self, first_day, last_day, api_key):
+        '''
+        Make sure the calendar lists every expiration between first_day and last_day.  Only the part
+        of the range before today is stored, later expirations can still be listed.
+        '''
+        first_day, last_day = get_date(first_day), get_date(last_day)
+        if self.is_covered(first_day, last_day):
+            return
+
+        today = date.today()
+        if first_day < today:
+            expired_last_day = min(last_day, today - timedelta(days=1))
+            if not self.is_covered(first_day, expired_last_day):
+                expiration_dates = fetch_expiration_dates(self.symbol, first_day, expired_last_day, api_key, expired=True)
+                for expiration_date in expiration_dates:
+                    self.execute("INSERT OR IGNORE INTO expiration_calendar (symbol, expiration_date) VALUES (?, ?)", (self.symbol, expiration_date))
+                self.execute("INSERT INTO expiration_calendar_ranges (symbol, first_day, last_day) VALUES (?, ?, ?)", (self.symbol, str(first_day), str(expired_last_day)))
+                self.covered_ranges.append((first_day, expired_last_day))
+                self.add_expiration_dates(expiration_dates)
+
+        if last_day >= today:
+            self.add_expiration_dates(fetch_expiration_dates(self.symbol, max(first_day, today), last_day, api_key, expired=False))
+            # Covered for the life of this process only
+            self.covered_ranges.append((first_day, last_day))
+
+    def get_first_expiration_on_or_after(self, day):
+        '''
+        The first listed expiration on or after day, or None
+        '''
+        index = bisect_left(self.expiration_dates, get_date(day))
+        if index == len(self.expiration_dates):
+            return None
+        return self.expiration_dates[index]
+
+def get_expiration_calendar(symbol, first_day, last_day, api_key):
+    '''
+    The calendar of the symbol covering first_day..last_day, shared by every backtest in this process
+    '''
+    expiration_calendar = _expiration_calendars.get(symbol)
+    if expiration_calendar is None:
+        expiration_calendar = ExpirationCalendar(symbol)
+        expiration_calendar.load()
+        _expiration_calendars[symbol] = expiration_calendar
+    expiration_calendar.ensure_range(first_day, last_day, api_key)
+    return expiration_calendar
@@ -16,6 +16,25 @@ def get_strategy_return(stats_file):
     total_return = (df_daily_returns + 1).cumprod() - 1
     return (total_return.iloc[-1])
 
+def get_strategy_return_from_portfolio_values(portfolio_values):
+    # portfolio_values is the list of {"datetime", "portfolio_value"} rows recorded by the strategy.
+    # The compounded daily returns reduce to the last value over the first value.
+    if len(portfolio_values) < 2 or portfolio_values[0]["portfolio_value"] == 0:
+        return None
+    return (portfolio_values[-1]["portfolio_value"] / portfolio_values[0]["portfolio_value"]) - 1
+
+def get_max_drawdown_from_portfolio_values(portfolio_values):
+    # The largest drop from a previous high as a positive decimal, 0.25 is a 25% drawdown
+    max_drawdown = 0
+    high_water_mark = None
+    for row in portfolio_values:
+        portfolio_value = row["portfolio_value"]
+        if high_water_mark is None or portfolio_value > high_water_mark:
+            high_water_mark = portfolio_value
+        if high_water_mark > 0:
+            max_drawdown = max(max_drawdown, (high_water_mark - portfolio_value) / high_water_mark)
+    return max_drawdown
+
 if __name__ == "__main__":
     strategy_stats_file = "logs/mwt-IBM-bull-put-spread_2024-03-21_13-55-24_stats.csv"
     strategy_return = get_strategy_return(strategy_stats_file)
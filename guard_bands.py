@@ -0,0 +1,173 @@
+# guard_bands
+#
+# Description: The underlying prices between which none of the roll and max loss checks of a trade can
+# trigger, used by the optional trigger_gating parameter.  Inside its bands a trade is not checked, so
+# a quiet day computes no greeks and prices only the short legs.  The strategy and the simulator build
+# the bands with the same functions from the implied volatility of each leg.
+#
+#   - a distance roll triggers at the short strike minus or plus strike_roll_distance
+#   - a delta roll triggers where the short's delta reaches delta_threshold, solved from Black-Scholes
+#   - the max loss triggers where the cost to close reaches the max loss, estimated by pricing the legs
+#     over a range of underlying prices
+#
+# The volatility and the time to expiration change while a trade is skipped.  The delta and max loss
+# prices are solved for every volatility of guard_band_volatility_scenarios, a multiple of the implied
+# volatility of the legs when the bands were set, and for the days to expiration left now, on the last
+# day a trade can be skipped and halfway between, and the band closest to the current price is used.
+# On a skipped day the shorts are priced: a price outside the Black-Scholes prices of the lowest and
+# highest volatility scenario means the volatility left the scenarios and the trade is checked.
+
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+from vectorized_greeks import black_scholes_price, get_years_to_expiration
+
+# The implied volatility of the band is the one of the legs divided and multiplied by this multiple
+guard_band_volatility_multiplier = 1.5
+guard_band_volatility_scenarios = [1 / guard_band_volatility_multiplier, 1.0, guard_band_volatility_multiplier]
+# The max loss band is searched within this fraction of the underlying price, in this many steps
+guard_band_price_range = 0.2
+guard_band_price_steps = 401
+
+def get_days_scenarios(days_to_expiration, days_before_expiry_to_buy_back):
+    '''
+    The days to expiration of the time scenarios: today, halfway and the last day a trade is skipped
+    '''
+    last_skipped_days = min(days_to_expiration, days_before_expiry_to_buy_back + 1)
+    return sorted({days_to_expiration, (days_to_expiration + last_skipped_days) // 2, last_skipped_days}, reverse=True)
+
+def get_delta_trigger_price(strike, right, volatility, days_to_expiration, days_before_expiry_to_buy_back, risk_free_rate, delta_threshold):
+    '''
+    The underlying price closest to the money at which the delta of the option reaches
+    delta_threshold in any volatility and time scenario, or None
+    '''
+    right = str(right).lower()
+    target = abs(delta_threshold) if right == "call" else 1 - abs(delta_threshold)
+    if volatility is None or not math.isfinite(volatility) or not 0 < target < 1:
+        return None
+
+    d1 = NormalDist().inv_cdf(target)
+    trigger_prices = []
+    for days in get_days_scenarios(days_to_expiration, days_before_expiry_to_buy_back):
+        years = get_years_to_expiration(days)
+        for scenario_volatility in [volatility * scenario for scenario in guard_band_volatility_scenarios]:
+            trigger_prices.append(strike * math.exp(d1 * scenario_volatility * math.sqrt(years) - (risk_free_rate + 0.5 * scenario_volatility ** 2) * years))
+    # Calls trigger above the price and puts below it
+    return min(trigger_prices) if right == "call" else max(trigger_prices)
+
+def get_max_loss_trigger_prices(underlying_price, legs, days_before_expiry_to_buy_back, risk_free_rate, cost_to_close, max_loss):
+    '''
+    The lowest and highest underlying prices, within guard_band_price_range of the current price,
+    between which the estimated cost to close stays under max_loss in every scenario.
+    legs is a list of (strike, right, quantity, volatility, days_to_expiration).
+    '''
+    if cost_to_close > max_loss:
+        return underlying_price, underlying_price
+
+    strikes = np.array([leg[0] for leg in legs], dtype=float)
+    is_call = np.array([str(leg[1]).lower() == "call" for leg in legs])
+    # Shorts are bought back and add to the cost to close, longs are sold and reduce it
+    signs = np.array([1 if leg[2] < 0 else -1 for leg in legs])
+    volatilities = np.array([leg[3] for leg in legs], dtype=float)
+    days_to_expiration = np.array([leg[4] for leg in legs])
+
+    # The middle of the range is the current price.  The model is shifted to the actual cost to close
+    # today, the same shift is kept for the other scenarios.
+    prices = underlying_price * np.linspace(1 - guard_band_price_range, 1 + guard_band_price_range, guard_band_price_steps)
+    option_prices = black_scholes_price(prices[:, None], strikes, np.array([get_years_to_expiration(days) for days in days_to_expiration]), risk_free_rate, volatilities, is_call)
+    model_shift = cost_to_close - (option_prices @ signs)[guard_band_price_steps // 2]
+
+    triggered = np.zeros(len(prices), dtype=bool)
+    days_scenarios = get_days_scenarios(int(days_to_expiration.min()), days_before_expiry_to_buy_back)
+    for days_passed in [days_scenarios[0] - days for days in days_scenarios]:
+        years = np.array([get_years_to_expiration(days - days_passed) for days in days_to_expiration])
+        for scenario in guard_band_volatility_scenarios:
+            option_prices = black_scholes_price(prices[:, None], strikes, years, risk_free_rate, volatilities * scenario, is_call)
+            triggered |= option_prices @ signs + model_shift > max_loss
+
+    below = prices < underlying_price
+    lower_triggers = prices[below & triggered]
+    upper_triggers = prices[~below & triggered]
+    price_step = prices[1] - prices[0]
+    lower_price = lower_triggers.max() + price_step if len(lower_triggers) else prices[0]
+    upper_price = upper_triggers.min() - price_step if len(upper_triggers) else prices[-1]
+    return lower_price, upper_price
+
+def get_guard_bands(trade, underlying_price, day, parameters, risk_free_rate, get_volatility, cost_to_close):
+    '''
+    The guard bands of a trade on day, or None if a leg has no volatility.  get_volatility(asset)
+    returns the implied volatility of a leg or None.
+    '''
+    roll_strategy = parameters["roll_strategy"]
+    days_before_expiry_to_buy_back = parameters["days_before_expiry_to_buy_back"]
+    lower_price, upper_price = 0, math.inf
+    expiration = None
+    legs = []
+    shorts = []
+    for asset, quantity in trade.get_legs():
+        expiration = asset.expiration if expiration is None else min(expiration, asset.expiration)
+        volatility = get_volatility(asset)
+        if volatility is None or not math.isfinite(volatility):
+            return None
+        legs.append((asset.strike, asset.right, quantity, volatility, (asset.expiration - day).days))
+        if quantity >= 0:
+            continue
+        shorts.append((asset, volatility))
+
+        right = str(asset.right).lower()
+        if roll_strategy == "short":
+            if right == "call":
+                upper_price = min(upper_price, asset.strike - parameters["strike_roll_distance"])
+            else:
+                lower_price = max(lower_price, asset.strike + parameters["strike_roll_distance"])
+        elif roll_strategy == "delta":
+            delta_price = get_delta_trigger_price(asset.strike, right, volatility, (asset.expiration - day).days, days_before_expiry_to_buy_back, risk_free_rate, parameters["delta_threshold"])
+            if delta_price is None:
+                return None
+            if right == "call":
+                upper_price = min(upper_price, delta_price)
+            else:
+                lower_price = max(lower_price, delta_price)
+
+    max_loss_multiplier = parameters["max_loss_multiplier"]
+    if max_loss_multiplier != 0:
+        max_loss_prices = get_max_loss_trigger_prices(underlying_price, legs, days_before_expiry_to_buy_back, risk_free_rate, cost_to_close, trade.purchase_credit * max_loss_multiplier)
+        lower_price = max(lower_price, max_loss_prices[0])
+        upper_price = min(upper_price, max_loss_prices[1])
+
+    return {"expiration": expiration, "lower_price": lower_price, "upper_price": upper_price, "shorts": shorts}
+
+def is_volatility_inside_scenarios(shorts, underlying_price, day, risk_free_rate, get_option_price):
+    '''
+    True if the price of every short is between its Black-Scholes prices at the lowest and highest
+    volatility scenario, the option price rises with the volatility
+    '''
+    for asset, volatility in shorts:
+        option_price = get_option_price(asset)
+        if option_price is None:
+            return False
+        years = get_years_to_expiration((asset.expiration - day).days)
+        is_call = str(asset.right).lower() == "call"
+        scenario_prices = [
+            float(black_scholes_price(underlying_price, np.array([float(asset.strike)]), years, risk_free_rate, np.array([volatility * scenario]), is_call)[0])
+            for scenario in [min(guard_band_volatility_scenarios), max(guard_band_volatility_scenarios)]
+        ]
+        if not scenario_prices[0] <= option_price <= scenario_prices[1]:
+            return False
+    return True
+
+def is_inside_guard_bands(guard_bands, underlying_price, day, days_before_expiry_to_buy_back, max_move_hit, risk_free_rate, get_option_price):
+    '''
+    A trade can skip its checks when nothing can trigger: the price is inside its bands, the expiry
+    is not close, no max move was hit and the volatility of the shorts is inside the scenarios.
+    get_option_price(asset) returns the price of a leg or None.
+    '''
+    if guard_bands is None or max_move_hit:
+        return False
+    if (guard_bands["expiration"] - day).days <= days_before_expiry_to_buy_back:
+        return False
+    if not guard_bands["lower_price"] < underlying_price < guard_bands["upper_price"]:
+        return False
+    return is_volatility_inside_scenarios(guard_bands["shorts"], underlying_price, day, risk_free_rate, get_option_price)
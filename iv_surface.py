@@ -0,0 +1,165 @@
+# iv_surface
+#
+# Description: Implied volatility surfaces, one per (symbol, trading day), indexed by expiry, right and
+# moneyness, the log of strike / underlying price.  Every implied volatility the strategy solves from
+# an option price is added to the surface of the day.  Later greeks for the same day come from the
+# surface without pricing the option again:
+#
+#   - a strike already on the surface uses its volatility
+#   - a strike between two points no more than max_interpolation_gap apart uses the linear
+#     interpolation of their volatilities
+#   - any other strike is priced and solved, and becomes a new point
+#
+# Each backtest keeps its own surfaces in memory, the least recently used evicted after max_surfaces.
+# An interpolated volatility depends on the points solved before it, so surfaces shared between the
+# backtests of a worker would make the deltas, and the strikes picked near a delta threshold, depend on
+# which configurations ran earlier in the same process.  With storage enabled the points are also
+# written to mwt_iv_surfaces.db next to the results database and read back by later runs, so repeated
+# runs over the same dates skip the solve.  Stored surfaces are shared on purpose: the results of a
+# run can then differ slightly with the runs that stored points before it.
+
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+from check_for_previous_run import results_database
+
+surface_database = os.path.join(os.path.dirname(results_database), "mwt_iv_surfaces.db")
+
+# Surfaces kept in memory by each backtest
+max_surfaces = 64
+# The widest moneyness gap interpolated, 0.01 is about $4.50 between strikes for SPY at 450
+max_interpolation_gap = 0.01
+
+class VolatilitySurface():
+
+    def __init__(self, symbol, day):
+        self.symbol = symbol
+        self.day = day
+        # (expiry, right) -> (sorted moneyness array, volatility array)
+        self.curves = {}
+
+    def add_points(self, expiry, right, moneyness, volatilities):
+        moneyness = np.asarray(moneyness, dtype=float)
+        volatilities = np.asarray(volatilities, dtype=float)
+        solved = np.isfinite(volatilities)
+        if not solved.any():
+            return
+
+        key = (str(expiry), right.lower())
+        old_moneyness, old_volatilities = self.curves.get(key, (np.empty(0), np.empty(0)))
+        all_moneyness = np.concatenate([old_moneyness, moneyness[solved]])
+        all_volatilities = np.concatenate([old_volatilities, volatilities[solved]])
+        # Keep one point per moneyness, the latest, in ascending order
+        all_moneyness, first_index = np.unique(all_moneyness[::-1], return_index=True)
+        self.curves[key] = (all_moneyness, all_volatilities[::-1][first_index])
+
+    def get_volatilities(self, expiry, right, moneyness):
+        '''
+        The volatility at each moneyness, NaN where the surface has no point close enough, and a mask
+        of the moneyness values that are points of the surface rather than interpolated
+        '''
+        moneyness = np.asarray(moneyness, dtype=float)
+        volatilities = np.full(moneyness.shape, np.nan)
+        exact = np.zeros(moneyness.shape, dtype=bool)
+        curve = self.curves.get((str(expiry), right.lower()))
+        if curve is None:
+            return volatilities, exact
+
+        curve_moneyness, curve_volatilities = curve
+        upper = np.searchsorted(curve_moneyness, moneyness)
+        for i, index in enumerate(upper):
+            if index < len(curve_moneyness) and abs(curve_moneyness[index] - moneyness[i]) < 1e-9:
+                volatilities[i] = curve_volatilities[index]
+                exact[i] = True
+            elif 0 < index < len(curve_moneyness) and curve_moneyness[index] - curve_moneyness[index - 1] <= max_interpolation_gap:
+                weight = (moneyness[i] - curve_moneyness[index - 1]) / (curve_moneyness[index] - curve_moneyness[index - 1])
+                volatilities[i] = curve_volatilities[index - 1] + weight * (curve_volatilities[index] - curve_volatilities[index - 1])
+        return volatilities, exact
+
+class VolatilitySurfaceCache():
+    '''
+    The surfaces of one backtest, optionally stored in database
+    '''
+
+    def __init__(self, database=None, max_surfaces=max_surfaces):
+        self.database = database
+        self.max_surfaces = max_surfaces
+        self.surfaces = OrderedDict()
+        # Implied volatilities read from a point of a surface, interpolated between two points, and solved
+        self.exact_count = 0
+        self.interpolated_count = 0
+        self.solved_count = 0
+
+        if self.database is not None:
+            conn = sqlite3.connect(self.database, timeout=30)
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS iv_surface_points (
+                    symbol TEXT,
+                    day TEXT,
+                    expiration_date TEXT,
+                    right TEXT,
+                    moneyness REAL,
+                    volatility REAL,
+                    PRIMARY KEY (symbol, day, expiration_date, right, moneyness)
+                )
+            ''')
+            conn.commit()
+            conn.close()
+
+    def execute(self, sql, parameters=()):
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def get_surface(self, symbol, day):
+        key = (symbol, str(day))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+
+        surface = VolatilitySurface(symbol, day)
+        if self.database is not None:
+            rows = self.execute("SELECT expiration_date, right, moneyness, volatility FROM iv_surface_points WHERE symbol = ? AND day = ?", key)
+            curves = {}
+            for expiration_date, right, moneyness, volatility in rows:
+                curves.setdefault((expiration_date, right), []).append((moneyness, volatility))
+            for (expiration_date, right), points in curves.items():
+                surface.add_points(expiration_date, right, [moneyness for moneyness, _ in points], [volatility for _, volatility in points])
+
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def add_points(self, symbol, day, expiry, right, moneyness, volatilities):
+        self.get_surface(symbol, day).add_points(expiry, right, moneyness, volatilities)
+        if self.database is not None:
+            conn = sqlite3.connect(self.database, timeout=30)
+            conn.executemany(
+                "INSERT OR REPLACE INTO iv_surface_points VALUES (?,?,?,?,?,?)",
+                [(symbol, str(day), str(expiry), right.lower(), float(point_moneyness), float(volatility))
+                 for point_moneyness, volatility in zip(moneyness, volatilities) if np.isfinite(volatility)],
+            )
+            conn.commit()
+            conn.close()
+
+    def print_summary(self):
+        total_count = self.exact_count + self.interpolated_count + self.solved_count
+        surface_percent = 100 * (self.exact_count + self.interpolated_count) / total_count if total_count else 0
+        print(f">>>>> Volatility surfaces: {self.exact_count + self.interpolated_count} of {total_count} ({surface_percent:.0f}%) implied volatilities read from the surfaces, "
+              f"{self.exact_count} surface points and {self.interpolated_count} interpolated, {self.solved_count} solved")
+
+def get_volatility_surface_cache(stored=False):
+    '''
+    A new surface cache for one backtest, backed by mwt_iv_surfaces.db when stored
+    '''
+    return VolatilitySurfaceCache(surface_database if stored else None)
@@ -0,0 +1,51 @@
+# market_snapshot
+#
+# Description: The prices and greeks the strategy reads during one trading iteration.  The clock does
+# not move inside an iteration, so the same contract always has the same price, yet the legs of the
+# open condor are priced several times: by maximum_loss_exceeded, again for the close reason and again
+# after a roll.  The snapshot asks Lumibot the first time a contract is read and answers the later
+# reads from memory.  It is cleared at the start of every iteration and counts the lookups it saved.
+# The greeks come from the strategy's get_option_greeks, see iv_surface.py.
+
+class MarketSnapshot():
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.datetime = None
+        self.prices = {}
+        self.greeks = {}
+        # Counted over the whole backtest
+        self.lookups = 0
+        self.upstream_lookups = 0
+
+    def start_iteration(self, dt):
+        self.datetime = dt
+        self.prices = {}
+        self.greeks = {}
+
+    def get_key(self, asset):
+        # The underlying is read with its symbol, options with an Asset whose right can be either case
+        if isinstance(asset, str):
+            return (asset,)
+        return (asset.symbol, asset.asset_type, str(asset.expiration), asset.strike, str(asset.right).lower())
+
+    def get_last_price(self, asset):
+        self.lookups += 1
+        key = self.get_key(asset)
+        if key not in self.prices:
+            self.upstream_lookups += 1
+            self.prices[key] = self.strategy.get_last_price(asset)
+        return self.prices[key]
+
+    def get_greeks(self, asset):
+        self.lookups += 1
+        key = self.get_key(asset)
+        if key not in self.greeks:
+            self.upstream_lookups += 1
+            self.greeks[key] = self.strategy.get_option_greeks(asset)
+        return self.greeks[key]
+
+    def print_summary(self):
+        saved_lookups = self.lookups - self.upstream_lookups
+        saved_percent = 100 * saved_lookups / self.lookups if self.lookups else 0
+        print(f">>>>> Market snapshot: {self.lookups} price and greeks lookups, {saved_lookups} ({saved_percent:.0f}%) answered from the snapshot")
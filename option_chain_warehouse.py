@@ -0,0 +1,243 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+A local warehouse of historical option data.  The ingestion pulls the daily bars of every contract
+in a (symbol, expiration, strike band) window from Polygon and writes them to Parquet files
+partitioned by symbol, expiration and date:
+
+    option_chain_warehouse/
+        manifest.db
+        symbol=SPY/expiration=2023-05-19/date=2023-04-03/bars.parquet
+        ...
+
+Each file holds one row per contract with a bar on that date.  The contracts of an expiration come
+from the option contract cache, the same listing get_option_strikes uses.  The manifest records the
+date range already ingested for every contract, so running the ingestion again only downloads what
+is missing.  A partition is rewritten with the rows of the new contracts merged in, and duplicates
+replaced, so an interrupted ingestion can simply be run again.
+
+    python option_chain_warehouse.py --symbols SPY,QQQ,IWM --start 2020-01-01 --end 2024-12-31 --strike-band 60
+    python option_chain_warehouse.py --manifest
+
+Backtests and tools read the warehouse with load_option_bars.
+
+"""
+
+import argparse
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from check_for_previous_run import results_database
+from credentials import POLYGON_CONFIG
+from option_contract_cache import OptionContractCache
+from polygon_http_client import get_json
+from sweep_scheduler import get_date, get_monthly_expiration_after_date
+
+warehouse_directory = os.path.join(os.path.dirname(results_database), "option_chain_warehouse")
+
+# Contracts are ingested from this many days before their expiration
+default_days_before_expiration = 70
+default_ingest_threads = 8
+
+bar_columns = ["ticker", "contract_type", "strike_price", "expiration_date", "date", "open", "high", "low", "close", "volume", "vwap", "transactions"]
+
+def get_partition_file(symbol, expiration_date, bar_date, directory=warehouse_directory):
+    return os.path.join(directory, f"symbol={symbol}", f"expiration={expiration_date}", f"date={bar_date}", "bars.parquet")
+
+def fetch_daily_bars(ticker, first_day, last_day):
+    '''
+    The daily bars of one ticker, an option contract or the underlying, as a list of Polygon aggregates
+    '''
+    api_key = POLYGON_CONFIG["API_KEY"]
+    url = f"https://api.polygon.io/v2/aggs/ticker/{ticker}/range/1/day/{first_day}/{last_day}?adjusted=true&sort=asc&limit=50000&apiKey={api_key}"
+    return get_json(url).get("results", [])
+
+class OptionChainWarehouse():
+
+    def __init__(self, directory=warehouse_directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest_database = os.path.join(self.directory, "manifest.db")
+
+        conn = sqlite3.connect(self.manifest_database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ingested_contracts (
+                ticker TEXT PRIMARY KEY,
+                symbol TEXT,
+                expiration_date TEXT,
+                contract_type TEXT,
+                strike_price REAL,
+                first_day TEXT,
+                last_day TEXT,
+                bar_count INTEGER,
+                ingested_at DATETIME
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS ingested_contracts_expiration ON ingested_contracts (symbol, expiration_date)")
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, parameters=()):
+        conn = sqlite3.connect(self.manifest_database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def get_ingested_ranges(self, symbol, expiration_date):
+        rows = self.execute("SELECT ticker, first_day, last_day FROM ingested_contracts WHERE symbol = ? AND expiration_date = ?", (symbol, str(expiration_date)))
+        return {ticker: (first_day, last_day) for ticker, first_day, last_day in rows}
+
+    def write_partitions(self, symbol, expiration_date, bars):
+        '''
+        Merge the bars into the date partitions of one expiration.  Rows already present for the
+        same contract and date are replaced, so writing the same bars twice changes nothing.
+        '''
+        for bar_date, day_bars in bars.groupby("date"):
+            partition_file = get_partition_file(symbol, expiration_date, bar_date, self.directory)
+            os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+            if os.path.exists(partition_file):
+                existing_bars = pd.read_parquet(partition_file)
+                day_bars = pd.concat([existing_bars[~existing_bars["ticker"].isin(day_bars["ticker"])], day_bars])
+            # Write a temporary file and rename it so a reader never sees a partial partition
+            temporary_file = f"{partition_file}.{os.getpid()}.tmp"
+            day_bars.sort_values("strike_price").to_parquet(temporary_file, index=False)
+            os.replace(temporary_file, partition_file)
+
+    def ingest_expiration(self, symbol, expiration_date, lowest_strike, highest_strike, first_day, last_day, max_threads=default_ingest_threads):
+        '''
+        Ingest the daily bars of the contracts of one expiration with strikes in the band.
+        Returns the number of contracts downloaded.
+        '''
+        contracts = OptionContractCache().get_option_contracts(symbol, expiration_date, POLYGON_CONFIG["API_KEY"])
+        ingested_ranges = self.get_ingested_ranges(symbol, expiration_date)
+
+        missing_contracts = []
+        for contract in contracts:
+            if not lowest_strike <= contract["strike_price"] <= highest_strike:
+                continue
+            ingested_range = ingested_ranges.get(contract["ticker"])
+            if ingested_range is not None and ingested_range[0] <= str(first_day) and ingested_range[1] >= str(last_day):
+                continue
+            # Download the union of the requested and ingested ranges so the manifest stays one range
+            contract_first_day, contract_last_day = str(first_day), str(last_day)
+            if ingested_range is not None:
+                contract_first_day, contract_last_day = min(contract_first_day, ingested_range[0]), max(contract_last_day, ingested_range[1])
+            missing_contracts.append((contract, contract_first_day, contract_last_day))
+
+        if len(missing_contracts) == 0:
+            return 0
+
+        bar_rows = []
+        manifest_rows = []
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            futures = {executor.submit(fetch_daily_bars, contract["ticker"], contract_first_day, contract_last_day): (contract, contract_first_day, contract_last_day)
+                       for contract, contract_first_day, contract_last_day in missing_contracts}
+            for future in as_completed(futures):
+                contract, contract_first_day, contract_last_day = futures[future]
+                try:
+                    aggregates = future.result()
+                except Exception as e:
+                    print(f"****** Unable to ingest {contract['ticker']}: {e!r}")
+                    continue
+                for aggregate in aggregates:
+                    bar_rows.append({
+                        "ticker": contract["ticker"],
+                        "contract_type": contract["contract_type"],
+                        "strike_price": contract["strike_price"],
+                        "expiration_date": str(expiration_date),
+                        "date": datetime.utcfromtimestamp(aggregate["t"] / 1000).date().isoformat(),
+                        "open": aggregate.get("o"),
+                        "high": aggregate.get("h"),
+                        "low": aggregate.get("l"),
+                        "close": aggregate.get("c"),
+                        "volume": aggregate.get("v"),
+                        "vwap": aggregate.get("vw"),
+                        "transactions": aggregate.get("n"),
+                    })
+                manifest_rows.append((contract["ticker"], symbol, str(expiration_date), contract["contract_type"], contract["strike_price"], contract_first_day, contract_last_day, len(aggregates), datetime.now()))
+
+        if bar_rows:
+            self.write_partitions(symbol, expiration_date, pd.DataFrame(bar_rows, columns=bar_columns))
+
+        # The manifest is only updated after the partitions are written
+        for manifest_row in manifest_rows:
+            self.execute("INSERT OR REPLACE INTO ingested_contracts VALUES (?,?,?,?,?,?,?,?,?)", manifest_row)
+
+        return len(manifest_rows)
+
+    def ingest_symbol(self, symbol, starting_date, ending_date, strike_band, days_before_expiration=default_days_before_expiration, max_threads=default_ingest_threads):
+        '''
+        Ingest every monthly expiration of a symbol that can be traded between starting_date and
+        ending_date, with strikes within strike_band dollars of the underlying price
+        '''
+        starting_date, ending_date = get_date(starting_date), get_date(ending_date)
+        underlying_bars = fetch_daily_bars(symbol, starting_date, ending_date + timedelta(days=days_before_expiration))
+        underlying_closes = {datetime.utcfromtimestamp(bar["t"] / 1000).date(): bar["c"] for bar in underlying_bars}
+
+        expiration_date = get_monthly_expiration_after_date(starting_date)
+        last_expiration = get_monthly_expiration_after_date(ending_date + timedelta(days=days_before_expiration))
+        while expiration_date <= last_expiration and expiration_date < date.today():
+            first_day = max(starting_date, expiration_date - timedelta(days=days_before_expiration))
+            window_closes = [close for day, close in underlying_closes.items() if first_day <= day <= expiration_date]
+            if window_closes:
+                ingested_count = self.ingest_expiration(symbol, expiration_date, min(window_closes) - strike_band, max(window_closes) + strike_band, first_day, expiration_date, max_threads)
+                print(f">>>>> {symbol} {expiration_date}: {ingested_count} contracts ingested")
+            expiration_date = get_monthly_expiration_after_date(expiration_date + timedelta(days=1))
+
+    def print_manifest(self):
+        rows = self.execute('''
+            SELECT symbol, COUNT(DISTINCT expiration_date), COUNT(*), SUM(bar_count), MIN(first_day), MAX(last_day)
+            FROM ingested_contracts GROUP BY symbol ORDER BY symbol
+        ''')
+        for symbol, expirations, contracts, bars, first_day, last_day in rows:
+            print(f">>>>> {symbol}: {expirations} expirations, {contracts} contracts, {bars} daily bars from {first_day} to {last_day}")
+
+def load_option_bars(symbol, expiration_date, first_day=None, last_day=None, directory=warehouse_directory):
+    '''
+    Read the daily bars of one expiration from the warehouse as a DataFrame with bar_columns,
+    optionally limited to the days first_day..last_day
+    '''
+    expiration_directory = os.path.join(directory, f"symbol={symbol}", f"expiration={get_date(expiration_date)}")
+    if not os.path.isdir(expiration_directory):
+        return pd.DataFrame(columns=bar_columns)
+
+    partitions = []
+    for partition in sorted(os.listdir(expiration_directory)):
+        bar_date = partition.split("=")[-1]
+        if first_day is not None and bar_date < str(get_date(first_day)):
+            continue
+        if last_day is not None and bar_date > str(get_date(last_day)):
+            continue
+        partition_file = os.path.join(expiration_directory, partition, "bars.parquet")
+        if os.path.exists(partition_file):
+            partitions.append(pd.read_parquet(partition_file))
+
+    if len(partitions) == 0:
+        return pd.DataFrame(columns=bar_columns)
+    return pd.concat(partitions, ignore_index=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest Polygon option chains into the local Parquet warehouse")
+    parser.add_argument("--symbols", default="SPY", help="comma separated underlying symbols")
+    parser.add_argument("--start", default="2020-01-01", help="first trading day to ingest")
+    parser.add_argument("--end", default=str(date.today()), help="last trading day to ingest")
+    parser.add_argument("--strike-band", type=float, default=60, help="dollars above and below the underlying price to ingest")
+    parser.add_argument("--days-before-expiration", type=int, default=default_days_before_expiration, help="ingest each contract from this many days before its expiration")
+    parser.add_argument("--threads", type=int, default=default_ingest_threads, help="number of contracts downloaded at the same time")
+    parser.add_argument("--manifest", action="store_true", help="only print what is in the warehouse")
+    args = parser.parse_args()
+
+    warehouse = OptionChainWarehouse()
+    if not args.manifest:
+        for symbol in args.symbols.split(","):
+            warehouse.ingest_symbol(symbol.strip(), args.start, args.end, args.strike_band, args.days_before_expiration, args.threads)
+    warehouse.print_manifest()
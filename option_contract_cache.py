@@ -0,0 +1,162 @@
+# option_contract_cache
+#
+# Description: A persistent cache of the Polygon option contract reference lookups made by
+# OptionsStrategyEngine.get_option_strikes.  The contracts of an expiration that has passed never
+# change, so after the first lookup every backtest, on any worker process and in any later sweep,
+# reads them from a SQLite file instead of paging through /v3/reference/options/contracts again.
+#
+# Only expirations before today are cached.  The cache is limited to max_cache_bytes and the least
+# recently used expirations are evicted first.  Hits and misses are counted in the cache file so
+# they can be read after a sweep:
+#
+#     python option_contract_cache.py
+
+import json
+import os
+import sqlite3
+import time
+from datetime import date, datetime
+
+from check_for_previous_run import results_database
+from polygon_http_client import get_json
+
+contract_cache_database = os.path.join(os.path.dirname(results_database), "mwt_option_contract_cache.db")
+
+# A monthly SPY expiration is roughly 100 KB, so this holds several thousand expirations
+max_cache_bytes = 500 * 1024 * 1024
+
+# Only the fields the strategy uses are stored
+contract_fields = ["ticker", "contract_type", "strike_price", "expiration_date"]
+
+def fetch_option_contracts(symbol, expiration_date, api_key):
+    '''
+    Read every page of the Polygon contract reference for one expiration
+    '''
+    options = []
+    options_url = f"https://api.polygon.io/v3/reference/options/contracts?underlying_ticker={symbol}&limit=500&expired=true&expiration_date={expiration_date}&apiKey={api_key}"
+    while True:
+        data = get_json(options_url)
+        options += data.get('results', [])
+        if data.get('next_url'):
+            options_cursor = data['next_url']
+            options_url = f"{options_cursor}&apiKey={api_key}"
+        else:
+            break
+
+    return [{field: option.get(field) for field in contract_fields} for option in options]
+
+class OptionContractCache():
+
+    def __init__(self, database=contract_cache_database, max_bytes=max_cache_bytes):
+        self.database = database
+        self.max_bytes = max_bytes
+
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS option_contracts (
+                symbol TEXT,
+                expiration_date TEXT,
+                contracts TEXT,
+                size_bytes INTEGER,
+                fetched_at DATETIME,
+                last_used REAL,
+                PRIMARY KEY (symbol, expiration_date)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_counters (
+                name TEXT PRIMARY KEY,
+                count INTEGER
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, parameters=()):
+        # A connection per statement so worker processes can share the cache file
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def count(self, name):
+        self.execute('''
+            INSERT INTO cache_counters (name, count) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET count = count + 1
+        ''', (name,))
+
+    def get(self, symbol, expiration_date):
+        '''
+        Return the cached contracts of one expiration, or None
+        '''
+        expiration_date = str(expiration_date)[:10]
+        rows = self.execute("SELECT contracts FROM option_contracts WHERE symbol = ? AND expiration_date = ?", (symbol, expiration_date))
+        if len(rows) == 0:
+            self.count("misses")
+            return None
+
+        self.execute("UPDATE option_contracts SET last_used = ? WHERE symbol = ? AND expiration_date = ?", (time.time(), symbol, expiration_date))
+        self.count("hits")
+        return json.loads(rows[0][0])
+
+    def put(self, symbol, expiration_date, contracts):
+        '''
+        Cache the contracts of an expiration that has passed and evict the least recently used
+        expirations if the cache is over its size limit
+        '''
+        expiration_date = str(expiration_date)[:10]
+        if expiration_date >= date.today().isoformat() or len(contracts) == 0:
+            return False
+
+        contracts_json = json.dumps(contracts)
+        self.execute('''
+            INSERT OR REPLACE INTO option_contracts (symbol, expiration_date, contracts, size_bytes, fetched_at, last_used)
+            VALUES (?,?,?,?,?,?)
+        ''', (symbol, expiration_date, contracts_json, len(contracts_json), datetime.now(), time.time()))
+        self.evict()
+        return True
+
+    def evict(self):
+        total_bytes = self.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM option_contracts")[0][0]
+        if total_bytes <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for symbol, expiration_date, size_bytes in self.execute("SELECT symbol, expiration_date, size_bytes FROM option_contracts ORDER BY last_used"):
+            if total_bytes <= self.max_bytes:
+                break
+            self.execute("DELETE FROM option_contracts WHERE symbol = ? AND expiration_date = ?", (symbol, expiration_date))
+            total_bytes -= size_bytes
+            evicted += 1
+            self.count("evictions")
+        return evicted
+
+    def get_option_contracts(self, symbol, expiration_date, api_key):
+        '''
+        The contracts of one expiration from the cache, or from Polygon on a miss
+        '''
+        contracts = self.get(symbol, expiration_date)
+        if contracts is None:
+            contracts = fetch_option_contracts(symbol, expiration_date, api_key)
+            self.put(symbol, expiration_date, contracts)
+        return contracts
+
+    def get_counters(self):
+        counters = {"hits": 0, "misses": 0, "evictions": 0}
+        counters.update(dict(self.execute("SELECT name, count FROM cache_counters")))
+        return counters
+
+    def print_summary(self):
+        counters = self.get_counters()
+        lookups = counters["hits"] + counters["misses"]
+        hit_rate = counters["hits"] / lookups if lookups > 0 else 0
+        expirations, total_bytes = self.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM option_contracts")[0]
+        print(f">>>>> Option contract cache: {counters['hits']} hits, {counters['misses']} misses ({hit_rate:.0%} hit rate), "
+              f"{counters['evictions']} evictions, {expirations} expirations using {total_bytes / (1024 * 1024):.1f} MB")
+
+if __name__ == "__main__":
+    OptionContractCache().print_summary()
@@ -74,6 +74,8 @@ from datetime import datetime, timedelta
 import datetime as dtime
 from decimal import Decimal
 import time
+import math
+import numpy as np
 import inspect
 import sys
 
@@ -81,7 +83,6 @@ import sys
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 from pprint import pformat  
-import requests
 
 from inspect import currentframe, getframeinfo
 
@@ -100,6 +101,20 @@ from lumibot.strategies.strategy import Strategy
 # IMS moved all module includes to the top of the code
 from credentials import POLYGON_CONFIG
 from lumibot.backtesting import PolygonDataBacktesting
+from option_contract_cache import OptionContractCache
+from strike_ladder import StrikeLadder, find_first_index
+from expiration_calendar import get_expiration_calendar
+from market_snapshot import MarketSnapshot
+from position_book import PositionBook, get_trade_event
+from iv_surface import get_volatility_surface_cache
+from vectorized_greeks import get_ladder_greeks, get_volatility_greeks, greeks_batch_size, greeks_parity_tolerance
+from guard_bands import get_guard_bands, is_inside_guard_bands
+from polygon_http_client import PolygonRequestError
+from sweep_scheduler import get_date
+from polygon_record_replay import install_from_environment
+
+# Record or replay the Polygon requests when the driver runs with --record-polygon or --replay-polygon
+install_from_environment()
 
 class OptionsStrategyEngine(Strategy):
 
@@ -150,33 +165,35 @@ class OptionsStrategyEngine(Strategy):
 
     strategy_name = f'mwt-{parameters["symbol"]}-{parameters["trade_strategy"]}-{parameters["starting_date"]}-{parameters["ending_date"]}'   
 
+    # The portfolio value series of the last completed backtest.  This is set in on_strategy_end
+    # so the backtest driver can read the results without parsing the Lumibot stats file.
+    backtest_portfolio_values = []
+    backtest_ended_flat = True
+    # The opens, rolls and closes of the last completed backtest, see simulator_parity.py
+    backtest_trade_events = []
+
     @classmethod
     def set_parameters(cls, parameters):
         cls.parameters = parameters
         cls.parameters_for_debug = pformat(cls.parameters).replace("\n", "<br>")  
     
     def initialize(self):
-        # The time to sleep between each trading iteration
-        self.sleeptime = "1D"  # 1 minute = 1M, 1 hour = 1H,  1 day = 1D
+        # The time to sleep between each trading iteration, set with the optional sleeptime parameter.
+        # The skip days and hold periods count trading iterations.
+        self.sleeptime = self.parameters.get("sleeptime", "1D")  # 1 minute = 1M, 1 hour = 1H,  1 day = 1D
 
-        # Initialize the wait counter
+        # Iterations since the last trade was closed, the starting hold length of the next trade
         self.hold_length = 0
 
-        # Roll counter -- used to track the number of rolls
-        self.roll_count = 0
-
-        # Used to speed up date checks
-        self.non_existing_expiry_dates = []
+        # The open trades with their legs, credit, rolls and hold length, see position_book.py
+        self.position_book = PositionBook()
 
-        # Current Condor Maximum Profit
-        self.purchase_credit = 0
+        # Used to speed up date checks when the expiration calendar is not available
+        self.non_existing_expiry_dates = set()
 
         # Saved rolled data for debugging
         self.roll_current_delta = 0
 
-        # Saved last trade size -- set in condor creation code
-        self.last_trade_size = 0
-
         # Skipped day counter after a max loss
         self.skipped_days_counter = 0
 
@@ -196,6 +213,25 @@ class OptionsStrategyEngine(Strategy):
         # Flag to indicate if the portfolio has gone negative
         self.portfolio_blew_up = False
 
+        # Portfolio value at the start of each trading iteration, see on_strategy_end
+        self.portfolio_value_history = []
+
+        # Every open, roll and close of a trade, compared with the simulator by simulator_parity.py
+        self.trade_events = []
+
+        # Polygon contract reference lookups shared by every backtest
+        self.option_contract_cache = OptionContractCache()
+
+        # Listed strikes of each expiry, see strike_ladder.py
+        self.strike_ladders = {}
+        # Prices and greeks of the current iteration
+        self.market_snapshot = MarketSnapshot(self)
+        # Implied volatility surfaces by day of this backtest, stored on disk and shared with later runs
+        # with the optional iv_surface_storage parameter
+        self.volatility_surfaces = get_volatility_surface_cache(self.parameters.get("iv_surface_storage", False))
+        # The strike chosen by find_target_delta_strike for each (symbol, expiry, right), the start of the next search
+        self.target_delta_strikes = {}
+
     def on_trading_iteration(self):
         # Used for debugging
         frameinfo = getframeinfo(currentframe())
@@ -240,19 +276,27 @@ class OptionsStrategyEngine(Strategy):
         # This value is update when a skip condition is hit
         days_to_skip = days_to_stay_out_of_market
         
+        # Prices and greeks are read once per iteration, see market_snapshot.py
+        self.market_snapshot.start_iteration(self.get_datetime())
+
         # Get the price of the underlying asset
-        underlying_price = self.get_last_price(symbol)
+        underlying_price = self.market_snapshot.get_last_price(symbol)
         rounded_underlying_price = round(underlying_price, 0)
 
         # Add lines to the indicator chart
         self.add_line(f"{symbol}_price", underlying_price)
 
-        # IMS this only works because the strategy only holds one condor at a time
+        # Count the iterations each trade has been held
         self.hold_length += 1
+        for trade in self.position_book.get_open_trades():
+            trade.hold_length += 1
 
         # Get the current datetime
         dt = self.get_datetime()
 
+        # Track the portfolio value so the driver can calculate the strategy return
+        self.portfolio_value_history.append({"datetime": dt, "portfolio_value": self.get_portfolio_value()})
+
         self.debug_print (f"************************* Iteration Date: {dt} Underlying rounded price: {rounded_underlying_price} *************************")
 
         self.historical_price.append({"price": rounded_underlying_price, "date": dt})
@@ -271,94 +315,40 @@ class OptionsStrategyEngine(Strategy):
                 self.max_move_hit_flag = False
                 days_to_skip = days_to_stay_out_of_market
 
-        # Check if we need to skip days after a max loss
+        # Check if we need to skip days after a max loss.  The open trades are still managed, no
+        # new trade is opened until the days have passed.
         self.skipped_days_counter += 1
-        if self.stay_out_of_market and self.skipped_days_counter < days_to_skip:
-            return
-        else:
+        if not (self.stay_out_of_market and self.skipped_days_counter < days_to_skip):
             # Reset the flags and days counter
             self.stay_out_of_market = False
             # Reset to general case in the event it was set to the max move value
             days_to_skip = days_to_stay_out_of_market
             self.skipped_days_counter = 0
-        
-        ##############################################################################
-        # Collect the option positions and see if we have a condor.  If we only
-        # have one position it will be the cash position.  If we have more than one
-        # position, we have a condor.  If we have a condor we need to check if we
-        # need to roll or close the condor.
-        ##############################################################################
-
-        # Get all the open positions
-        no_active_condor = False
-        positions = self.get_positions()
-        if len(positions) < 2:
-            no_active_condor = True
-
-        # This strategy keeps one condor active at a time.  If this is the first trading
-        # day or we have no condor active create one and exit.
-            
-        if (self.first_iteration or no_active_condor) and not self.portfolio_blew_up:
-            ############################################################################################
-            # Initialize values we track for each condor
-            ############################################################################################
-            self.call_vega = []
-            self.put_vega = []
 
-            ############################################################################################
-            # If the cash available is less then the spread wings we do not haev the money to trade
-            ############################################################################################
-            self.portfolio_blew_up = self.check_if_portfolio_blew_up(distance_of_wings, self.get_cash())
-            if self.portfolio_blew_up:
-                return
-
-            ############################################################################################
-            # Output the parameters of the strategy to the indicator file
-            ############################################################################################
-            self.add_marker(
-                    f"Parameters used in this model",
-                    value=underlying_price+30,
-                    color="pink",
-                    symbol="square-dot", 
-                    detail_text=self.parameters_for_debug
-                )
-            # Get next 3rd Friday expiry after the date
-            expiry = self.get_next_expiration_date(option_duration, symbol, rounded_underlying_price)
-
-            # IMS used for debugging.  Create a criteria and then put a break on the print statement
-            # break_date = dtime.date(2022, 3, 18)
-            # if expiry == break_date:
-            #     print("break")
-
-            sides = self.select_sides(trade_strategy)
-            roll = False
-            # Create the initial condor
-            condor_status, call_strike, put_strike, purchase_credit, last_trade_size, last_call_delta, last_put_delta = self.create_legs(
-                symbol, expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, sides, maximum_portfolio_allocation, self.last_trade_size, max_strikes, roll
-            )
+        # Up to max_open_trades condors, or spreads, can be open at the same time, each opened at least
+        # entry_spacing_days after the previous one.  The defaults keep one condor open at a time.
+        max_open_trades = self.parameters.get("max_open_trades", 1)
+        entry_spacing_days = self.parameters.get("entry_spacing_days", 0)
 
-            # Used when calculating and placing rolls
-            self.purchase_credit = purchase_credit
-            self.last_trade_size = last_trade_size
+        # With the optional trigger_gating parameter a trade whose underlying price is inside its guard
+        # bands is not checked, see set_guard_bands
+        trigger_gating = self.parameters.get("trigger_gating", False)
 
-            if "Success" in condor_status:
-                self.margin_reserve = self.margin_reserve + (distance_of_wings * 100 * quantity_to_trade)  # IMS need to update to reduce by credit
-                # Add marker to the chart
-                self.add_trade_marker(trade_strategy, dt, expiry, underlying_price, call_strike, put_strike, last_call_delta, last_put_delta, purchase_credit, roll)
-            else:
-                # Add marker to the chart
-                self.add_marker(
-                    f"Create Trade Failed: {condor_status}",
-                    value=underlying_price,
-                    color="blue",
-                    symbol="asterisk",
-                    detail_text=f"Date: {dt}<br>Strategy: {trade_strategy}<br>Expiration: {expiry}<br>Last price: {underlying_price}<br>call short: {call_strike}<br>put short: {put_strike}<br>credit: {purchase_credit}"
-                ) 
+        ##############################################################################
+        # Manage the open trades.  The position book keeps the legs, credit, rolls and
+        # hold length of every trade, see position_book.py.  Each trade is checked
+        # for a roll or a close on its own.
+        ##############################################################################
 
-        else:
-            #######################################################################
-            # End of first iteration or no active condor
-            #######################################################################
+        trade_closed = False
+        for trade in self.position_book.get_open_trades():
+            # A trade is checked once its orders have filled, in a backtest at the start of the next iteration
+            if trade.pending_legs:
+                continue
+            if trigger_gating and is_inside_guard_bands(trade.guard_bands, underlying_price, dt.date(), days_before_expiry_to_buy_back, self.max_move_hit_flag, self.risk_free_rate or 0, self.market_snapshot.get_last_price):
+                continue
+            # The bands are set again after the checks
+            trade.guard_bands = None
 
             roll_call_short = False
             roll_put_short = False
@@ -370,8 +360,7 @@ class OptionsStrategyEngine(Strategy):
             close_reason = "Closing, unknown reason"
 
             ###################################################################################
-            # Loop through all of the open positions
-            # This code assumes only one condor is open at a time
+            # Loop through the legs of the trade
             # Check for the following conditions:
             # 1.   Days before expiration to buy back
             # 2a.  Roll if: Delta of the option is above the delta required or
@@ -380,18 +369,18 @@ class OptionsStrategyEngine(Strategy):
             # 4.   The maximum number of rolls has been exceeded
             ###################################################################################
 
-            for position in positions:
+            for asset, quantity in trade.get_legs():
                 # Reset sell/roll indicator before exit positions
                 roll_call_short = False
                 roll_put_short = False
                 sell_the_condor = False
-                position_strike = position.asset.strike
+                position_strike = asset.strike
 
                 # If the position is an option
-                if position.asset.asset_type == "option":
+                if asset.asset_type == "option":
 
                     # Get the expiry of the option
-                    option_expiry = position.asset.expiration
+                    option_expiry = asset.expiration
 
                     # Saved for a potential roll
                     original_expiration_date = option_expiry
@@ -403,8 +392,8 @@ class OptionsStrategyEngine(Strategy):
                     if days_to_expiry <= days_before_expiry_to_buy_back:
                         # We need to buy back the option
                         sell_the_condor = True
-                        cost_to_close = self.cost_to_close_position()
-                        close_reason = f"Closing for days: credit {self.purchase_credit}, close {cost_to_close}"
+                        cost_to_close = self.cost_to_close_position(trade)
+                        close_reason = f"Closing for days: credit {trade.purchase_credit}, close {cost_to_close}"
                         break
 
                     # Base on the value of roll_strategy, determine if we need to roll on delta or on how close
@@ -415,35 +404,43 @@ class OptionsStrategyEngine(Strategy):
                     delta_message = ""
 
                     # Currently all adjustments are made on the short side of the condor
-                    if position.quantity < 0:
-                        greeks = self.get_greeks(position.asset)
-                        self.debug_print(f"Delta: {greeks['delta']}, Theta: {greeks['theta']}, Gamma: {greeks['gamma']}, Vega: {greeks['vega']}")
+                    if quantity < 0:
+                        greeks = self.market_snapshot.get_greeks(asset)
+                        # A leg without a price has no greeks, like the simulator the delta roll then waits
+                        # for an iteration with a price
+                        short_delta = None
+                        if greeks is None:
+                            if roll_strategy == "delta":
+                                print(f"****** No greeks for the {asset.right} short {asset.strike}, skipping its delta roll check")
+                        else:
+                            short_delta = greeks["delta"]
+                            self.debug_print(f"Delta: {greeks['delta']}, Theta: {greeks['theta']}, Gamma: {greeks['gamma']}, Vega: {greeks['vega']}")
 
                         # # Track the vega for the call and put options
-                        # if position.asset.right == "CALL":
+                        # if asset.right == "CALL":
                         #     self.call_vega.append(greeks["vega"])
                         #     self.add_line(f"call_vega", greeks.vega)   
-                        # elif position.asset.right == "PUT":
+                        # elif asset.right == "PUT":
                         #     self.put_vega.append(greeks["vega"])
                         #     self.add_line(f"put_vega", greeks.vega)  
 
                         # Check the delta of the option if the strategy is delta based
-                        if roll_strategy == "delta":
-                            self.roll_current_delta = greeks["delta"]
+                        if roll_strategy == "delta" and short_delta is not None:
+                            self.roll_current_delta = short_delta
 
                         # Check if the option is a call
-                        if position.asset.right == "CALL":
+                        if str(asset.right).upper() == "CALL":
 
                             if roll_strategy == "delta":
                                 # Check if the delta is above the delta required
-                                if abs(greeks["delta"]) > abs(delta_threshold):
+                                if short_delta is not None and abs(short_delta) > abs(delta_threshold):
                                     roll_call_short = True
-                                    roll_reason = f"Rolling for CALL short delta: {greeks['delta']}"
+                                    roll_reason = f"Rolling for CALL short delta: {short_delta}"
                                     break
                             
                             if roll_strategy == "short":
-                                call_short_strike_boundary = position.asset.strike - strike_roll_distance
-                                call_strike = position.asset.strike
+                                call_short_strike_boundary = asset.strike - strike_roll_distance
+                                call_strike = asset.strike
                                 if underlying_price >= call_short_strike_boundary:
                                     # If it is, we need to roll the option
                                     roll_call_short = True
@@ -451,18 +448,18 @@ class OptionsStrategyEngine(Strategy):
                                     break
 
                         # Check if the option is a put
-                        elif position.asset.right == "PUT":
+                        elif str(asset.right).upper() == "PUT":
 
                             if roll_strategy == "delta":
                                 # Check if the delta is above the delta required
-                                if abs(greeks["delta"]) > abs(delta_threshold):
+                                if short_delta is not None and abs(short_delta) > abs(delta_threshold):
                                     roll_put_short = True
-                                    roll_reason = f"Rolling for PUT short delta: {greeks['delta']}"
+                                    roll_reason = f"Rolling for PUT short delta: {short_delta}"
                                     break
                             
                             if roll_strategy == "short":
-                                put_short_strike_boundary = position.asset.strike + strike_roll_distance
-                                put_strike = position.asset.strike
+                                put_short_strike_boundary = asset.strike + strike_roll_distance
+                                put_strike = asset.strike
                                 if underlying_price <= put_short_strike_boundary:
                                     # If it is, we need to roll the option
                                     roll_put_short = True
@@ -474,13 +471,13 @@ class OptionsStrategyEngine(Strategy):
             #######################################################################
                             
             if roll_call_short or roll_put_short:
-                self.roll_count += 1
-                if self.roll_count > maximum_rolls:
+                trade.roll_count += 1
+                if trade.roll_count > maximum_rolls:
                     sell_the_condor = True
                     roll_call_short = False
                     roll_put_short = False
-                    cost_to_close = self.cost_to_close_position()
-                    close_reason = f"{roll_reason}, rolls ({self.roll_count}), credit {self.purchase_credit}, close {cost_to_close} "
+                    cost_to_close = self.cost_to_close_position(trade)
+                    close_reason = f"{roll_reason}, rolls ({trade.roll_count}), credit {trade.purchase_credit}, close {cost_to_close} "
                     if skip_on_max_rolls:
                         self.stay_out_of_market = True
                         self.skipped_days_counter = 0
@@ -491,29 +488,29 @@ class OptionsStrategyEngine(Strategy):
             ########################################################################
             if self.max_move_hit_flag:
                 # If we have a condor active sell it
-                if len(positions) > 1:
+                if trade.has_legs():
                     sell_the_condor = True
                     roll_call_short = False
                     roll_put_short = False
                     self.stay_out_of_market = True
                     self.skipped_days_counter = 0
-                    cost_to_close = self.cost_to_close_position()
-                    close_reason = f"Max move hit: credit {self.purchase_credit}, cost to close {cost_to_close}"
+                    cost_to_close = self.cost_to_close_position(trade)
+                    close_reason = f"Max move hit: credit {trade.purchase_credit}, cost to close {cost_to_close}"
 
  
             ########################################################################
             # Check for maximum loss over if do not have a max move exit condition
             ########################################################################
-            if max_loss_multiplier != 0 and self.maximum_loss_exceeded(self.purchase_credit, max_loss_multiplier):
+            if max_loss_multiplier != 0 and self.maximum_loss_exceeded(trade, max_loss_multiplier):
                 # If we have a condor active sell it
-                if len(positions) > 1:
+                if trade.has_legs():
                     sell_the_condor = True
                     roll_call_short = False
                     roll_put_short = False
                     self.stay_out_of_market = True
                     self.skipped_days_counter = 0
-                    cost_to_close = self.cost_to_close_position()
-                    close_reason = f"Maximum loss: credit {self.purchase_credit}, cost to close {cost_to_close}"
+                    cost_to_close = self.cost_to_close_position(trade)
+                    close_reason = f"Maximum loss: credit {trade.purchase_credit}, cost to close {cost_to_close}"
 
             ########################################################################
             # Now execute the close and roll conditions
@@ -527,10 +524,9 @@ class OptionsStrategyEngine(Strategy):
                 # expiration date. Another way of saying the above is the pricing of options become more volatile
                 # as we approach the expiration date.  
 
-                self.sell_all()
-
-                # Reset the roll count since we are creating a new condor with both legs
-                self.roll_count = 0
+                self.trade_events.append(get_trade_event(dt, "close", "both", trade))
+                self.close_trade(trade)
+                trade_closed = True
 
                 # Reset the minimum time to hold a condor
                 self.hold_length = 0
@@ -551,12 +547,14 @@ class OptionsStrategyEngine(Strategy):
                 # IMS Only sleep when live, this sleep function will no-opt in a backtest
                 self.sleep(5)
 
-                # Check to see if the close was due to max loss, max move and if it was just return
+                # Check to see if the close was due to max loss, max move and if it was move on to the next trade
                 # If the max loss delay is hit, the code at the start of each day will open
-                # a new condor.
-                if self.stay_out_of_market:
-                    self.purchase_credit = 0
-                    return
+                # a new condor.  The replacement keeps the entry spacing of the other open trades, when it
+                # is too close to the last entry the new trade block opens it on a later iteration.
+                if self.stay_out_of_market or not self.entries_allowed(dt):
+                    continue
+                if not self.position_book.can_open_trade(dt, max_open_trades, entry_spacing_days):
+                    continue
                 
                 # Get closest 3rd Friday expiry
                 new_expiry = self.get_next_expiration_date(option_duration, symbol, rounded_underlying_price)
@@ -565,19 +563,23 @@ class OptionsStrategyEngine(Strategy):
                 # and strike based on the original parameters.
                 sides = self.select_sides(trade_strategy)
                 roll = False
+                new_trade = self.position_book.open_trade(dt)
                 condor_status, call_strike, put_strike, purchase_credit, last_trade_size, last_call_delta, last_put_delta = self.create_legs(
-                    symbol, new_expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, sides, maximum_portfolio_allocation, self.last_trade_size, max_strikes, roll
+                    symbol, new_expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, sides, maximum_portfolio_allocation, trade.last_trade_size, max_strikes, roll, new_trade
                 )
 
                 # These values are used for calculating and placing rolls
-                self.purchase_credit = purchase_credit
-                self.last_trade_size = last_trade_size
+                new_trade.purchase_credit = purchase_credit
+                new_trade.last_trade_size = last_trade_size
+                if new_trade.is_empty():
+                    self.position_book.close_trade(new_trade)
 
                 # IMS This is just a place holder.  This need to be rethought.
                 self.margin_reserve = distance_of_wings * 100 * quantity_to_trade
 
                 if "Success" in condor_status: 
                     self.margin_reserve = distance_of_wings * 100 * quantity_to_trade  # IMS need to update to reduce by credit
+                    self.trade_events.append(get_trade_event(dt, "open", sides, new_trade))
                     # Add marker to the chart
                     self.add_trade_marker(trade_strategy, dt, new_expiry, underlying_price, call_strike, put_strike, last_call_delta, last_put_delta,     purchase_credit, roll)
                 else:
@@ -598,15 +600,15 @@ class OptionsStrategyEngine(Strategy):
             #################################################################################################
                     
             elif (roll_call_short or roll_put_short):
-                if (int(self.hold_length) < int(minimum_hold_period)) and (not self.max_move_hit_flag):
+                if (int(trade.hold_length) < int(minimum_hold_period)) and (not self.max_move_hit_flag):
                     self.add_marker(
-                        f"Short hold period was not exceeded: {self.hold_length}<{minimum_hold_period}",
+                        f"Short hold period was not exceeded: {trade.hold_length}<{minimum_hold_period}",
                         value=underlying_price,
                         color="yellow",
                         symbol="hexagon-open",
                         detail_text=f"Date: {dt}<br>Last price: {underlying_price}<br>call short: {call_strike}<br>put short: {put_strike}"
                     )
-                    return
+                    continue
                 
                 roll_message = ""
                 roll_close_status = ""
@@ -615,15 +617,15 @@ class OptionsStrategyEngine(Strategy):
                     roll_message = f"{roll_reason}, {delta_message} "
                     side = "call"
                     roll = True
-                    roll_close_status = self.close_spread(side)
+                    roll_close_status = self.close_spread(side, trade)
                 if roll_put_short:
                     roll_message = f"{roll_reason}, {delta_message} "
                     side = "put"
                     roll = True
-                    roll_close_status = self.close_spread(side)
+                    roll_close_status = self.close_spread(side, trade)
                 
                 # Reset the hold period counter
-                self.hold_length = 0
+                trade.hold_length = 0
 
                 # IMS margin requirement needs to be update to reflect the change in the credit
                 # The basic margin requirement remains the same.  The margin reserve is reduced by the cost of the roll
@@ -633,7 +635,7 @@ class OptionsStrategyEngine(Strategy):
                 # IMS This is a noop in backtest mode
                 self.sleep(5)
 
-                cost_to_close = self.cost_to_close_position(side=side)
+                cost_to_close = self.cost_to_close_position(trade, side=side)
 
                 # Add marker to the chart
                 self.add_marker(
@@ -659,13 +661,14 @@ class OptionsStrategyEngine(Strategy):
                 #     print("break")
 
                 condor_status, call_strike, put_strike, purchase_credit, last_trade_size, last_call_delta, last_put_delta = self.create_legs(
-                    symbol, roll_expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, side, maximum_portfolio_allocation, self.last_trade_size, max_strikes, roll
+                    symbol, roll_expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, side, maximum_portfolio_allocation, trade.last_trade_size, max_strikes, roll, trade
                 )
 
                 # The maximum_credit is only used when we initiate a new condor, not when we roll
 
                 if "Success" in condor_status:
                     self.margin_reserve = self.margin_reserve + (distance_of_wings * 100 * quantity_to_trade)  # IMS need to update to reduce by credit
+                    self.trade_events.append(get_trade_event(dt, "roll", side, trade))
                     # Add marker to the chart
                     self.add_trade_marker(trade_strategy, dt, roll_expiry, underlying_price, call_strike, put_strike, last_call_delta, last_put_delta, purchase_credit,roll)       
 
@@ -677,17 +680,136 @@ class OptionsStrategyEngine(Strategy):
                         color="blue",
                         symbol="asterisk",
                         detail_text=f"Date: {dt}<br>Expiration: {roll_expiry}<br>Last price: {underlying_price}<br>call short: {call_strike}<br>put short: {put_strike}"
-                    )  
-    
+                    )
+
+        if trigger_gating:
+            self.update_guard_bands(underlying_price)
+
+        ##############################################################################
+        # Open a new trade when there is room for one.  A trade closed in this iteration
+        # was already replaced above, if it could be.
+        ##############################################################################
+
+        if (
+            self.position_book.can_open_trade(dt, max_open_trades, entry_spacing_days)
+            and not trade_closed
+            and not self.stay_out_of_market
+            and not self.portfolio_blew_up
+        ):
+            # A time sliced backtest only opens trades inside its window
+            if not self.entries_allowed(dt):
+                return
+
+            ############################################################################################
+            # Initialize values we track for each condor
+            ############################################################################################
+            self.call_vega = []
+            self.put_vega = []
+
+            ############################################################################################
+            # If the cash available is less then the spread wings we do not haev the money to trade
+            ############################################################################################
+            self.portfolio_blew_up = self.check_if_portfolio_blew_up(distance_of_wings, self.get_cash())
+            if self.portfolio_blew_up:
+                return
+
+            ############################################################################################
+            # Output the parameters of the strategy to the indicator file
+            ############################################################################################
+            self.add_marker(
+                    f"Parameters used in this model",
+                    value=underlying_price+30,
+                    color="pink",
+                    symbol="square-dot", 
+                    detail_text=self.parameters_for_debug
+                )
+            # Get next 3rd Friday expiry after the date
+            expiry = self.get_next_expiration_date(option_duration, symbol, rounded_underlying_price)
+
+            # IMS used for debugging.  Create a criteria and then put a break on the print statement
+            # break_date = dtime.date(2022, 3, 18)
+            # if expiry == break_date:
+            #     print("break")
+
+            sides = self.select_sides(trade_strategy)
+            roll = False
+            # Create the initial condor.  Like the single condor counter it replaces, the hold length
+            # of a new trade starts from the iterations since the last trade was closed.
+            trade = self.position_book.open_trade(dt)
+            trade.hold_length = self.hold_length
+            condor_status, call_strike, put_strike, purchase_credit, last_trade_size, last_call_delta, last_put_delta = self.create_legs(
+                symbol, expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, sides, maximum_portfolio_allocation, trade.last_trade_size, max_strikes, roll, trade
+            )
+
+            # Used when calculating and placing rolls
+            trade.purchase_credit = purchase_credit
+            trade.last_trade_size = last_trade_size
+            if trade.is_empty():
+                self.position_book.close_trade(trade)
+            elif trigger_gating:
+                self.update_guard_bands(underlying_price)
+
+            if "Success" in condor_status:
+                self.margin_reserve = self.margin_reserve + (distance_of_wings * 100 * quantity_to_trade)  # IMS need to update to reduce by credit
+                self.trade_events.append(get_trade_event(dt, "open", sides, trade))
+                # Add marker to the chart
+                self.add_trade_marker(trade_strategy, dt, expiry, underlying_price, call_strike, put_strike, last_call_delta, last_put_delta, purchase_credit, roll)
+            else:
+                # Add marker to the chart
+                self.add_marker(
+                    f"Create Trade Failed: {condor_status}",
+                    value=underlying_price,
+                    color="blue",
+                    symbol="asterisk",
+                    detail_text=f"Date: {dt}<br>Strategy: {trade_strategy}<br>Expiration: {expiry}<br>Last price: {underlying_price}<br>call short: {call_strike}<br>put short: {put_strike}<br>credit: {purchase_credit}"
+                )
+
         return
 
+    def on_filled_order(self, position, order, price, quantity, multiplier):
+        # Opening orders add their legs to the trade, closing orders already removed theirs
+        self.position_book.fill_order(order, int(abs(float(quantity))))
+
+    def on_partially_filled_order(self, position, order, price, quantity, multiplier):
+        self.position_book.fill_order(order, int(abs(float(quantity))))
+
+    def on_canceled_order(self, order):
+        # A rejected or canceled order, for example a contract without data, must not leave a leg in the book
+        trade = self.position_book.cancel_order(order)
+        if trade is not None:
+            print(f"****** Order for {order.asset} was canceled, trade {trade.trade_id} updated")
+
+    def on_strategy_end(self):
+        # Record the final portfolio value and publish the series on the class.  The driver reads it
+        # as soon as backtest() returns instead of waiting for and parsing the stats file.
+        self.portfolio_value_history.append({"datetime": self.get_datetime(), "portfolio_value": self.get_portfolio_value()})
+        type(self).backtest_portfolio_values = self.portfolio_value_history
+        type(self).backtest_ended_flat = len(self.get_positions()) < 2
+        type(self).backtest_trade_events = self.trade_events
+        self.market_snapshot.print_summary()
+        self.volatility_surfaces.print_summary()
+        return
+
+    def entries_allowed(self, dt):
+        # The optional first_entry_date and last_entry_date parameters are set by time_sliced_backtest.py.
+        # Before first_entry_date the backtest only warms up its price history, and on or after
+        # last_entry_date it closes its last trade and stays flat.
+        today = dt.date().isoformat()
+        first_entry_date = self.parameters.get("first_entry_date")
+        last_entry_date = self.parameters.get("last_entry_date")
+        if first_entry_date is not None and today < str(first_entry_date)[:10]:
+            return False
+        if last_entry_date is not None and today >= str(last_entry_date)[:10]:
+            return False
+        return True
+
     ##############################################################################################
     # The following function creates an iron condor or a single spread when rolling an iron condor
     # The side parameters determines if we create a full condor, "both", or roll the "call"
     ##############################################################################################
 
     def create_legs(
-        self, symbol, expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, side, maximum_portfolio_allocation, last_trade_size, max_strikes, roll
+        self, symbol, expiry, strike_step_size, call_delta_required, put_delta_required, quantity_to_trade, distance_of_wings, side, maximum_portfolio_allocation, last_trade_size, max_strikes, roll, trade
     ):
 
         self.debug_print (f"************************* Creating Legs *************************")
@@ -701,7 +823,7 @@ class OptionsStrategyEngine(Strategy):
         maximum_credit = 0
         
         # Get the current price of the underlying asset
-        underlying_price = self.get_last_price(symbol)
+        underlying_price = self.market_snapshot.get_last_price(symbol)
 
         # Round the underlying price to the nearest strike step size
         rounded_underlying_price = (
@@ -762,18 +884,10 @@ class OptionsStrategyEngine(Strategy):
         call_strikes = [call_strike for call_strike in call_strikes if call_strike > underlying_price]
         # Sort the strikes in ascending order
         call_strikes.sort()
-        call_strike_deltas = self.get_strike_deltas(
-            symbol, expiry, call_strikes, "call", stop_less_than=call_delta_required
-        )
-
         # Find the call option with an appropriate delta and the expiry
-        # IMS Optimization -- start searching from the back, this should be the last entry
-        call_strike = None
-        for strike, delta in call_strike_deltas.items():
-            if delta is not None and delta <= call_delta_required:
-                call_strike = strike
-                last_call_delta = delta
-                break
+        call_strike, last_call_delta = self.find_target_delta_strike(
+            symbol, expiry, call_strikes, "call", call_delta_required
+        )
 
         # If we didn't find a call strike set an error message
         if call_strike is None and (side == "call" or side =="both"):
@@ -785,17 +899,10 @@ class OptionsStrategyEngine(Strategy):
         put_strikes = [put_strike for put_strike in put_strikes if put_strike < underlying_price]
         # Sort the strikes in descending order
         put_strikes.sort(reverse=True)
-        put_strike_deltas = self.get_strike_deltas(
-            symbol, expiry, put_strikes, "put", stop_greater_than=-put_delta_required
-        )
-
         # Find the put option with a the correct delta and the expiry
-        put_strike = None
-        for strike, delta in put_strike_deltas.items():
-            if delta is not None and delta >= -put_delta_required:
-                put_strike = strike
-                last_put_delta = delta
-                break
+        put_strike, last_put_delta = self.find_target_delta_strike(
+            symbol, expiry, put_strikes, "put", put_delta_required
+        )
 
         # If we didn't find a  put strike set an error message
         if put_strike is None and (side == "put" or side =="both"):
@@ -807,43 +914,38 @@ class OptionsStrategyEngine(Strategy):
         # Attempt to find the orders (combination of strike, and expiration)
         ###################################################################################
 
-        # Make 5 attempts to create the call side of the condor
-        # We use 5 attempts because as we move out of the money, the distance between strikes
-        # may increase from 1 to 5
-
-        # IMS only try up to the number of strikes we have in the list
-        # Change to 3 for now in the range(5) was 5
+        # The strike ladder lists the valid strikes of the expiry, so only spreads whose short and
+        # wing strikes both exist are tried.  If the short strike has no listed wing the search
+        # moves the short toward the money, at most 5 listed strikes.
+        strike_ladder = self.get_strike_ladder(symbol, expiry, api_key)
 
         call_strike_adjustment = 0
         put_sell_order, put_buy_order, call_sell_order, call_buy_order = None, None, None, None
         if side == "call" or side == "both":
-            for i in range(5):
+            for short_strike, _ in strike_ladder.get_spread_candidates("call", call_strike, distance_of_wings):
                 call_sell_order, call_buy_order = self.get_call_orders(
                     symbol,
                     expiry,
                     strike_step_size,
-                    call_strike + call_strike_adjustment,
+                    short_strike,
                     revised_quantity_to_trade,
                     distance_of_wings,
                 )
 
                 # Check if we got both orders
                 if call_sell_order is not None and call_buy_order is not None:
+                    call_strike_adjustment = short_strike - call_strike
                     break
 
-                # If we didn't get both orders, then move the call strike up
-                else:
-                    call_strike_adjustment -= strike_step_size
-
         if side=="put" or side == "both":
-            # Make 5 attempts to create the put side of the condor
-            put_strike_adjustment = -call_strike_adjustment
-            for i in range(5):
+            # If the call short moved toward the money move the put short by the same amount
+            put_start_strike = put_strike - call_strike_adjustment
+            for short_strike, _ in strike_ladder.get_spread_candidates("put", put_start_strike, distance_of_wings):
                 put_sell_order, put_buy_order = self.get_put_orders(
                     symbol,
                     expiry,
                     strike_step_size,
-                    put_strike + put_strike_adjustment,
+                    short_strike,
                     revised_quantity_to_trade,
                     distance_of_wings
                 )
@@ -852,11 +954,6 @@ class OptionsStrategyEngine(Strategy):
                 if put_sell_order is not None and put_buy_order is not None:
                     break
 
-                # If we didn't get both orders, then move the put strike down
-                else:
-                    # put_strike_adjustment += strike_step_size
-                    put_strike_adjustment += 1
-
         ############################################
         # Submit all of the orders
         ############################################
@@ -865,17 +962,21 @@ class OptionsStrategyEngine(Strategy):
             call_sell_order is not None
             and call_buy_order is not None
         ):
-            # Submit the orders
+            # Submit the orders, the legs are added to the trade when they fill, see on_filled_order
             self.submit_order(call_sell_order)
             self.submit_order(call_buy_order)
+            self.position_book.add_pending_leg(trade, call_sell_order, -revised_quantity_to_trade)
+            self.position_book.add_pending_leg(trade, call_buy_order, revised_quantity_to_trade)
 
         if (
             put_sell_order is not None
             and put_buy_order is not None
         ):
-            # Submit the orders
+            # Submit the orders, the legs are added to the trade when they fill, see on_filled_order
             self.submit_order(put_sell_order)
             self.submit_order(put_buy_order)
+            self.position_book.add_pending_leg(trade, put_sell_order, -revised_quantity_to_trade)
+            self.position_book.add_pending_leg(trade, put_buy_order, revised_quantity_to_trade)
 
         ############################################
         # Calculate the maximum credit of the condor
@@ -886,16 +987,16 @@ class OptionsStrategyEngine(Strategy):
         # We cannot use the get_current_credit method since the order is not live yet
         if (call_sell_order):
             self.debug_print (f"get_last_price {call_sell_order.asset.strike}")
-            call_sell_price = self.get_last_price(call_sell_order.asset)
+            call_sell_price = self.market_snapshot.get_last_price(call_sell_order.asset)
         if (call_buy_order):
             self.debug_print (f"get_last_price {call_buy_order.asset.strike}")
-            call_buy_price = self.get_last_price(call_buy_order.asset)
+            call_buy_price = self.market_snapshot.get_last_price(call_buy_order.asset)
         if (put_sell_order):
             self.debug_print (f"get_last_price {put_sell_order.asset.strike}")
-            put_sell_price = self.get_last_price(put_sell_order.asset)
+            put_sell_price = self.market_snapshot.get_last_price(put_sell_order.asset)
         if (put_buy_order):
             self.debug_print (f"get_last_price {put_buy_order.asset.strike}")
-            put_buy_price = self.get_last_price(put_buy_order.asset)
+            put_buy_price = self.market_snapshot.get_last_price(put_buy_order.asset)
         maximum_credit = round(call_sell_price - call_buy_price + put_sell_price - put_buy_price,2)
 
       
@@ -1025,7 +1126,7 @@ class OptionsStrategyEngine(Strategy):
         )
 
         # Get the price of the put option
-        put_sell_price = self.get_last_price(put_sell_asset)
+        put_sell_price = self.market_snapshot.get_last_price(put_sell_asset)
 
         # Create the order
         put_sell_order = self.create_order(put_sell_asset, quantity_to_trade, "sell")
@@ -1041,7 +1142,7 @@ class OptionsStrategyEngine(Strategy):
 
         # Get the price of the put option
         self.debug_print (f"get_last_price {put_buy_asset.strike}")
-        put_buy_price = self.get_last_price(put_buy_asset)
+        put_buy_price = self.market_snapshot.get_last_price(put_buy_asset)
 
         # Create the order
         put_buy_order = self.create_order(put_buy_asset, quantity_to_trade, "buy")
@@ -1065,7 +1166,7 @@ class OptionsStrategyEngine(Strategy):
 
         # Get the price of the call option
         self.debug_print (f"get_last_price {call_sell_asset.strike}")
-        call_sell_price = self.get_last_price(call_sell_asset)
+        call_sell_price = self.market_snapshot.get_last_price(call_sell_asset)
 
         if quantity_to_trade <= 0:
             print(f"invalid quality to trade: {quantity_to_trade}\n")
@@ -1082,7 +1183,7 @@ class OptionsStrategyEngine(Strategy):
         )
 
         # Get the price of the call option
-        call_buy_price = self.get_last_price(call_buy_asset)
+        call_buy_price = self.market_snapshot.get_last_price(call_buy_asset)
         self.debug_print (f"call buy price is {call_buy_price}, strike {call_strike + distance_of_wings}, expiration {expiry}")
 
         # Create the order
@@ -1093,6 +1194,94 @@ class OptionsStrategyEngine(Strategy):
 
         return call_sell_order, call_buy_order
 
+    def find_target_delta_strike(self, symbol, expiry, strikes, right, delta_required):
+        # Return the first strike, moving away from the money, whose delta has fallen to
+        # delta_required, and its delta, or None, None.  Calls are ordered up and puts down.
+        #
+        # Delta falls steadily as the strike moves out of the money, so the strike is found with a
+        # bisection over the strikes, see find_first_index in strike_ladder.py.  The search starts from
+        # the strike chosen the last time for the same expiry, which is usually close.  If a strike
+        # has no price the strikes are searched one by one, like the original loop, which can also be
+        # selected with the delta_search parameter set to "linear".
+        if right == "call":
+            is_reached = lambda delta: delta <= delta_required
+        else:
+            is_reached = lambda delta: delta >= -delta_required
+
+        if self.parameters.get("delta_search", "bisection") == "bisection":
+            previous_strike = self.target_delta_strikes.get((symbol, str(expiry), right))
+            start_index = strikes.index(previous_strike) if previous_strike in strikes else None
+
+            deltas = {}
+            def is_index_reached(index):
+                deltas[index] = self.get_deltas(symbol, expiry, [strikes[index]], right)[0]
+                return None if deltas[index] is None else is_reached(deltas[index])
+
+            index = find_first_index(len(strikes), is_index_reached, start_index)
+            self.debug_print(f"find_target_delta_strike: {right} delta of {len(deltas)} of {len(strikes)} strikes evaluated")
+            if index is not None:
+                if index == len(strikes):
+                    return None, None
+                self.target_delta_strikes[(symbol, str(expiry), right)] = strikes[index]
+                return strikes[index], deltas[index]
+
+        if right == "call":
+            strike_deltas = self.get_strike_deltas(symbol, expiry, strikes, right, stop_less_than=delta_required)
+        else:
+            strike_deltas = self.get_strike_deltas(symbol, expiry, strikes, right, stop_greater_than=-delta_required)
+
+        for strike, delta in strike_deltas.items():
+            if delta is not None and is_reached(delta):
+                self.target_delta_strikes[(symbol, str(expiry), right)] = strike
+                return strike, delta
+        return None, None
+
+    def get_deltas(self, symbol, expiry, strikes, right):
+        # The deltas of the strikes of one expiry, None for a strike without a price
+        greeks = self.get_strike_greeks(symbol, expiry, strikes, right)
+        if greeks is None:
+            return [None] * len(strikes)
+        # IMS The calling code will check for None and skip these strikes
+        return [None if math.isnan(delta) else float(delta) for delta in greeks["delta"]]
+
+    def get_strike_greeks(self, symbol, expiry, strikes, right):
+        # The greeks of the strikes of one expiry as arrays, None without an underlying price.  The
+        # implied volatilities come from the volatility surface of the day when it has them, the other
+        # strikes are priced and solved and added to the surface, see iv_surface.py.
+        underlying_price = self.market_snapshot.get_last_price(symbol)
+        if underlying_price is None:
+            return None
+
+        day = self.get_datetime().date()
+        days_to_expiration = (expiry - day).days
+        risk_free_rate = self.risk_free_rate or 0
+        right = right.lower()
+        moneyness = np.log(np.asarray(strikes, dtype=float) / underlying_price)
+
+        volatilities, exact = self.volatility_surfaces.get_surface(symbol, day).get_volatilities(expiry, right, moneyness)
+        missing = np.isnan(volatilities)
+        self.volatility_surfaces.exact_count += int(exact.sum())
+        self.volatility_surfaces.interpolated_count += int((~missing & ~exact).sum())
+        if missing.any():
+            missing_strikes = [strike for strike, is_missing in zip(strikes, missing) if is_missing]
+            option_prices = [
+                self.market_snapshot.get_last_price(Asset(symbol, asset_type="option", expiration=expiry, strike=strike, right=right))
+                for strike in missing_strikes
+            ]
+            solved_greeks = get_ladder_greeks(underlying_price, missing_strikes, option_prices, days_to_expiration, risk_free_rate, right)
+            volatilities[missing] = solved_greeks["implied_volatility"]
+            self.volatility_surfaces.solved_count += len(missing_strikes)
+            self.volatility_surfaces.add_points(symbol, day, expiry, right, moneyness[missing], solved_greeks["implied_volatility"])
+
+        return get_volatility_greeks(underlying_price, strikes, days_to_expiration, risk_free_rate, volatilities, right)
+
+    def get_option_greeks(self, asset):
+        # The greeks of one option like Lumibot's get_greeks, read from the volatility surface of the day
+        greeks = self.get_strike_greeks(asset.symbol, asset.expiration, [asset.strike], asset.right)
+        if greeks is None or math.isnan(greeks["delta"][0]):
+            return None
+        return {name: float(values[0]) for name, values in greeks.items()}
+
     def get_strike_deltas(
         self,
         symbol,
@@ -1102,87 +1291,53 @@ class OptionsStrategyEngine(Strategy):
         stop_greater_than=None,
         stop_less_than=None,
     ):
-        # Get the greeks for each strike
+        # The deltas are computed with NumPy for greeks_batch_size strikes at a time instead of one
+        # get_greeks call per strike, see vectorized_greeks.py.  Strikes are priced a batch at a time
+        # so the search still stops soon after the delta passes the stop value.
         strike_deltas = {}
-        for strike in strikes:
-            # Create the asset
-            asset = Asset(
-                symbol,
-                asset_type="option",
-                expiration=expiry,
-                strike=strike,
-                right=right,
-            )
-
-            # Use the price to verify the strike is valid
-            # IMS we may be able to drop this now that we use polygon to retrieve the strikes
-            # IMS Potential optimization
-            # valid_strike = self.get_last_price(asset)
-            valid_strike = 1
-
-            if valid_strike is not None and valid_strike > 0:
-                # Get the greeks for the asset if it is a valid strike
-                # Invalid strikes will have a price of zero
-                # Invoking get_geeks with an invalid strike will generate an error
-                greeks = self.get_greeks(asset)
-
-                if greeks is not None:
-                    strike_deltas[strike] = greeks["delta"]
-                    if (
-                        stop_greater_than
-                        and greeks["delta"]
-                        and greeks["delta"] >= stop_greater_than
-                    ):
-                        break
+        for batch_start in range(0, len(strikes), greeks_batch_size):
+            batch_strikes = strikes[batch_start:batch_start + greeks_batch_size]
+            batch_deltas = self.get_deltas(symbol, expiry, batch_strikes, right)
+
+            for strike, delta in zip(batch_strikes, batch_deltas):
+                strike_deltas[strike] = delta
+                if (
+                    (stop_greater_than and delta and delta >= stop_greater_than)
+                    or (stop_less_than and delta and delta <= stop_less_than)
+                ):
+                    if self.parameters.get("greeks_parity_check", False):
+                        self.check_greeks_parity(symbol, expiry, right, strike_deltas)
+                    return strike_deltas
+
+        if self.parameters.get("greeks_parity_check", False):
+            self.check_greeks_parity(symbol, expiry, right, strike_deltas)
+        return strike_deltas
 
-                    if (
-                        stop_less_than
-                        and greeks["delta"] 
-                        and greeks["delta"] <= stop_less_than
-                    ):
-                        break
-                else: 
-                    # IMS The calling code will check for None and skip these strikes
-                    strike_deltas[strike] = None
-            else:   
-                strike_deltas[strike] = None
+    def check_greeks_parity(self, symbol, expiry, right, strike_deltas):
+        # Compare the vectorized deltas with Lumibot's scalar get_greeks, enabled with the
+        # greeks_parity_check parameter.  Slow, only for checking the vectorized model.
+        for strike, delta in strike_deltas.items():
+            asset = Asset(symbol, asset_type="option", expiration=expiry, strike=strike, right=right)
+            greeks = self.get_greeks(asset)
+            scalar_delta = None if greeks is None else greeks["delta"]
+            if delta is None or scalar_delta is None:
+                if delta != scalar_delta:
+                    print(f"****** Greeks parity {asset}: vectorized delta {delta}, get_greeks delta {scalar_delta}")
+            elif abs(delta - scalar_delta) > greeks_parity_tolerance:
+                print(f"****** Greeks parity {asset}: vectorized delta {delta:.4f}, get_greeks delta {scalar_delta:.4f}")
 
-        return strike_deltas
-    
     # IMS The code to close a side does not do any retries.  This will be a problem in live trading.
-    # This code assumes we only have one condor open at a time.  It loops through and closes
-    # all the options.  This is not a good assumption for a more sophisticated strategy.
 
-    def cost_to_close_position(self, side="both"):
+    def cost_to_close_position(self, trade, side="both"):
+        # The cost to close the legs of one trade, or of one side of it, from the position book
         cost_to_close = 0
-        positions = self.get_positions()
-        # Loop through and close all of the puts
-        for position in positions:
-            # If the position is an option
-            if position.asset.asset_type == "option":
-                if side == "both":
-                    self.debug_print (f"Cost to close position both: {position.asset.strike}")
-                    last_price = self.get_asset_price(position.asset.symbol,position.asset.expiration,position.asset.strike, position.asset.right)
-                    if position.quantity >= 0:
-                        cost_to_close += -last_price
-                    else:
-                        cost_to_close += last_price
-
-                if side == "put" and position.asset.right == "put":
-                    self.debug_print (f"Cost to close position put: {position.asset.strike}")
-                    last_price = self.get_asset_price(position.asset.symbol,position.asset.expiration,position.asset.strike, position.asset.right)
-                    if position.quantity >= 0:
-                        cost_to_close += -last_price
-                    else:
-                        cost_to_close += last_price
-
-                if side == "call" and position.asset.right == "call":
-                    self.debug_print (f"Cost to close position call: {position.asset.strike}")
-                    last_price = self.get_asset_price(position.asset.symbol,position.asset.expiration,position.asset.strike, position.asset.right)
-                    if position.quantity >= 0:
-                        cost_to_close += -last_price
-                    else:
-                        cost_to_close += last_price
+        for asset, quantity in trade.get_legs(None if side == "both" else side):
+            self.debug_print (f"Cost to close position {side}: {asset.strike}")
+            last_price = self.get_asset_price(asset.symbol, asset.expiration, asset.strike, asset.right)
+            if quantity >= 0:
+                cost_to_close += -last_price
+            else:
+                cost_to_close += last_price
 
         return round(cost_to_close,2)
     
@@ -1194,48 +1349,47 @@ class OptionsStrategyEngine(Strategy):
             strike=strike,
             right=right,
         )
-        return self.get_last_price(asset)
-
-    def close_spread(self, right):
-        # Make sure the right is in upper case because the asset.right is upper case
-        right = right.upper()
-        # Get all the open positions
-        positions = self.get_positions()
-
-        close_status = "no side to close"
-
-        # Loop through and close all of the calls
-        for position in positions:
-            # If the position is an option
-            if position.asset.asset_type == "option":
-                if position.asset.right == right:
-                    # call_sell_order = self.get_selling_order(position)
-                    asset = Asset(
-                        position.asset.symbol,
-                        asset_type="option",
-                        expiration=position.asset.expiration,
-                        strike=position.asset.strike,
-                        right=position.asset.right,
-                    )
-                     # If this is a short we buy to close if it is long we sell to close                   
-                    if position.quantity < 0:
-                        action = "buy"
-                    else:
-                        action = "sell"
+        return self.market_snapshot.get_last_price(asset)
 
-                    call_close_order = self.create_order(asset, abs(position.quantity), action)
+    def close_spread(self, right, trade):
+        # Close the legs of one side of the trade and remove them from the position book
+        for leg_asset, quantity in self.position_book.remove_legs(trade, right):
+            asset = Asset(
+                leg_asset.symbol,
+                asset_type="option",
+                expiration=leg_asset.expiration,
+                strike=leg_asset.strike,
+                right=leg_asset.right,
+            )
+            # If this is a short we buy to close if it is long we sell to close
+            if quantity < 0:
+                action = "buy"
+            else:
+                action = "sell"
 
-                    self.submit_order(call_close_order)
-                        
-        return 
+            close_order = self.create_order(asset, abs(quantity), action)
+            self.submit_order(close_order)
+            # If the close is canceled the leg goes back to the trade, see on_canceled_order
+            self.position_book.add_closing_order(trade, close_order, quantity)
 
-    # IMS This code assumes we only have one condor open at a time.  It loops through and calculates
-    # the current credit of the condor.  This is not a good assumption for a more sophisticated strategy.
-    
-    def maximum_loss_exceeded(self, purchase_credit, max_loss_multiplier):
+        return
 
-        cost_to_close = self.cost_to_close_position()
-        max_loss_allowed = purchase_credit * max_loss_multiplier
+    def close_trade(self, trade):
+        # With a single trade open every position is one of its legs, sell_all closes them and also
+        # cancels any open orders as the strategy always did
+        if len(self.position_book) == 1:
+            self.sell_all()
+            self.position_book.close_trade(trade)
+            return
+
+        for right in ["call", "put"]:
+            self.close_spread(right, trade)
+        self.position_book.close_trade(trade)
+
+    def maximum_loss_exceeded(self, trade, max_loss_multiplier):
+
+        cost_to_close = self.cost_to_close_position(trade)
+        max_loss_allowed = trade.purchase_credit * max_loss_multiplier
     
         if cost_to_close > max_loss_allowed:
             return True
@@ -1243,6 +1397,21 @@ class OptionsStrategyEngine(Strategy):
             return False
     
     
+    def update_guard_bands(self, underlying_price):
+        for trade in self.position_book.get_open_trades():
+            if trade.guard_bands is None and trade.has_legs() and not trade.pending_legs:
+                self.set_guard_bands(trade, underlying_price)
+
+    def set_guard_bands(self, trade, underlying_price):
+        # Set after every entry, roll or full check when trigger_gating is on, see guard_bands.py.
+        # Without a volatility for a leg the bands stay unset and the trade is checked every iteration.
+        cost_to_close = self.cost_to_close_position(trade) if self.parameters["max_loss_multiplier"] != 0 else 0
+        trade.guard_bands = get_guard_bands(trade, underlying_price, self.get_datetime().date(), self.parameters, self.risk_free_rate or 0, self.get_leg_volatility, cost_to_close)
+
+    def get_leg_volatility(self, asset):
+        greeks = self.market_snapshot.get_greeks(asset)
+        return None if greeks is None else greeks["implied_volatility"]
+
     def search_next_market_date( self, expiry, symbol, rounded_underlying_price):
 
         # Check if there is an option with this expiry (in case it's a holiday or weekend)
@@ -1269,14 +1438,14 @@ class OptionsStrategyEngine(Strategy):
 
             # Get the price of the option
             self.debug_print (f"search_next_market_date: expiry {expiry}, price {rounded_underlying_price}")
-            price = self.get_last_price(symbol)
+            price = self.market_snapshot.get_last_price(symbol)
 
             # If we got the price, then break because this expiry is valid
             if price is not None:
                 break
 
             # Add the expiry to the list of non existing expiry dates
-            self.non_existing_expiry_dates.append(expiry)
+            self.non_existing_expiry_dates.add(expiry)
 
             # If we didn't get the price, then move the expiry forward by one day and try again
             expiry += timedelta(days=1)
@@ -1291,37 +1460,42 @@ class OptionsStrategyEngine(Strategy):
     def get_next_expiration_date(self, option_duration, symbol, strike_price):
         dt = self.get_datetime()
         suggested_date = self.get_option_expiration_after_date(dt + timedelta(days=option_duration))
-        return self.search_next_market_date(suggested_date, symbol, strike_price)
-    
-    def get_option_strikes(self, symbol, expiration_date, maximum_strikes, current_price, api_key):
-        options = []
-        options_url = f"https://api.polygon.io/v3/reference/options/contracts?underlying_ticker={symbol}&limit=500&expired=true&expiration_date={expiration_date}&apiKey={api_key}"
-        while True:
-            response = requests.get(options_url)
-            data = response.json()
-            options += data['results']
-            if data.get('next_url'):
-                options_cursor = data['next_url']
-                options_url = f"{options_cursor}&apiKey={api_key}"
-            else:
-                break
 
-        # Separate the options into puts and calls just in case the strikes are not the same for both
-        put_strikes = [option['strike_price'] for option in options if option['contract_type'] == 'put']
-        call_strikes = [option['strike_price'] for option in options if option['contract_type'] == 'call']
+        # Look up the first listed expiry in the expiration calendar of the symbol, built once from
+        # the Polygon contract reference for the whole backtest, see expiration_calendar.py
+        try:
+            expiration_calendar = get_expiration_calendar(
+                symbol,
+                self.parameters["starting_date"],
+                get_date(self.parameters["ending_date"]) + timedelta(days=option_duration + 45),
+                POLYGON_CONFIG["API_KEY"],
+            )
+        except PolygonRequestError as e:
+            print(f"****** Unable to load the {symbol} expiration calendar, searching day by day: {e}")
+            return self.search_next_market_date(suggested_date, symbol, strike_price)
 
-        # Sort the strikes so we can find the middle X strikes
-        call_strikes.sort()
+        expiry = expiration_calendar.get_first_expiration_on_or_after(suggested_date)
 
-        # Find the index of the current_price in the put_strikes and call_strikes
-        put_index = min(range(len(put_strikes)), key=lambda i: abs(put_strikes[i]-current_price))
-        call_index = min(range(len(call_strikes)), key=lambda i: abs(call_strikes[i]-current_price))
+        # Same limit as the day by day search, if nothing is listed within 5 days use the suggested date
+        if expiry is None or expiry > get_date(suggested_date) + timedelta(days=5):
+            return suggested_date
+        return expiry
+    
+    def get_strike_ladder(self, symbol, expiration_date, api_key):
+        # One ladder per expiry for the whole backtest, the listed strikes of an expiry do not change
+        ladder_key = (symbol, str(expiration_date))
+        if ladder_key not in self.strike_ladders:
+            # The contracts of past expirations come from the persistent cache, see option_contract_cache.py
+            options = self.option_contract_cache.get_option_contracts(symbol, expiration_date, api_key)
+            self.strike_ladders[ladder_key] = StrikeLadder.from_contracts(symbol, expiration_date, options)
+        return self.strike_ladders[ladder_key]
 
-        middle_strike = maximum_strikes // 2
+    def get_option_strikes(self, symbol, expiration_date, maximum_strikes, current_price, api_key):
+        strike_ladder = self.get_strike_ladder(symbol, expiration_date, api_key)
 
-        # Only return maximum_strikes number of put_strikes and call_strikes
-        put_strikes = put_strikes[max(0, put_index-middle_strike):put_index+middle_strike]
-        call_strikes = call_strikes[max(0, call_index-middle_strike):call_index+middle_strike]  
+        # Only return maximum_strikes number of put_strikes and call_strikes around the current price
+        put_strikes = strike_ladder.get_strike_window("put", current_price, maximum_strikes)
+        call_strikes = strike_ladder.get_strike_window("call", current_price, maximum_strikes)
 
         return put_strikes, call_strikes
             
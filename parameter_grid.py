@@ -0,0 +1,81 @@
+# parameter_grid
+#
+# Description: A strategy configuration file can declare a [parameter_grid] table.  Each key in the
+# table holds a list of values or a range written as an inline table.  The configuration is expanded
+# into one set of concrete parameters for every combination of the grid values.
+#
+#     [parameter_grid]
+#     call_delta_required = [0.12, 0.16, 0.20]
+#     distance_of_wings = { start = 5, stop = 20, step = 5 }   # 5, 10, 15, 20
+#
+# The expanded parameters do not include the parameter_grid table, so each combination has the same
+# parameter hash as a hand written TOML file with the same values.
+
+import itertools
+from decimal import Decimal
+
+def get_grid_values(key, grid_value):
+    '''
+    Convert a list or a {start, stop, step} range into the list of values for one key
+    '''
+    if isinstance(grid_value, list):
+        return grid_value
+
+    if isinstance(grid_value, dict):
+        start = grid_value["start"]
+        stop = grid_value["stop"]
+        step = grid_value["step"]
+        if step <= 0:
+            raise ValueError(f"parameter_grid {key}: step must be greater than zero")
+
+        # Round to the precision of the range so 0.1 + 0.05 * 2 is 0.2 and matches a hand written value
+        decimals = None
+        if not all(isinstance(value, int) for value in (start, stop, step)):
+            # Decimal reads the digits of 1e-05 as well as of 0.25
+            decimals = max(max(0, -Decimal(str(value)).as_tuple().exponent) for value in (start, stop, step))
+
+        values = []
+        count = 0
+        value = start
+        while value <= stop + step * 1e-9:
+            values.append(value if decimals is None else round(value, decimals))
+            count += 1
+            value = start + step * count
+        return values
+
+    # A single value is treated as a grid with one entry
+    return [grid_value]
+
+def expand_parameter_grid(strategy_parameters):
+    '''
+    Return a list of concrete parameter sets, one for each combination in the parameter_grid
+    table.  A configuration without a parameter_grid is returned as a list with one entry.
+    '''
+    if "parameter_grid" not in strategy_parameters:
+        return [strategy_parameters]
+
+    base_parameters = {key: value for key, value in strategy_parameters.items() if key != "parameter_grid"}
+    grid = strategy_parameters["parameter_grid"]
+
+    keys = list(grid.keys())
+    values = [get_grid_values(key, grid[key]) for key in keys]
+
+    expanded_parameters = []
+    for combination in itertools.product(*values):
+        parameters = dict(base_parameters)
+        parameters.update(zip(keys, combination))
+        expanded_parameters.append(parameters)
+
+    return expanded_parameters
+
+if __name__ == "__main__":
+    test_parameters = {
+        "symbol": "SPY",
+        "call_delta_required": 0.16,
+        "parameter_grid": {
+            "call_delta_required": {"start": 0.1, "stop": 0.3, "step": 0.05},
+            "distance_of_wings": [5, 10],
+        },
+    }
+    for parameters in expand_parameter_grid(test_parameters):
+        print(parameters)
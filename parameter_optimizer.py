@@ -0,0 +1,295 @@
+# parameter_optimizer
+#
+# Description: Adaptive search of the OptionsStrategyEngine parameters with a Tree-structured Parzen
+# Estimator (TPE).  Instead of a grid, the configuration declares the bounds of the parameters to
+# search and an objective.  Every result already in mwt_benchmark_returns with the same fixed
+# parameters, including those kept in the other_parameters JSON, is used as an observation.  The
+# searched parameters must have a column of their own.  The observations are split into the best gamma fraction and
+# the rest, a kernel density is fitted to each group, and the next batch of configurations is drawn
+# where the ratio of the good density to the bad density is highest.  The batch is run in parallel,
+# the results are read back from the database and the search repeats until the budget is used.
+#
+#     symbol = "SPY"
+#     ...
+#
+#     [optimizer]
+#     objective = "return_over_drawdown"     # or "return_vs_benchmark", "strategy_return"
+#     max_backtests = 60                     # stop after this many new backtests
+#     max_hours = 24                         # or after this much wall clock time
+#     batch_size = 4                         # configurations proposed per round, usually --workers
+#
+#     [optimizer.parameter_bounds]
+#     call_delta_required = { low = 0.08, high = 0.30 }
+#     distance_of_wings = { low = 5, high = 25, step = 5 }
+#     roll_strategy = { choices = ["short", "delta", "none"] }
+
+import json
+import math
+import random
+import sqlite3
+import time
+
+from check_for_previous_run import default_backtest_engine, get_backtest_engine, get_parameter_hash, results_database
+from create_strategy_database import add_missing_columns, get_column_names
+from successive_halving import get_return_over_drawdown
+
+optimizer_objectives = ["return_vs_benchmark", "return_over_drawdown", "strategy_return"]
+
+# Fraction of the observations treated as good, and the number of random configurations tried
+# before the density estimates are used
+gamma = 0.25
+startup_backtests = 10
+candidates_per_proposal = 32
+
+def get_objective(row, objective):
+    '''
+    The objective of one result row, larger is better.  Returns None if the row cannot be scored.
+    '''
+    strategy_return = row.get("strategy_return")
+    if strategy_return is None:
+        return None
+    if objective == "strategy_return":
+        return strategy_return
+    if objective == "return_vs_benchmark":
+        if row.get("benchmark_return") is None:
+            return None
+        return strategy_return - row["benchmark_return"]
+    if row.get("max_drawdown") is None:
+        return None
+    return get_return_over_drawdown(strategy_return, row["max_drawdown"])
+
+def values_match(value, row_value):
+    '''
+    Compare a configuration value with the value stored in the database
+    '''
+    if isinstance(value, bool):
+        # SQLite stores booleans as 0 and 1
+        return row_value is not None and bool(row_value) == value
+    if isinstance(value, float) or isinstance(row_value, float):
+        try:
+            return math.isclose(float(value), float(row_value), rel_tol=1e-9)
+        except (TypeError, ValueError):
+            return False
+    if isinstance(value, (dict, list)):
+        # Tables and arrays of other_parameters come back from JSON with sorted keys
+        return json.dumps(value, sort_keys=True, default=str) == json.dumps(row_value, sort_keys=True, default=str)
+    if hasattr(value, "year"):
+        # Dates are stored as text, sometimes with a time
+        return str(value)[:10] == str(row_value)[:10]
+    return str(value) == str(row_value)
+
+def get_result_columns():
+    conn = sqlite3.connect(results_database)  # Connect to the database
+    cursor = conn.cursor()
+    add_missing_columns(cursor)
+    conn.commit()
+    column_names = get_column_names(cursor)
+    conn.close()
+    return column_names
+
+def check_parameter_bounds(parameter_bounds):
+    '''
+    Every searched parameter must be a column of mwt_benchmark_returns, its values are read back from it
+    '''
+    column_names = get_result_columns()
+    missing_columns = sorted(key for key in parameter_bounds if key not in column_names)
+    if missing_columns:
+        raise ValueError(f"The optimizer cannot search {missing_columns}, only parameters with a column in mwt_benchmark_returns can be searched")
+
+def load_observations(base_parameters, parameter_bounds, objective):
+    '''
+    Return [(parameters, objective value)] for every result in the database that has the same fixed
+    parameters and backtest engine as base_parameters.  The parameters without a column are compared
+    with the other_parameters JSON, a row must have the same ones.
+    '''
+    conn = sqlite3.connect(results_database)  # Connect to the database
+    cursor = conn.cursor()
+    add_missing_columns(cursor)
+    conn.commit()
+
+    cursor.execute("SELECT * FROM mwt_benchmark_returns")
+    column_names = [column[0] for column in cursor.description]
+    rows = [dict(zip(column_names, values)) for values in cursor.fetchall()]
+    conn.close()
+
+    fixed_keys = [key for key in base_parameters if key in column_names and key not in parameter_bounds and key != "backtest_engine"]
+    other_parameters = {key: value for key, value in base_parameters.items() if key not in column_names}
+    backtest_engine = get_backtest_engine(base_parameters)
+
+    observations = []
+    for row in rows:
+        if (row["backtest_engine"] or default_backtest_engine) != backtest_engine:
+            continue
+        if not all(values_match(base_parameters[key], row[key]) for key in fixed_keys):
+            continue
+        # Rows written before other_parameters only match a configuration without such parameters
+        row_other_parameters = json.loads(row["other_parameters"]) if row["other_parameters"] else {}
+        if row_other_parameters.keys() != other_parameters.keys():
+            continue
+        if not all(values_match(value, row_other_parameters[key]) for key, value in other_parameters.items()):
+            continue
+        if any(row.get(key) is None for key in parameter_bounds):
+            continue
+        objective_value = get_objective(row, objective)
+        if objective_value is None:
+            continue
+        observations.append(({key: row[key] for key in parameter_bounds}, objective_value))
+
+    return observations
+
+def snap_value(bounds, value):
+    '''
+    Clip a numeric value to its bounds and round it to the step, integers when the bounds are integers
+    '''
+    value = min(max(value, bounds["low"]), bounds["high"])
+    if "step" in bounds:
+        value = bounds["low"] + round((value - bounds["low"]) / bounds["step"]) * bounds["step"]
+        value = min(value, bounds["high"])
+    if all(isinstance(bounds[key], int) for key in bounds if key in ("low", "high", "step")):
+        return int(round(value))
+    return round(value, 6)
+
+def sample_uniform(bounds, rng):
+    if "choices" in bounds:
+        return rng.choice(bounds["choices"])
+    return snap_value(bounds, rng.uniform(bounds["low"], bounds["high"]))
+
+class ParzenEstimator():
+    '''
+    One dimensional density of a parameter: Gaussian kernels around the observed values, in the
+    [0, 1] scaled range, mixed with a uniform prior.  Categorical parameters use smoothed counts.
+    '''
+
+    def __init__(self, bounds, values):
+        self.bounds = bounds
+        if "choices" in bounds:
+            self.weights = {choice: 1.0 for choice in bounds["choices"]}
+            for value in values:
+                if value in self.weights:
+                    self.weights[value] += 1.0
+            self.total_weight = sum(self.weights.values())
+        else:
+            self.width = float(bounds["high"] - bounds["low"]) or 1.0
+            self.centers = [(float(value) - bounds["low"]) / self.width for value in values]
+            # Narrow the kernels as the number of observations grows
+            self.bandwidth = max(0.05, 0.5 * (len(self.centers) + 1) ** -0.2)
+
+    def sample(self, rng):
+        if "choices" in self.bounds:
+            threshold = rng.uniform(0, self.total_weight)
+            for choice, weight in self.weights.items():
+                threshold -= weight
+                if threshold <= 0:
+                    return choice
+            return self.bounds["choices"][-1]
+
+        # Pick the uniform prior or one of the kernels with equal weight
+        component = rng.randrange(len(self.centers) + 1)
+        if component == len(self.centers):
+            scaled_value = rng.random()
+        else:
+            scaled_value = rng.gauss(self.centers[component], self.bandwidth)
+        return snap_value(self.bounds, self.bounds["low"] + min(max(scaled_value, 0.0), 1.0) * self.width)
+
+    def log_density(self, value):
+        if "choices" in self.bounds:
+            return math.log(self.weights.get(value, 1.0) / self.total_weight)
+
+        scaled_value = (float(value) - self.bounds["low"]) / self.width
+        density = 1.0  # uniform prior
+        for center in self.centers:
+            density += math.exp(-0.5 * ((scaled_value - center) / self.bandwidth) ** 2) / (self.bandwidth * math.sqrt(2 * math.pi))
+        return math.log(density / (len(self.centers) + 1))
+
+def propose_parameters(base_parameters, parameter_bounds, observations, batch_size, rng, excluded_hashes):
+    '''
+    Propose batch_size new parameter sets that are not in excluded_hashes
+    '''
+    proposals = []
+    good_estimators = None
+    bad_estimators = None
+
+    if len(observations) >= startup_backtests:
+        ranked_observations = sorted(observations, key=lambda observation: observation[1], reverse=True)
+        good_count = max(1, math.ceil(gamma * len(ranked_observations)))
+        good_observations = ranked_observations[:good_count]
+        bad_observations = ranked_observations[good_count:]
+        good_estimators = {key: ParzenEstimator(bounds, [values[key] for values, _ in good_observations]) for key, bounds in parameter_bounds.items()}
+        bad_estimators = {key: ParzenEstimator(bounds, [values[key] for values, _ in bad_observations]) for key, bounds in parameter_bounds.items()}
+
+    attempts = 0
+    while len(proposals) < batch_size and attempts < batch_size * 100:
+        attempts += 1
+
+        if good_estimators is None:
+            # Not enough results yet, explore at random
+            values = {key: sample_uniform(bounds, rng) for key, bounds in parameter_bounds.items()}
+        else:
+            # Draw candidates from the good density and keep the one with the best good / bad ratio
+            best_score = -math.inf
+            values = None
+            for i in range(candidates_per_proposal):
+                candidate = {key: good_estimators[key].sample(rng) for key in parameter_bounds}
+                score = sum(good_estimators[key].log_density(candidate[key]) - bad_estimators[key].log_density(candidate[key]) for key in parameter_bounds)
+                if score > best_score:
+                    best_score = score
+                    values = candidate
+
+        parameters = dict(base_parameters)
+        parameters.update(values)
+        parameter_hash = get_parameter_hash(parameters)
+        if parameter_hash in excluded_hashes:
+            continue
+        excluded_hashes.add(parameter_hash)
+        proposals.append(parameters)
+
+    return proposals
+
+def run_parameter_optimizer(strategy_file, strategy_parameters, run_backtests, previous_run_hashes, batch_size=None, seed=None):
+    '''
+    Optimize one configuration with an [optimizer] table.  run_backtests is called with each batch of
+    (strategy_file, strategy_parameters) runs and must add their results to the database.
+    Returns the best (parameters, objective value) found, or None.
+    '''
+    optimizer = strategy_parameters["optimizer"]
+    objective = optimizer.get("objective", "return_vs_benchmark")
+    if objective not in optimizer_objectives:
+        raise ValueError(f"Unknown optimizer objective {objective}, use one of {optimizer_objectives}")
+    parameter_bounds = optimizer["parameter_bounds"]
+    max_backtests = optimizer.get("max_backtests", 50)
+    max_seconds = optimizer.get("max_hours", 24) * 3600
+    batch_size = optimizer.get("batch_size", batch_size or 1)
+
+    check_parameter_bounds(parameter_bounds)
+
+    base_parameters = {key: value for key, value in strategy_parameters.items() if key != "optimizer"}
+    rng = random.Random(seed)
+    excluded_hashes = set(previous_run_hashes)
+
+    start_time = time.time()
+    backtests_run = 0
+    observations = load_observations(base_parameters, parameter_bounds, objective)
+    while backtests_run < max_backtests and time.time() - start_time < max_seconds:
+        proposals = propose_parameters(base_parameters, parameter_bounds, observations, min(batch_size, max_backtests - backtests_run), rng, excluded_hashes)
+        if len(proposals) == 0:
+            print("------ The optimizer could not find new parameters to try inside the bounds")
+            break
+
+        print(f">>>>> Optimizer round with {len(observations)} results, running {len(proposals)} backtests ({backtests_run} of {max_backtests} used)")
+        runs = [(f"{strategy_file.split('.')[0]}-{get_parameter_hash(parameters)[:12]}.toml", parameters) for parameters in proposals]
+        run_backtests(runs)
+        backtests_run += len(runs)
+
+        # The batch must be in results_database, the database record_backtest_results writes to,
+        # otherwise every round would propose from the same observations
+        observation_count = len(observations)
+        observations = load_observations(base_parameters, parameter_bounds, objective)
+        if len(observations) <= observation_count:
+            raise RuntimeError(f"The optimizer ran {len(runs)} backtests but none of them added a result to the results database")
+
+    if len(observations) == 0:
+        return None
+
+    best_values, best_objective = max(observations, key=lambda observation: observation[1])
+    print(f">>>>> Best {objective} {best_objective} from {len(observations)} backtests: {best_values}")
+    return best_values, best_objective
@@ -0,0 +1,163 @@
+# polygon_http_client
+#
+# Description: The HTTP client used for every direct call to the Polygon REST API.
+#
+#   - One requests.Session per process keeps the connections to api.polygon.io alive
+#   - Every request has a timeout
+#   - Connection errors, timeouts, 429 and 5xx responses, and responses without results that are
+#     not marked OK are retried with exponential backoff, honoring Retry-After
+#   - A token bucket limits the request rate.  The bucket is kept in a small SQLite file so all
+#     the worker processes of a parallel sweep share one limit.
+#
+# The rate can be set in credentials.py to match the Polygon plan:
+#
+# POLYGON_CONFIG = {
+#     "API_KEY": "...",
+#     "REQUESTS_PER_SECOND": 50,   # optional, default below
+# }
+
+import os
+import random
+import re
+import sqlite3
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from check_for_previous_run import results_database
+from credentials import POLYGON_CONFIG
+from polygon_record_replay import polygon_mode_variable
+
+rate_limit_database = os.path.join(os.path.dirname(results_database), "mwt_polygon_rate_limit.db")
+
+# The free plan allows 5 requests per minute, set REQUESTS_PER_SECOND to 0.08 for it
+requests_per_second = POLYGON_CONFIG.get("REQUESTS_PER_SECOND", 50)
+bucket_size = max(1.0, requests_per_second)
+
+request_timeout_seconds = 30
+max_attempts = 6
+backoff_seconds = 1.0
+max_backoff_seconds = 60.0
+retry_status_codes = {429, 500, 502, 503, 504}
+
+class PolygonRequestError(Exception):
+    pass
+
+class TokenBucket():
+    '''
+    A token bucket stored in SQLite so every process using the same file shares the rate limit
+    '''
+
+    def __init__(self, database=rate_limit_database, rate=requests_per_second, capacity=bucket_size):
+        self.database = database
+        self.rate = rate
+        self.capacity = capacity
+
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS token_bucket (id INTEGER PRIMARY KEY, tokens REAL, updated REAL)")
+        cursor.execute("INSERT OR IGNORE INTO token_bucket (id, tokens, updated) VALUES (1, ?, ?)", (self.capacity, time.time()))
+        conn.commit()
+        conn.close()
+
+    def try_acquire(self):
+        '''
+        Take a token if one is available.  Returns 0 on success, otherwise the seconds to wait.
+        '''
+        conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            # BEGIN IMMEDIATE so two processes cannot take the same token
+            cursor.execute("BEGIN IMMEDIATE")
+            tokens, updated = cursor.execute("SELECT tokens, updated FROM token_bucket WHERE id = 1").fetchone()
+            now = time.time()
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            wait_seconds = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait_seconds = (1 - tokens) / self.rate
+            cursor.execute("UPDATE token_bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return wait_seconds
+
+    def acquire(self):
+        while True:
+            wait_seconds = self.try_acquire()
+            if wait_seconds == 0:
+                return
+            time.sleep(wait_seconds)
+
+_session = None
+_session_pid = None
+_token_bucket = None
+
+def get_session():
+    # A session must not be shared across a fork, so each process creates its own
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+def get_token_bucket():
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = TokenBucket()
+    return _token_bucket
+
+def redact_api_key(url):
+    return re.sub(r"apiKey=[^&]*", "apiKey=...", url)
+
+def get_retry_seconds(attempt, response=None):
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    # Exponential backoff with jitter so the workers do not retry in step
+    return min(max_backoff_seconds, backoff_seconds * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def get_json(url, params=None):
+    '''
+    GET a Polygon URL and return the decoded JSON.  Raises PolygonRequestError when the request
+    still fails after max_attempts.
+    '''
+    # A replay is answered from the recordings database, so it is neither throttled nor retried
+    replaying = os.environ.get(polygon_mode_variable) == "replay"
+    attempts = 1 if replaying else max_attempts
+    last_error = None
+    for attempt in range(attempts):
+        if not replaying:
+            get_token_bucket().acquire()
+
+        response = None
+        try:
+            response = get_session().get(url, params=params, timeout=request_timeout_seconds)
+            if response.status_code in retry_status_codes:
+                last_error = f"HTTP {response.status_code}"
+            elif response.status_code != 200:
+                # Other errors, for example a bad API key, will not go away by retrying
+                raise PolygonRequestError(f"HTTP {response.status_code} from {redact_api_key(url)}: {response.text[:200]}")
+            else:
+                data = response.json()
+                # Polygon sometimes answers a throttled request with 200 and an error status
+                if "results" in data or data.get("status") in ("OK", "DELAYED"):
+                    return data
+                last_error = f"no results, status {data.get('status')}: {data.get('error') or data.get('message')}"
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            last_error = repr(e)
+
+        if replaying:
+            break
+        retry_seconds = get_retry_seconds(attempt, response)
+        print(f"****** Polygon request failed ({last_error}), retrying in {retry_seconds:.1f} seconds: {redact_api_key(url)}")
+        time.sleep(retry_seconds)
+
+    raise PolygonRequestError(f"Polygon request failed after {attempts} attempts ({last_error}): {redact_api_key(url)}")
@@ -0,0 +1,200 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Record the Polygon requests of a backtest and replay them without a network.  Both our own Polygon
+calls (requests) and Lumibot's PolygonDataBacktesting (the polygon RESTClient) send their requests
+through urllib3, so the shim replaces urllib3's HTTPConnectionPool.urlopen for hosts ending in
+polygon.io.  Nothing in the strategy or in Lumibot changes.
+
+    record   every Polygon request is sent and its response stored, compressed, in the recordings
+             database, keyed by the method, the URL without the API key and the body
+    replay   every Polygon request is answered from the recordings database.  A request that was
+             not recorded gets a 404 response and is listed in the database so it can be reported.
+
+The mode is read from the MWT_POLYGON_MODE environment variable so worker processes, including
+processes started with spawn, use the same mode as the driver:
+
+    python backtest_driver.py --record-polygon
+    python backtest_driver.py --replay-polygon      # no network needed
+
+    python polygon_record_replay.py                 # report what is recorded and what was missing
+
+"""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.response import HTTPResponse
+
+from check_for_previous_run import results_database
+
+recordings_database = os.path.join(os.path.dirname(results_database), "mwt_polygon_recordings.db")
+polygon_mode_variable = "MWT_POLYGON_MODE"
+polygon_modes = ["record", "replay"]
+
+# Headers that describe the original encoding of the body, the stored body is already decoded
+dropped_headers = {"content-encoding", "transfer-encoding", "content-length", "connection", "set-cookie"}
+
+_original_urlopen = HTTPConnectionPool.urlopen
+_installed_mode = None
+
+def get_request_key(method, url, body=None):
+    '''
+    Identify a request by its method, its URL with the query sorted and the API key removed, and
+    its body
+    '''
+    url_parts = urlsplit(url)
+    query = sorted((name, value) for name, value in parse_qsl(url_parts.query, keep_blank_values=True) if name != "apiKey")
+    normalized_url = f"{url_parts.path}?{urlencode(query)}"
+    if isinstance(body, str):
+        body = body.encode()
+    key_source = f"{method.upper()} {normalized_url}".encode() + (body or b"")
+    return hashlib.sha256(key_source).hexdigest(), normalized_url
+
+class PolygonRecordings():
+
+    def __init__(self, database=recordings_database):
+        self.database = database
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS polygon_recordings (
+                request_key TEXT PRIMARY KEY,
+                method TEXT,
+                url TEXT,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                recorded_at DATETIME
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS unrecorded_requests (
+                request_key TEXT PRIMARY KEY,
+                method TEXT,
+                url TEXT,
+                request_count INTEGER,
+                last_requested_at DATETIME
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, parameters=()):
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def save(self, request_key, method, url, status, headers, body):
+        self.execute('''
+            INSERT OR REPLACE INTO polygon_recordings (request_key, method, url, status, headers, body, recorded_at)
+            VALUES (?,?,?,?,?,?,?)
+        ''', (request_key, method, url, status, json.dumps(headers), zlib.compress(body), datetime.now()))
+        # A request recorded after it was reported missing is no longer missing
+        self.execute("DELETE FROM unrecorded_requests WHERE request_key = ?", (request_key,))
+
+    def load(self, request_key):
+        rows = self.execute("SELECT status, headers, body FROM polygon_recordings WHERE request_key = ?", (request_key,))
+        if len(rows) == 0:
+            return None
+        status, headers, body = rows[0]
+        return status, json.loads(headers), zlib.decompress(body)
+
+    def add_unrecorded(self, request_key, method, url):
+        self.execute('''
+            INSERT INTO unrecorded_requests (request_key, method, url, request_count, last_requested_at) VALUES (?,?,?,1,?)
+            ON CONFLICT(request_key) DO UPDATE SET request_count = request_count + 1, last_requested_at = excluded.last_requested_at
+        ''', (request_key, method, url, datetime.now()))
+
+    def print_report(self):
+        recorded_count, recorded_bytes = self.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM polygon_recordings")[0]
+        print(f">>>>> Polygon recordings: {recorded_count} responses using {recorded_bytes / (1024 * 1024):.1f} MB")
+        unrecorded = self.execute("SELECT method, url, request_count FROM unrecorded_requests ORDER BY last_requested_at")
+        if unrecorded:
+            print(f"****** {len(unrecorded)} Polygon requests were not recorded, run the backtests again with --record-polygon:")
+            for method, url, request_count in unrecorded:
+                print(f"------ {method} {url} ({request_count} times)")
+        return len(unrecorded)
+
+def build_response(status, headers, body, method, preload_content):
+    headers = {name: value for name, value in headers.items() if name.lower() not in dropped_headers}
+    headers["Content-Length"] = str(len(body))
+    return HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status,
+        reason="OK" if status == 200 else "Replayed",
+        preload_content=preload_content,
+        decode_content=False,
+        request_method=method,
+    )
+
+def is_polygon_host(pool):
+    return str(pool.host).endswith("polygon.io")
+
+def recording_urlopen(pool, method, url, body=None, *args, **kwargs):
+    if not is_polygon_host(pool):
+        return _original_urlopen(pool, method, url, body, *args, **kwargs)
+
+    preload_content = kwargs.get("preload_content", True)
+    kwargs["preload_content"] = False
+    response = _original_urlopen(pool, method, url, body, *args, **kwargs)
+    response_body = response.read(decode_content=True)
+    response.release_conn()
+
+    request_key, normalized_url = get_request_key(method, url, body)
+    # Throttled and failed responses are not recorded, the retry will be
+    if response.status < 500 and response.status != 429:
+        PolygonRecordings().save(request_key, method, normalized_url, response.status, dict(response.headers), response_body)
+    return build_response(response.status, dict(response.headers), response_body, method, preload_content)
+
+def replaying_urlopen(pool, method, url, body=None, *args, **kwargs):
+    if not is_polygon_host(pool):
+        return _original_urlopen(pool, method, url, body, *args, **kwargs)
+
+    request_key, normalized_url = get_request_key(method, url, body)
+    recordings = PolygonRecordings()
+    recording = recordings.load(request_key)
+    if recording is None:
+        recordings.add_unrecorded(request_key, method, normalized_url)
+        missing_body = json.dumps({"status": "NOT_RECORDED", "error": f"No recording for {method} {normalized_url}"}).encode()
+        return build_response(404, {"Content-Type": "application/json"}, missing_body, method, kwargs.get("preload_content", True))
+
+    status, headers, response_body = recording
+    return build_response(status, headers, response_body, method, kwargs.get("preload_content", True))
+
+def install(mode):
+    '''
+    Record or replay the Polygon requests of this process.  None restores the network.
+    '''
+    global _installed_mode
+    if mode not in polygon_modes + [None]:
+        raise ValueError(f"Unknown Polygon mode {mode}, use one of {polygon_modes}")
+
+    if mode == "record":
+        HTTPConnectionPool.urlopen = recording_urlopen
+    elif mode == "replay":
+        HTTPConnectionPool.urlopen = replaying_urlopen
+    else:
+        HTTPConnectionPool.urlopen = _original_urlopen
+    _installed_mode = mode
+
+def install_from_environment():
+    mode = os.environ.get(polygon_mode_variable)
+    if mode and mode != _installed_mode:
+        install(mode)
+
+if __name__ == "__main__":
+    PolygonRecordings().print_report()
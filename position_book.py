@@ -0,0 +1,197 @@
+# position_book
+#
+# Description: The open trades of a backtest, keyed by trade id.  Lumibot's get_positions returns one
+# position per contract for the whole account, so with more than one condor open the strategy cannot
+# tell from it which legs belong together.  The book records the legs each trade submitted, with
+# their quantities, and the state the strategy keeps per condor: the credit, the number of rolls and
+# the number of iterations it has been held.  Trades and legs are dictionaries, so looking up a trade,
+# or the trades holding a contract, does not rescan the positions.
+#
+# A leg only becomes a position when its order fills.  Until then it is a pending leg of the trade,
+# keyed by the order identifier, and the book maps each pending order to its trade so a fill finds it
+# without scanning the trades.  A canceled opening order drops its pending leg, a canceled closing
+# order gives the leg back to its trade, so a rejected order never leaves a leg that does not exist.
+
+def get_leg_key(asset):
+    # Lumibot reports the right in upper case, orders may be created in lower case
+    return (asset.symbol, str(asset.expiration), float(asset.strike), str(asset.right).upper())
+
+class Trade():
+
+    def __init__(self, trade_id, opened_at):
+        self.trade_id = trade_id
+        self.opened_at = opened_at
+        # leg key -> [asset, quantity], a negative quantity is a short
+        self.legs = {}
+        self.purchase_credit = 0
+        self.last_trade_size = 0
+        self.roll_count = 0
+        self.hold_length = 0
+        # order identifier -> [asset, quantity] of the legs submitted but not filled
+        self.pending_legs = {}
+        # Underlying prices between which no check can trigger, set by the strategy with trigger_gating
+        self.guard_bands = None
+
+    def get_legs(self, right=None):
+        '''
+        The (asset, quantity) of the legs, in the order they were opened, optionally of one right
+        '''
+        return [(asset, quantity) for (_, _, _, leg_right), (asset, quantity) in self.legs.items()
+                if right is None or leg_right == right.upper()]
+
+    def has_legs(self):
+        return len(self.legs) > 0
+
+    def is_empty(self):
+        # No position and no order waiting to fill
+        return len(self.legs) == 0 and len(self.pending_legs) == 0
+
+class PositionBook():
+
+    def __init__(self):
+        self.trades = {}
+        self.next_trade_id = 1
+        self.last_opened_at = None
+        # leg key -> ids of the trades holding the contract
+        self.leg_trades = {}
+        # order identifier -> (trade, asset, quantity) of the closing orders not filled yet
+        self.closing_orders = {}
+        # order identifier -> trade of the opening orders not filled yet
+        self.pending_orders = {}
+
+    def __len__(self):
+        return len(self.trades)
+
+    def open_trade(self, opened_at):
+        trade = Trade(self.next_trade_id, opened_at)
+        self.trades[trade.trade_id] = trade
+        self.next_trade_id += 1
+        self.last_opened_at = opened_at
+        return trade
+
+    def can_open_trade(self, opened_at, max_open_trades, entry_spacing_days):
+        '''
+        True if fewer than max_open_trades are open and the last trade was opened at least
+        entry_spacing_days before opened_at
+        '''
+        if len(self.trades) >= max_open_trades:
+            return False
+        return self.last_opened_at is None or (opened_at.date() - self.last_opened_at.date()).days >= entry_spacing_days
+
+    def get_trade(self, trade_id):
+        return self.trades.get(trade_id)
+
+    def get_open_trades(self):
+        return list(self.trades.values())
+
+    def get_trades_holding(self, asset):
+        return [self.trades[trade_id] for trade_id in self.leg_trades.get(get_leg_key(asset), ())]
+
+    def add_leg(self, trade, asset, quantity):
+        key = get_leg_key(asset)
+        if key in trade.legs:
+            quantity += trade.legs.pop(key)[1]
+        if quantity == 0:
+            if key in self.leg_trades:
+                self.leg_trades[key].discard(trade.trade_id)
+                if not self.leg_trades[key]:
+                    del self.leg_trades[key]
+            return
+        trade.legs[key] = [asset, quantity]
+        self.leg_trades.setdefault(key, set()).add(trade.trade_id)
+
+    def remove_legs(self, trade, right=None):
+        '''
+        Remove the legs of the trade, optionally only those of one right, and return them
+        '''
+        removed_legs = trade.get_legs(right)
+        for asset, _ in removed_legs:
+            key = get_leg_key(asset)
+            del trade.legs[key]
+            self.leg_trades[key].discard(trade.trade_id)
+            if not self.leg_trades[key]:
+                del self.leg_trades[key]
+        return removed_legs
+
+    def close_trade(self, trade):
+        self.remove_legs(trade)
+        for identifier in trade.pending_legs:
+            self.pending_orders.pop(identifier, None)
+        trade.pending_legs = {}
+        return self.trades.pop(trade.trade_id, None)
+
+    def add_pending_leg(self, trade, order, quantity):
+        trade.pending_legs[order.identifier] = [order.asset, quantity]
+        self.pending_orders[order.identifier] = trade
+
+    def add_closing_order(self, trade, order, quantity):
+        # quantity is the quantity of the leg being closed, a negative quantity is a short
+        self.closing_orders[order.identifier] = (trade, order.asset, quantity)
+
+    def get_pending_trade(self, order):
+        return self.pending_orders.get(order.identifier)
+
+    def fill_order(self, order, filled_quantity):
+        '''
+        Move the filled quantity of a pending leg to the positions of its trade.  Returns the trade,
+        None for an order the book did not submit or a closing order.
+        '''
+        self.closing_orders.pop(order.identifier, None)
+        trade = self.get_pending_trade(order)
+        if trade is None:
+            return None
+
+        asset, quantity = trade.pending_legs[order.identifier]
+        filled_quantity = min(abs(filled_quantity), abs(quantity))
+        filled_quantity = filled_quantity if quantity > 0 else -filled_quantity
+        self.add_leg(trade, asset, filled_quantity)
+        if filled_quantity == quantity:
+            del trade.pending_legs[order.identifier]
+            del self.pending_orders[order.identifier]
+        else:
+            trade.pending_legs[order.identifier][1] = quantity - filled_quantity
+        return trade
+
+    def cancel_order(self, order):
+        '''
+        Undo a canceled order: a pending leg is dropped, and the trade with it if nothing else is
+        left, a closing order gives the leg back to its trade, reopening the trade if it was closed.
+        Returns the trade, or None.
+        '''
+        if order.identifier in self.closing_orders:
+            trade, asset, quantity = self.closing_orders.pop(order.identifier)
+            self.trades.setdefault(trade.trade_id, trade)
+            self.add_leg(trade, asset, quantity)
+            trade.guard_bands = None
+            return trade
+
+        trade = self.get_pending_trade(order)
+        if trade is None:
+            return None
+        del trade.pending_legs[order.identifier]
+        del self.pending_orders[order.identifier]
+        if trade.is_empty():
+            self.trades.pop(trade.trade_id, None)
+        return trade
+
+def get_trade_event(day, action, side, trade):
+    '''
+    A record of a trade being opened, rolled or closed, with its expiration, short strikes and size.
+    The Lumibot strategy and the simulator record the same events, see simulator_parity.py.
+    '''
+    expiration, short_strikes, quantity = None, {"CALL": None, "PUT": None}, 0
+    # The legs of the orders of this iteration are still pending in a Lumibot backtest
+    for asset, leg_quantity in trade.get_legs() + list(trade.pending_legs.values()):
+        _, leg_expiration, strike, right = get_leg_key(asset)
+        if leg_quantity < 0:
+            expiration, short_strikes[right], quantity = leg_expiration, strike, -leg_quantity
+    return {
+        "date": str(day)[:10],
+        "trade_id": trade.trade_id,
+        "action": action,
+        "side": side,
+        "expiration": expiration,
+        "call_short": short_strikes["CALL"],
+        "put_short": short_strikes["PUT"],
+        "quantity": quantity,
+    }
@@ -0,0 +1,120 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Check the simulator, condor_simulator.py, against the Lumibot backtest.  Every parameter set of the
+configurations is run both ways and compared:
+
+    - the trade events, every open, roll and close with its date, expiration, short strikes and size,
+      must be the same
+    - the daily portfolio values must stay within equity_tolerance of the Lumibot values
+
+The simulator fills at the daily close and Lumibot at the price of the iteration, so small equity
+differences are expected.  A different trade usually means the two price sources disagree about a
+roll or a max loss on that day, the report shows the first one.  The speed up of each run is
+printed with the comparison.
+
+    python simulator_parity.py                       # every configuration in the configuration directory
+    python simulator_parity.py spy-condor.toml       # only these configurations
+
+The exit status is 1 if any parameter set does not match.
+
+"""
+
+import argparse
+import os
+import sys
+
+import toml
+
+import backtest_driver
+from backtest_driver import run_strategy_backtest
+from condor_simulator import run_simulated_backtest
+from get_strategy_return import get_strategy_return_from_portfolio_values
+from parameter_grid import expand_parameter_grid
+from sweep_scheduler import get_date
+
+# Simulated values further than this fraction from the Lumibot values are reported as divergent
+equity_tolerance = 0.02
+
+trade_event_fields = ["date", "trade_id", "action", "side", "expiration", "call_short", "put_short", "quantity"]
+
+def compare_trade_events(lumibot_events, simulated_events):
+    '''
+    The index and the two events of the first difference, None if the trades are the same
+    '''
+    for index in range(max(len(lumibot_events), len(simulated_events))):
+        lumibot_event = lumibot_events[index] if index < len(lumibot_events) else None
+        simulated_event = simulated_events[index] if index < len(simulated_events) else None
+        if lumibot_event is None or simulated_event is None:
+            return index, lumibot_event, simulated_event
+        if any(lumibot_event[field] != simulated_event[field] for field in trade_event_fields):
+            return index, lumibot_event, simulated_event
+    return None
+
+def compare_portfolio_values(lumibot_values, simulated_values):
+    '''
+    The largest daily difference in dollars and the (day, difference) of the first day beyond
+    equity_tolerance, or None
+    '''
+    lumibot_by_date = {get_date(value["datetime"]): value["portfolio_value"] for value in lumibot_values}
+    largest_difference = 0.0
+    first_divergence = None
+    for value in simulated_values:
+        lumibot_value = lumibot_by_date.get(get_date(value["datetime"]))
+        if lumibot_value is None:
+            continue
+        difference = value["portfolio_value"] - lumibot_value
+        largest_difference = max(largest_difference, abs(difference))
+        if first_divergence is None and abs(difference) > abs(lumibot_value) * equity_tolerance:
+            first_divergence = (get_date(value["datetime"]), difference)
+    return largest_difference, first_divergence
+
+def run_parity_check(strategy_file, strategy_parameters):
+    '''
+    Run one parameter set on Lumibot and on the simulator, print the comparison and return True
+    if the trades match and the equity curves stay within the tolerance
+    '''
+    lumibot_parameters = {key: value for key, value in strategy_parameters.items() if key != "backtest_engine"}
+    lumibot_results = run_strategy_backtest(strategy_file, lumibot_parameters)
+    simulated_results = run_simulated_backtest(strategy_file, lumibot_parameters)
+
+    trade_difference = compare_trade_events(lumibot_results.get("trade_events", []), simulated_results["trade_events"])
+    largest_difference, first_divergence = compare_portfolio_values(lumibot_results["portfolio_values"], simulated_results["portfolio_values"])
+
+    speed_up = lumibot_results["run_seconds"] / max(simulated_results["run_seconds"], 1e-6)
+    print(f">>>>> {strategy_file}: Lumibot return {get_strategy_return_from_portfolio_values(lumibot_results['portfolio_values'])}, "
+          f"simulated return {simulated_results['strategy_return']}, largest daily difference {largest_difference:.2f}, {speed_up:.0f}x faster")
+
+    if trade_difference is not None:
+        index, lumibot_event, simulated_event = trade_difference
+        print(f"****** {strategy_file}: trade event {index + 1} differs")
+        print(f"------ Lumibot:   {lumibot_event}")
+        print(f"------ Simulator: {simulated_event}")
+    if first_divergence is not None:
+        divergence_day, difference = first_divergence
+        print(f"****** {strategy_file}: the simulated equity diverges from Lumibot on {divergence_day} by {difference:.2f}")
+
+    return trade_difference is None and first_divergence is None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the simulator with the Lumibot backtest")
+    parser.add_argument("strategy_files", nargs="*", help="TOML files in the strategy configuration directory, all of them by default")
+    args = parser.parse_args()
+
+    strategy_files = args.strategy_files or sorted(file for file in os.listdir(backtest_driver.strategy_configuration_directory) if file.endswith(".toml"))
+
+    checked_count = 0
+    failed_runs = []
+    for strategy_file in strategy_files:
+        strategy_parameters = toml.load(os.path.join(backtest_driver.strategy_configuration_directory, strategy_file))
+        # The optimizer proposes its own parameter sets, there is nothing fixed to compare
+        if "optimizer" in strategy_parameters:
+            continue
+        for parameters in expand_parameter_grid(strategy_parameters):
+            checked_count += 1
+            if not run_parity_check(strategy_file, parameters):
+                failed_runs.append(strategy_file)
+
+    print(f">>>>> {checked_count - len(failed_runs)} of {checked_count} parameter sets match the Lumibot backtest")
+    sys.exit(1 if failed_runs else 0)
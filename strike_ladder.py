@@ -0,0 +1,153 @@
+# strike_ladder
+#
+# Description: The listed strikes of one (symbol, expiration), kept as sorted lists so the strike
+# lookups the strategy makes are bisect searches instead of scans:
+#
+#   - the at the money strike, the listed strike nearest a price
+#   - the window of max_strikes strikes around a price
+#   - the spread whose short strike and wing, distance_of_wings away, are both listed
+#   - the first strike whose delta reaches a target, a bisection with find_first_index
+#
+# Knowing which strikes are listed lets create_legs choose valid shorts and wings without pricing
+# strikes that do not exist.
+
+from bisect import bisect_left
+
+class StrikeLadder():
+
+    def __init__(self, symbol, expiration, call_strikes, put_strikes):
+        self.symbol = symbol
+        self.expiration = expiration
+        self.strikes = {
+            "call": sorted(set(call_strikes)),
+            "put": sorted(set(put_strikes)),
+        }
+
+    @classmethod
+    def from_contracts(cls, symbol, expiration, contracts):
+        '''
+        Build the ladder from Polygon contract references, see option_contract_cache.py
+        '''
+        call_strikes = [contract["strike_price"] for contract in contracts if contract["contract_type"] == "call"]
+        put_strikes = [contract["strike_price"] for contract in contracts if contract["contract_type"] == "put"]
+        return cls(symbol, expiration, call_strikes, put_strikes)
+
+    def get_strikes(self, right):
+        return self.strikes[right.lower()]
+
+    def has_strike(self, right, strike):
+        strikes = self.get_strikes(right)
+        index = bisect_left(strikes, strike)
+        return index < len(strikes) and abs(strikes[index] - strike) < 1e-6
+
+    def get_nearest_index(self, right, price):
+        '''
+        The index of the listed strike nearest price, None if there are no strikes
+        '''
+        strikes = self.get_strikes(right)
+        if len(strikes) == 0:
+            return None
+        index = bisect_left(strikes, price)
+        if index == len(strikes):
+            return index - 1
+        if index > 0 and price - strikes[index - 1] <= strikes[index] - price:
+            return index - 1
+        return index
+
+    def get_nearest_strike(self, right, price):
+        index = self.get_nearest_index(right, price)
+        return None if index is None else self.get_strikes(right)[index]
+
+    def get_atm_strike(self, price):
+        return self.get_nearest_strike("call", price)
+
+    def get_strike_window(self, right, price, maximum_strikes):
+        '''
+        Up to maximum_strikes listed strikes centered on the strike nearest price, in ascending order
+        '''
+        index = self.get_nearest_index(right, price)
+        if index is None:
+            return []
+        middle_strike = maximum_strikes // 2
+        return self.get_strikes(right)[max(0, index - middle_strike):index + middle_strike]
+
+    def get_wing_strike(self, right, short_strike, distance):
+        '''
+        The long strike distance dollars further out of the money than short_strike, or None if it
+        is not listed
+        '''
+        wing_strike = short_strike + distance if right.lower() == "call" else short_strike - distance
+        return wing_strike if self.has_strike(right, wing_strike) else None
+
+    def get_spread_candidates(self, right, short_strike, distance, maximum_steps=5):
+        '''
+        The (short strike, wing strike) pairs with both strikes listed among the maximum_steps listed
+        strikes starting at the strike nearest short_strike and moving toward the money, like the
+        earlier strike adjustment loop, so the short is never further out of the money than asked.
+        '''
+        strikes = self.get_strikes(right)
+        index = self.get_nearest_index(right, short_strike)
+        if index is None:
+            return []
+
+        # Calls move down toward the money, puts move up
+        step = -1 if right.lower() == "call" else 1
+        candidates = []
+        for i in range(maximum_steps):
+            if not 0 <= index < len(strikes):
+                break
+            wing_strike = self.get_wing_strike(right, strikes[index], distance)
+            if wing_strike is not None:
+                candidates.append((strikes[index], wing_strike))
+            index += step
+        return candidates
+
+def find_first_index(count, is_reached, start_index=None):
+    '''
+    The first index in 0..count-1 where is_reached(index) is True, given that it is False up to some
+    index and True after it, or count if it is never True.  The indexes are bisected, so only about
+    log2(count) of them are evaluated.  With start_index the search first steps out from that index,
+    doubling the step, until the first True index is bracketed, which takes a few evaluations when
+    the answer is close to start_index.  Returns None as soon as is_reached returns None.
+    '''
+    # is_reached is False at low and True at high, -1 and count stand for the ends of the ladder
+    low, high = -1, count
+
+    if start_index is not None and 0 <= start_index < count:
+        reached = is_reached(start_index)
+        if reached is None:
+            return None
+        step = 1
+        if reached:
+            high = start_index
+            while high - step > low:
+                reached = is_reached(high - step)
+                if reached is None:
+                    return None
+                if not reached:
+                    low = high - step
+                    break
+                high -= step
+                step *= 2
+        else:
+            low = start_index
+            while low + step < high:
+                reached = is_reached(low + step)
+                if reached is None:
+                    return None
+                if reached:
+                    high = low + step
+                    break
+                low += step
+                step *= 2
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        reached = is_reached(middle)
+        if reached is None:
+            return None
+        if reached:
+            high = middle
+        else:
+            low = middle
+    return high
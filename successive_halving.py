@@ -0,0 +1,119 @@
+# successive_halving
+#
+# Description: Prune a parameter sweep with successive halving.  Every candidate is first backtested
+# on a short prefix of its starting_date..ending_date window.  Only the best keep_fraction of the
+# candidates, ranked by the selected metric, are backtested on the next, longer window.  This repeats
+# until the survivors are backtested on the full window.
+#
+# Each shorter window is an ordinary backtest with an earlier ending_date, so it has its own
+# parameter hash and its own row in the results database, with window_days recording its length.
+# Windows that are already in the database are not run again.  The last window is the full window,
+# so the survivors' final results are the same rows a normal sweep would produce.
+
+import math
+from datetime import timedelta
+
+from check_for_previous_run import get_backtest_engine, get_parameter_hash, get_previous_run_results
+from sweep_scheduler import get_backtest_days, get_date
+
+halving_metrics = ["strategy_return", "max_drawdown", "return_over_drawdown"]
+
+# The drawdown of return_over_drawdown is floored so a run that never lost money, or never traded,
+# does not outrank every profitable run
+minimum_drawdown = 0.01
+
+def get_return_over_drawdown(strategy_return, max_drawdown):
+    '''
+    The return_over_drawdown metric, shared with parameter_optimizer.py
+    '''
+    return strategy_return / max(max_drawdown, minimum_drawdown)
+
+def get_window_parameters(strategy_parameters, window_fraction):
+    '''
+    The parameters for a backtest of the first window_fraction of the backtest period.  The full
+    window returns the parameters unchanged so the parameter hash matches a normal sweep.
+    '''
+    if window_fraction >= 1:
+        return strategy_parameters
+
+    window_days = max(1, round(get_backtest_days(strategy_parameters) * window_fraction))
+    window_parameters = dict(strategy_parameters)
+    window_parameters["ending_date"] = get_date(strategy_parameters["starting_date"]) + timedelta(days=window_days)
+    return window_parameters
+
+def get_halving_score(run_results, metric):
+    '''
+    A larger score is better.  Runs without results are ranked last.
+    '''
+    if run_results is None or run_results["strategy_return"] is None:
+        return -math.inf
+
+    strategy_return = run_results["strategy_return"]
+    max_drawdown = run_results["max_drawdown"]
+    if metric == "strategy_return":
+        return strategy_return
+    if max_drawdown is None:
+        return -math.inf
+    if metric == "max_drawdown":
+        return -max_drawdown
+    return get_return_over_drawdown(strategy_return, max_drawdown)
+
+def run_successive_halving(candidate_runs, run_backtests, window_fractions=(0.25, 0.5, 1.0), keep_fraction=0.5, metric="strategy_return"):
+    '''
+    candidate_runs is a list of (strategy_file, strategy_parameters).  run_backtests is called with
+    the list of runs missing from the database for each window and must add their results to the
+    database.  Returns the surviving candidates of the last window ordered from best to worst.
+    '''
+    if metric not in halving_metrics:
+        raise ValueError(f"Unknown successive halving metric {metric}, use one of {halving_metrics}")
+
+    window_fractions = sorted(window_fractions)
+    survivors = list(candidate_runs)
+
+    for window_number, window_fraction in enumerate(window_fractions):
+        window_runs = []
+        for strategy_file, strategy_parameters in survivors:
+            window_parameters = get_window_parameters(strategy_parameters, window_fraction)
+            window_file = strategy_file
+            if window_fraction < 1:
+                window_file = f"{strategy_file.split('.')[0]}-w{get_backtest_days(window_parameters)}.toml"
+            window_runs.append((window_file, window_parameters))
+
+        # Only run the windows that are not already in the database
+        window_hashes = [get_parameter_hash(window_parameters) for _, window_parameters in window_runs]
+        previous_results = get_previous_run_results(window_hashes)
+        missing_runs = [run for run, parameter_hash in zip(window_runs, window_hashes) if parameter_hash not in previous_results]
+
+        print(f">>>>> Successive halving window {window_number + 1} of {len(window_fractions)}: {window_fraction:.0%} of the backtest period, "
+              f"{len(survivors)} candidates, {len(window_runs) - len(missing_runs)} already in the database")
+
+        if missing_runs:
+            run_backtests(missing_runs)
+            # Read back from results_database, the database record_backtest_results writes to
+            previous_results = get_previous_run_results(window_hashes)
+            missing_hashes = [get_parameter_hash(window_parameters) for _, window_parameters in missing_runs]
+            if not any(parameter_hash in previous_results for parameter_hash in missing_hashes):
+                raise RuntimeError(f"Successive halving window {window_number + 1} ran {len(missing_runs)} backtests but none of them are in the results database")
+            for (window_file, _), parameter_hash in zip(window_runs, window_hashes):
+                if parameter_hash not in previous_results:
+                    print(f"****** Successive halving: {window_file} has no results, it is ranked last")
+
+        # Rank the candidates on this window and keep the best ones for the next window.  Only results of
+        # the candidate's own backtest engine are scored.
+        scores = []
+        for (_, window_parameters), parameter_hash in zip(window_runs, window_hashes):
+            run_results = previous_results.get(parameter_hash)
+            if run_results is not None and run_results["backtest_engine"] != get_backtest_engine(window_parameters):
+                run_results = None
+            scores.append(get_halving_score(run_results, metric))
+        ranked_candidates = [candidate for _, candidate in sorted(zip(scores, survivors), key=lambda scored: scored[0], reverse=True)]
+
+        if window_number == len(window_fractions) - 1:
+            survivors = ranked_candidates
+        else:
+            survivors = ranked_candidates[:max(1, math.ceil(len(ranked_candidates) * keep_fraction))]
+
+    for strategy_file, _ in survivors:
+        print(f"------ Successive halving survivor: {strategy_file}")
+
+    return survivors
@@ -0,0 +1,207 @@
+# sweep_journal
+#
+# Description: A persistent journal of the backtests in a sweep.  Each backtest is identified by its
+# parameter_hash and moves through the states
+#
+#   queued -> running -> done
+#                     -> failed -> (retried) -> quarantined after max_attempts
+#
+# The journal is written before and after every backtest, so if the driver dies part way through a
+# sweep the next run of the driver resumes exactly the backtests that did not finish, in the order
+# they were first queued.  Backtests that were running when the driver died are queued again.
+#
+# Several drivers, on one machine or on several machines sharing the journal file, can work through
+# the same sweep.  A driver claims a backtest by taking a lease on it and renews the lease with a
+# heartbeat while the backtest runs.  If a driver dies its leases expire and other drivers claim the
+# backtests again.
+
+import os
+import sqlite3
+import time
+import toml
+from datetime import datetime
+
+from check_for_previous_run import get_parameter_hash, results_database
+
+journal_database = os.path.join(os.path.dirname(results_database), "mwt_sweep_journal.db")
+
+# Columns added after the journal was first created
+added_columns = [
+    ("lease_owner", "TEXT"),  # The driver that claimed the backtest
+    ("lease_expires", "REAL"),  # Time, in seconds since the epoch, when other drivers may claim the backtest
+    ("heartbeat_at", "DATETIME"),  # Last time the driver renewed the lease
+]
+
+class SweepJournal():
+
+    def __init__(self, database=journal_database, max_attempts=3):
+        self.database = database
+        self.max_attempts = max_attempts
+
+        conn = sqlite3.connect(self.database)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_journal (
+                parameter_hash TEXT PRIMARY KEY,
+                sequence INTEGER,
+                strategy_file TEXT,
+                strategy_parameters TEXT,
+                state TEXT,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_at DATETIME
+            )
+        ''')
+        cursor.execute("PRAGMA table_info(sweep_journal)")
+        existing_columns = {row[1] for row in cursor.fetchall()}
+        for column_name, column_type in added_columns:
+            if column_name not in existing_columns:
+                cursor.execute(f"ALTER TABLE sweep_journal ADD COLUMN {column_name} {column_type}")
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, parameters=()):
+        # A connection per statement keeps the journal safe to use after a fork
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql, parameters)
+        rows = cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def enqueue_runs(self, runs):
+        '''
+        Add (strategy_file, strategy_parameters) runs to the journal in the order given.  Runs that
+        are already in the journal keep their state and their original position.
+        '''
+        conn = sqlite3.connect(self.database, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(sequence), 0) FROM sweep_journal")
+        sequence = cursor.fetchone()[0]
+        for strategy_file, strategy_parameters in runs:
+            sequence += 1
+            # The parameters are stored as TOML so dates come back as dates
+            cursor.execute('''
+                INSERT OR IGNORE INTO sweep_journal (parameter_hash, sequence, strategy_file, strategy_parameters, state, attempts, updated_at)
+                VALUES (?,?,?,?,?,?,?)
+            ''', (get_parameter_hash(strategy_parameters), sequence, strategy_file, toml.dumps(strategy_parameters), "queued", 0, datetime.now()))
+        conn.commit()
+        conn.close()
+
+    def reset_interrupted_runs(self):
+        '''
+        Queue again the backtests that were running when the driver stopped.  An interrupted
+        attempt does not count against max_attempts.  Backtests leased by a driver that is still
+        running are left alone.
+        '''
+        interrupted = "state = 'running' AND (lease_expires IS NULL OR lease_expires < ?)"
+        rows = self.execute(f"SELECT parameter_hash FROM sweep_journal WHERE {interrupted}", (time.time(),))
+        self.execute(f'''
+            UPDATE sweep_journal SET state = 'queued', attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_expires = NULL, updated_at = ?
+            WHERE {interrupted}
+        ''', (datetime.now(), time.time()))
+        if len(rows) > 0:
+            print(f">>>>> Resuming {len(rows)} backtests that were interrupted")
+        return len(rows)
+
+    def get_runnable_runs(self):
+        '''
+        Return the queued backtests and the failed backtests that can be retried, in journal order
+        '''
+        rows = self.execute('''
+            SELECT strategy_file, strategy_parameters FROM sweep_journal
+            WHERE state = 'queued' OR (state = 'failed' AND attempts < ?)
+            ORDER BY sequence
+        ''', (self.max_attempts,))
+        return [(strategy_file, toml.loads(strategy_parameters)) for strategy_file, strategy_parameters in rows]
+
+    def mark_running(self, strategy_parameters):
+        self.execute('''
+            UPDATE sweep_journal SET state = 'running', attempts = attempts + 1, updated_at = ? WHERE parameter_hash = ?
+        ''', (datetime.now(), get_parameter_hash(strategy_parameters)))
+
+    def mark_done(self, strategy_parameters):
+        self.execute('''
+            UPDATE sweep_journal SET state = 'done', last_error = NULL, lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE parameter_hash = ?
+        ''', (datetime.now(), get_parameter_hash(strategy_parameters)))
+
+    def mark_failed(self, strategy_parameters, error):
+        '''
+        Record a failed attempt.  After max_attempts the backtest is quarantined and not retried.
+        '''
+        parameter_hash = get_parameter_hash(strategy_parameters)
+        self.execute('''
+            UPDATE sweep_journal
+            SET state = CASE WHEN attempts >= ? THEN 'quarantined' ELSE 'failed' END, last_error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ?
+            WHERE parameter_hash = ?
+        ''', (self.max_attempts, f"{error!r}", datetime.now(), parameter_hash))
+
+        state = self.execute("SELECT state FROM sweep_journal WHERE parameter_hash = ?", (parameter_hash,))[0][0]
+        if state == "quarantined":
+            print(f"****** Backtest quarantined after {self.max_attempts} attempts: {error!r}")
+        return state
+
+    def claim_next_run(self, node_id, lease_seconds):
+        '''
+        Atomically claim the next backtest for this driver.  The next backtest is the first queued
+        backtest, failed backtest that can be retried, or running backtest whose lease expired.
+        Returns (strategy_file, strategy_parameters) or None when there is nothing to claim.
+        '''
+        conn = sqlite3.connect(self.database, timeout=60, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            # BEGIN IMMEDIATE takes the write lock so two drivers cannot claim the same backtest
+            cursor.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            cursor.execute('''
+                SELECT parameter_hash, strategy_file, strategy_parameters FROM sweep_journal
+                WHERE state = 'queued'
+                   OR (state = 'failed' AND attempts < ?)
+                   OR (state = 'running' AND lease_expires IS NOT NULL AND lease_expires < ?)
+                ORDER BY sequence LIMIT 1
+            ''', (self.max_attempts, now))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("COMMIT")
+                return None
+
+            parameter_hash, strategy_file, strategy_parameters = row
+            cursor.execute('''
+                UPDATE sweep_journal
+                SET state = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, heartbeat_at = ?, updated_at = ?
+                WHERE parameter_hash = ?
+            ''', (node_id, now + lease_seconds, datetime.now(), datetime.now(), parameter_hash))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        return strategy_file, toml.loads(strategy_parameters)
+
+    def renew_leases(self, node_id, lease_seconds):
+        '''
+        Heartbeat: extend the leases of every backtest this driver is running
+        '''
+        self.execute('''
+            UPDATE sweep_journal SET lease_expires = ?, heartbeat_at = ? WHERE state = 'running' AND lease_owner = ?
+        ''', (time.time() + lease_seconds, datetime.now(), node_id))
+
+    def count_active_runs(self):
+        '''
+        The number of backtests that are waiting to be claimed or are running on any driver
+        '''
+        rows = self.execute('''
+            SELECT COUNT(*) FROM sweep_journal WHERE state IN ('queued', 'running') OR (state = 'failed' AND attempts < ?)
+        ''', (self.max_attempts,))
+        return rows[0][0]
+
+    def print_summary(self):
+        rows = self.execute("SELECT state, COUNT(*) FROM sweep_journal GROUP BY state ORDER BY state")
+        print(">>>>> Sweep journal: " + ", ".join(f"{state} {count}" for state, count in rows))
+
+        quarantined_runs = self.execute("SELECT strategy_file, last_error FROM sweep_journal WHERE state = 'quarantined' ORDER BY sequence")
+        for strategy_file, last_error in quarantined_runs:
+            print(f"------ Quarantined {strategy_file}: {last_error}")
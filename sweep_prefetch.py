@@ -0,0 +1,172 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Download the market data a sweep needs before the backtests start.  The parameters of every pending
+backtest give its symbol, date window and option_duration, so the monthly expirations it can trade
+are known in advance.  The underlying prices during the time each expiration can be held, widened
+by the strike band from max_strikes, strike_step_size and distance_of_wings, give the strikes it
+can request.  The planner takes the union over the whole sweep, so data shared by many backtests is
+downloaded once, and then downloads it with a pool of threads:
+
+    - the contract reference of each expiration into the option contract cache
+    - the underlying and option bars into the Lumibot Polygon cache read by PolygonDataBacktesting
+
+The backtests then run almost entirely from local data.  The Polygon rate limit still applies to
+the contract reference downloads, see polygon_http_client.py.
+
+    python backtest_driver.py --prefetch --prefetch-threads 16 --workers 4
+    python sweep_prefetch.py                # only download the data
+
+"""
+
+import os
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lumibot.entities import Asset
+from lumibot.tools import polygon_helper
+
+from credentials import POLYGON_CONFIG
+from option_contract_cache import OptionContractCache
+from sweep_scheduler import get_date, get_monthly_expiration_after_date
+
+# The bar size PolygonDataBacktesting requests for the strategy's get_last_price calls
+prefetch_timespan = "minute"
+default_prefetch_threads = 16
+
+def get_trade_window(expiration, option_duration):
+    '''
+    The days an expiration can be held.  A condor opened on day d uses the first monthly expiration
+    on or after d + option_duration, so the expiration is opened after the previous expiration minus
+    option_duration.  It is held, and rolled, until it is closed before it expires.
+    '''
+    first_of_previous_month = (expiration.replace(day=1) - timedelta(days=1)).replace(day=1)
+    previous_expiration = get_monthly_expiration_after_date(first_of_previous_month)
+    return previous_expiration - timedelta(days=option_duration), expiration
+
+def plan_sweep_prefetch(runs):
+    '''
+    Return the underlying date range of each symbol and, for each (symbol, expiration), the days it
+    can be held and the widest strike band, in dollars around the underlying price, any backtest of
+    the sweep can request
+    '''
+    underlying_windows = {}
+    expiration_plans = {}
+
+    for strategy_file, strategy_parameters in runs:
+        symbol = strategy_parameters["symbol"]
+        starting_date = get_date(strategy_parameters["starting_date"])
+        ending_date = get_date(strategy_parameters["ending_date"])
+        option_duration = strategy_parameters["option_duration"]
+        strike_band = (strategy_parameters["max_strikes"] // 2) * strategy_parameters["strike_step_size"] + strategy_parameters["distance_of_wings"]
+
+        first_day, last_day = underlying_windows.get(symbol, (starting_date, ending_date))
+        underlying_windows[symbol] = (min(first_day, starting_date), max(last_day, ending_date))
+
+        expiration = get_monthly_expiration_after_date(starting_date + timedelta(days=option_duration))
+        last_expiration = get_monthly_expiration_after_date(ending_date + timedelta(days=option_duration))
+        while expiration <= last_expiration:
+            window_start, window_end = get_trade_window(expiration, option_duration)
+            window_start, window_end = max(window_start, starting_date), min(window_end, ending_date)
+            if window_start <= window_end:
+                plan = expiration_plans.setdefault((symbol, expiration), {"first_day": window_start, "last_day": window_end, "strike_band": strike_band})
+                plan["first_day"] = min(plan["first_day"], window_start)
+                plan["last_day"] = max(plan["last_day"], window_end)
+                plan["strike_band"] = max(plan["strike_band"], strike_band)
+            expiration = get_monthly_expiration_after_date(expiration + timedelta(days=1))
+
+    return underlying_windows, expiration_plans
+
+def get_bars(asset, first_day, last_day):
+    return polygon_helper.get_price_data_from_polygon(
+        POLYGON_CONFIG["API_KEY"],
+        asset,
+        datetime.combine(first_day, datetime.min.time()),
+        datetime.combine(last_day + timedelta(days=1), datetime.min.time()),
+        timespan=prefetch_timespan,
+        has_paid_subscription=True,
+    )
+
+def get_prices_by_day(bars):
+    if bars is None or len(bars) == 0:
+        return {}
+    daily_lows = bars["close"].groupby(bars.index.date).min()
+    daily_highs = bars["close"].groupby(bars.index.date).max()
+    return {day: (daily_lows[day], daily_highs[day]) for day in daily_lows.index}
+
+def run_sweep_prefetch(runs, max_threads=default_prefetch_threads):
+    '''
+    Download the data the runs will request.  Failed downloads are reported and left for the
+    backtests to fetch.
+    '''
+    underlying_windows, expiration_plans = plan_sweep_prefetch(runs)
+    print(f">>>>> Prefetching {len(underlying_windows)} symbols and {len(expiration_plans)} expirations for {len(runs)} backtests with {max_threads} threads")
+
+    contract_cache = OptionContractCache()
+    api_key = POLYGON_CONFIG["API_KEY"]
+    failures = 0
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        # The underlying bars give the price range of each expiration's trade window
+        underlying_futures = {executor.submit(get_bars, Asset(symbol), first_day - timedelta(days=7), last_day): symbol for symbol, (first_day, last_day) in underlying_windows.items()}
+        contract_futures = {executor.submit(contract_cache.get_option_contracts, symbol, expiration, api_key): (symbol, expiration) for symbol, expiration in expiration_plans}
+
+        underlying_prices = {}
+        for future in as_completed(underlying_futures):
+            symbol = underlying_futures[future]
+            try:
+                underlying_prices[symbol] = get_prices_by_day(future.result())
+            except Exception as e:
+                failures += 1
+                print(f"****** Unable to prefetch {symbol} bars: {e!r}")
+
+        option_bar_requests = set()
+        for future in as_completed(contract_futures):
+            symbol, expiration = contract_futures[future]
+            plan = expiration_plans[(symbol, expiration)]
+            try:
+                contracts = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"****** Unable to prefetch the {symbol} {expiration} contracts: {e!r}")
+                continue
+
+            window_prices = [prices for day, prices in underlying_prices.get(symbol, {}).items() if plan["first_day"] <= day <= plan["last_day"]]
+            if len(window_prices) == 0:
+                continue
+            lowest_strike = min(low for low, _ in window_prices) - plan["strike_band"]
+            highest_strike = max(high for _, high in window_prices) + plan["strike_band"]
+            for contract in contracts:
+                if lowest_strike <= contract["strike_price"] <= highest_strike:
+                    option_bar_requests.add((symbol, expiration, contract["strike_price"], contract["contract_type"]))
+
+        print(f">>>>> Prefetching bars for {len(option_bar_requests)} option contracts")
+        option_futures = {}
+        for symbol, expiration, strike, right in sorted(option_bar_requests):
+            plan = expiration_plans[(symbol, expiration)]
+            asset = Asset(symbol, asset_type="option", expiration=expiration, strike=strike, right=right)
+            option_futures[executor.submit(get_bars, asset, plan["first_day"], min(plan["last_day"], expiration))] = asset
+
+        for future in as_completed(option_futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f"****** Unable to prefetch {option_futures[future]} bars: {e!r}")
+
+    print(f">>>>> Prefetch finished with {failures} failed downloads")
+    contract_cache.print_summary()
+    return failures
+
+if __name__ == "__main__":
+    import backtest_driver
+    from backtest_driver import load_strategy_runs
+    from check_for_previous_run import get_previous_run_hashes
+
+    previous_run_hashes = get_previous_run_hashes()
+    pending_runs = []
+    for toml_file in sorted(os.listdir(backtest_driver.strategy_configuration_directory)):
+        if toml_file.endswith('.toml'):
+            pending_runs += load_strategy_runs(toml_file, previous_run_hashes)
+    run_sweep_prefetch(pending_runs)
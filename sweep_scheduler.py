@@ -0,0 +1,165 @@
+# sweep_scheduler
+#
+# Description: Estimate the cost of each pending backtest from the run times of earlier backtests
+# in the results database and order the sweep so the most expensive runs start first.  Starting the
+# long runs first keeps one long backtest from finishing alone at the end of a parallel sweep.
+#
+# The cost of a run is estimated as seconds per calendar day times the length of the backtest.  The
+# seconds per day rate comes from the closest match in the history of the same backtest engine, the
+# simulator runs in a fraction of the time of Lumibot:
+#
+#   1. earlier runs with the same symbol, max_strikes and roll_strategy
+#   2. earlier runs with the same symbol, scaled by max_strikes
+#   3. all earlier runs, scaled by max_strikes
+#   4. default_seconds_per_day if the database has no timed runs yet
+
+import sqlite3
+import statistics
+from datetime import date, datetime, timedelta
+
+from check_for_previous_run import get_backtest_engine, default_backtest_engine, results_database
+from create_strategy_database import add_missing_columns
+
+# Used when there is no history to estimate from.  Roughly a 25 strike run on a daily sleeptime.
+default_seconds_per_day = 2.0
+default_simulator_seconds_per_day = 0.001
+default_max_strikes = 25
+
+def get_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+def get_monthly_expiration_after_date(day):
+    '''
+    The third Friday of the month on or after day, the monthly option expiration
+    '''
+    year, month = day.year, day.month
+    while True:
+        first_day = date(year, month, 1)
+        third_friday = first_day + timedelta(days=(4 - first_day.weekday()) % 7 + 14)
+        if third_friday >= day:
+            return third_friday
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def get_next_weekday(day):
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return day
+
+def get_backtest_days(strategy_parameters):
+    return max(1, (get_date(strategy_parameters["ending_date"]) - get_date(strategy_parameters["starting_date"])).days)
+
+def load_run_history():
+    '''
+    Return the timing of every earlier backtest that recorded its run time
+    '''
+    conn = sqlite3.connect(results_database)  # Connect to the database
+    cursor = conn.cursor()
+
+    try:
+        add_missing_columns(cursor)
+        conn.commit()
+        cursor.execute('''
+            SELECT symbol, starting_date, ending_date, max_strikes, roll_strategy, run_seconds, backtest_engine
+            FROM mwt_benchmark_returns WHERE run_seconds IS NOT NULL
+        ''')
+        rows = cursor.fetchall()
+    except sqlite3.OperationalError:
+        # The database was created before run times were recorded
+        rows = []
+    conn.close()
+
+    run_history = []
+    for symbol, starting_date, ending_date, max_strikes, roll_strategy, run_seconds, backtest_engine in rows:
+        days = get_backtest_days({"starting_date": starting_date, "ending_date": ending_date})
+        run_history.append({
+            "backtest_engine": backtest_engine or default_backtest_engine,
+            "symbol": symbol,
+            "max_strikes": max_strikes or default_max_strikes,
+            "roll_strategy": roll_strategy,
+            "seconds_per_day": run_seconds / days,
+        })
+
+    return run_history
+
+def estimate_run_seconds(strategy_parameters, run_history):
+    '''
+    Estimate the wall clock time of one backtest from the run history
+    '''
+    symbol = strategy_parameters["symbol"]
+    max_strikes = strategy_parameters.get("max_strikes", default_max_strikes)
+    roll_strategy = strategy_parameters.get("roll_strategy")
+    backtest_engine = get_backtest_engine(strategy_parameters)
+    # Runs recorded without an engine were Lumibot backtests
+    run_history = [run for run in run_history if run.get("backtest_engine", default_backtest_engine) == backtest_engine]
+
+    exact_matches = [run["seconds_per_day"] for run in run_history
+                     if run["symbol"] == symbol and run["max_strikes"] == max_strikes and run["roll_strategy"] == roll_strategy]
+    if exact_matches:
+        seconds_per_day = statistics.median(exact_matches)
+    else:
+        # Most of the cost of a run is pricing and calculating greeks for each strike, so scale
+        # the rate of similar runs by the number of strikes
+        symbol_matches = [run for run in run_history if run["symbol"] == symbol]
+        similar_runs = symbol_matches if symbol_matches else run_history
+        if similar_runs:
+            seconds_per_day = statistics.median(run["seconds_per_day"] * max_strikes / run["max_strikes"] for run in similar_runs)
+        else:
+            engine_seconds_per_day = default_simulator_seconds_per_day if backtest_engine == "simulator" else default_seconds_per_day
+            seconds_per_day = engine_seconds_per_day * max_strikes / default_max_strikes
+
+    return seconds_per_day * get_backtest_days(strategy_parameters)
+
+def order_runs_by_cost(pending_runs, run_history=None):
+    '''
+    Return the pending (strategy_file, strategy_parameters) runs ordered from the most expensive
+    to the least expensive, and the estimated seconds of each run in the same order
+    '''
+    if run_history is None:
+        run_history = load_run_history()
+
+    estimated_runs = [(estimate_run_seconds(strategy_parameters, run_history), (strategy_file, strategy_parameters))
+                      for strategy_file, strategy_parameters in pending_runs]
+    estimated_runs.sort(key=lambda estimated_run: estimated_run[0], reverse=True)
+
+    return [run for _, run in estimated_runs], [seconds for seconds, _ in estimated_runs]
+
+def estimate_sweep_seconds(estimated_seconds, max_workers):
+    '''
+    Estimate the wall clock time of the sweep by assigning the runs, longest first, to the
+    worker that becomes free first
+    '''
+    worker_finish_times = [0.0] * max(1, max_workers)
+    for seconds in estimated_seconds:
+        next_worker = worker_finish_times.index(min(worker_finish_times))
+        worker_finish_times[next_worker] += seconds
+    return max(worker_finish_times)
+
+def format_duration(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s"
+
+def print_sweep_eta(estimated_seconds, max_workers):
+    sweep_seconds = estimate_sweep_seconds(estimated_seconds, max_workers)
+    eta = datetime.fromtimestamp(datetime.now().timestamp() + sweep_seconds)
+    print(f">>>>> Sweep of {len(estimated_seconds)} backtests, {format_duration(sum(estimated_seconds))} of backtesting on {max_workers} worker(s)")
+    print(f">>>>> Estimated sweep time {format_duration(sweep_seconds)}, finishing around {eta:%Y-%m-%d %H:%M}")
+
+if __name__ == "__main__":
+    run_history = [
+        {"symbol": "SPY", "max_strikes": 100, "roll_strategy": "short", "seconds_per_day": 8.0},
+        {"symbol": "IBM", "max_strikes": 25, "roll_strategy": "short", "seconds_per_day": 1.5},
+    ]
+    pending_runs = [
+        ("ibm.toml", {"symbol": "IBM", "max_strikes": 25, "roll_strategy": "short", "starting_date": "2022-01-01", "ending_date": "2022-03-31"}),
+        ("spy.toml", {"symbol": "SPY", "max_strikes": 100, "roll_strategy": "short", "starting_date": "2022-01-01", "ending_date": "2022-12-31"}),
+        ("qqq.toml", {"symbol": "QQQ", "max_strikes": 50, "roll_strategy": "delta", "starting_date": "2022-01-01", "ending_date": "2022-06-30"}),
+    ]
+    ordered_runs, estimated_seconds = order_runs_by_cost(pending_runs, run_history)
+    for (strategy_file, _), seconds in zip(ordered_runs, estimated_seconds):
+        print(f"{strategy_file} {format_duration(seconds)}")
+    print_sweep_eta(estimated_seconds, 2)
@@ -0,0 +1,204 @@
+# test_condor_simulator
+#
+# Description: Deterministic tests of VirtualPortfolio.trade_day on a synthetic SimulationMarket.  The
+# closes of every contract are Black-Scholes prices of a given underlying path, so each rule of the
+# strategy can be driven with a price path shaped to trigger it: the entry by delta, the distance and
+# delta rolls, the max loss close, the max move skip and the buy back before expiry.
+#
+#   python -m pytest test_condor_simulator.py
+
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from condor_simulator import SimulationMarket, VirtualPortfolio
+from strike_ladder import StrikeLadder
+from sweep_scheduler import get_monthly_expiration_after_date
+from vectorized_greeks import black_scholes_price, get_years_to_expiration
+
+first_day = date(2024, 1, 2)
+strikes = np.arange(50.0, 151.0)
+
+strategy_parameters = {
+    "symbol": "SPY",
+    "trade_strategy": "iron-condor",
+    "option_duration": 30,
+    "strike_step_size": 1,
+    "max_strikes": 40,
+    "call_delta_required": 0.2,
+    "put_delta_required": 0.2,
+    "maximum_rolls": 2,
+    "days_before_expiry_to_buy_back": 5,
+    "quantity_to_trade": 1,
+    "minimum_hold_period": 2,
+    "distance_of_wings": 5,
+    "strike_roll_distance": 1.0,
+    "max_loss_multiplier": 0,
+    "roll_strategy": "none",
+    "skip_on_max_rolls": False,
+    "delta_threshold": 0.35,
+    "maximum_portfolio_allocation": 0.75,
+    "max_loss_trade_days_to_skip": 3,
+    "max_volitility_days_to_skip": 3,
+    "max_symbol_volitility": 0.05,
+    "trading_fee": 0.65,
+}
+
+class SyntheticMarket(SimulationMarket):
+    '''
+    A market of weekday closes from a price path and a volatility, constant or one per day, with the
+    monthly expirations priced by Black-Scholes on a one dollar strike ladder instead of the warehouse
+    '''
+
+    def __init__(self, prices, volatility=0.2, risk_free_rate=0.05):
+        self.symbol = "SPY"
+        self.risk_free_rate = risk_free_rate
+        self.directory = None
+
+        self.trading_days = []
+        day = first_day
+        while len(self.trading_days) < len(prices):
+            if day.weekday() < 5:
+                self.trading_days.append(day)
+            day += timedelta(days=1)
+        self.first_day = self.trading_days[0]
+        self.last_day = self.trading_days[-1] + timedelta(days=1)
+        self.underlying_prices = dict(zip(self.trading_days, prices))
+        volatilities = volatility if isinstance(volatility, list) else [volatility] * len(prices)
+
+        self.expiration_dates = []
+        expiration = get_monthly_expiration_after_date(first_day)
+        while expiration <= self.last_day + timedelta(days=90):
+            self.expiration_dates.append(expiration)
+            expiration = get_monthly_expiration_after_date(expiration + timedelta(days=1))
+
+        self.chains = {}
+        self.strike_ladders = {}
+        self.strike_deltas = {}
+        self.volatilities = {}
+        for expiration in self.expiration_dates:
+            chain = {}
+            for day, day_volatility in zip(self.trading_days, volatilities):
+                if day > expiration:
+                    break
+                years = get_years_to_expiration((expiration - day).days)
+                chain[day] = {
+                    right: {float(strike): round(float(price), 2) for strike, price in zip(strikes, black_scholes_price(self.underlying_prices[day], strikes, years, risk_free_rate, day_volatility, right == "call"))}
+                    for right in ["call", "put"]
+                }
+            self.chains[expiration] = chain
+            self.strike_ladders[expiration] = StrikeLadder(self.symbol, expiration, set(strikes), set(strikes))
+
+def run_portfolio(market, **parameters):
+    portfolio = VirtualPortfolio(dict(strategy_parameters, **parameters), 10000)
+    for day in market.trading_days:
+        portfolio.trade_day(market, day)
+    return portfolio
+
+def get_events(portfolio, action):
+    return [event for event in portfolio.trade_events if event["action"] == action]
+
+# Flat for three days, then up 1.50 a day through the call short, then flat
+rising_path = [100.0] * 3 + [100 + 1.5 * i for i in range(1, 12)] + [116.5] * 10
+expiration = date(2024, 2, 16)
+
+def test_entry_by_delta():
+    market = SyntheticMarket([100.0] * 10)
+    portfolio = run_portfolio(market)
+
+    event = portfolio.trade_events[0]
+    assert (event["date"], event["action"], event["side"], event["expiration"]) == ("2024-01-02", "open", "both", "2024-02-16")
+    # The shorts are the first strikes out of the money whose delta reaches the required delta
+    day = market.trading_days[0]
+    call_deltas = market.get_deltas(day, expiration, "call", [event["call_short"] - 1, event["call_short"]])
+    put_deltas = market.get_deltas(day, expiration, "put", [event["put_short"] + 1, event["put_short"]])
+    assert call_deltas[0] > 0.2 >= call_deltas[1]
+    assert put_deltas[0] < -0.2 <= put_deltas[1]
+    # The wings are distance_of_wings away
+    legs = {(asset.right, asset.strike): quantity for asset, quantity in portfolio.position_book.get_open_trades()[0].get_legs()}
+    assert legs == {("call", 108.0): -1, ("call", 113.0): 1, ("put", 95.0): -1, ("put", 90.0): 1}
+
+def test_distance_roll():
+    market = SyntheticMarket(rising_path)
+    portfolio = run_portfolio(market, roll_strategy="short")
+
+    # The first close within strike_roll_distance of the 108 call short is 107.50 on January 11
+    roll = get_events(portfolio, "roll")[0]
+    assert market.get_underlying_price(date(2024, 1, 10)) < 107 <= market.get_underlying_price(date(2024, 1, 11))
+    assert (roll["date"], roll["side"], roll["put_short"]) == ("2024-01-11", "call", 95.0)
+    assert roll["call_short"] > 108
+
+def test_delta_roll():
+    market = SyntheticMarket(rising_path)
+    portfolio = run_portfolio(market, roll_strategy="delta")
+
+    # The delta of the 108 call short passes delta_threshold on January 10
+    deltas = {day: market.get_deltas(day, expiration, "call", [108.0])[0] for day in market.trading_days[:8]}
+    assert deltas[date(2024, 1, 9)] <= 0.35 < deltas[date(2024, 1, 10)]
+    roll = get_events(portfolio, "roll")[0]
+    assert (roll["date"], roll["side"], roll["put_short"]) == ("2024-01-10", "call", 95.0)
+    assert roll["call_short"] > 108
+
+def test_max_loss_close():
+    market = SyntheticMarket(rising_path)
+    portfolio = run_portfolio(market, max_loss_multiplier=1.0)
+
+    def get_cost_to_close(day):
+        price = lambda right, strike: market.get_option_price(day, expiration, right, strike)
+        return price("call", 108.0) - price("call", 113.0) + price("put", 95.0) - price("put", 90.0)
+
+    # The trade closes on the first day the cost to close is over the credit, then stays out of the
+    # market for max_loss_trade_days_to_skip days
+    credit = get_cost_to_close(date(2024, 1, 2))
+    assert get_cost_to_close(date(2024, 1, 8)) <= credit < get_cost_to_close(date(2024, 1, 9))
+    assert get_events(portfolio, "roll") == []
+    close, reopen = portfolio.trade_events[1:3]
+    assert (close["date"], close["action"], close["call_short"]) == ("2024-01-09", "close", 108.0)
+    assert (reopen["date"], reopen["action"]) == ("2024-01-12", "open")
+
+def test_max_move_skip():
+    # A 6% drop is over max_symbol_volitility
+    market = SyntheticMarket([100.0] * 4 + [94.0] * 10)
+    portfolio = run_portfolio(market)
+
+    close, reopen = portfolio.trade_events[1:3]
+    assert (close["date"], close["action"]) == ("2024-01-08", "close")
+    # No entry for max_volitility_days_to_skip days
+    assert (reopen["date"], reopen["action"], reopen["put_short"]) == ("2024-01-11", "open", 89.0)
+
+def test_buy_back_before_expiry():
+    market = SyntheticMarket([100.0] * 40)
+    portfolio = run_portfolio(market)
+
+    # February 12 is the first day within days_before_expiry_to_buy_back of the February 16 expiration,
+    # the next condor opens the same day on the next monthly expiration
+    assert [(event["date"], event["action"], event["expiration"]) for event in portfolio.trade_events] == [
+        ("2024-01-02", "open", "2024-02-16"),
+        ("2024-02-12", "close", "2024-02-16"),
+        ("2024-02-12", "open", "2024-03-15"),
+    ]
+
+def test_entry_spacing_after_expiry():
+    market = SyntheticMarket([100.0] * 70)
+    portfolio = run_portfolio(market, max_open_trades=2, entry_spacing_days=10)
+
+    # Both condors close on the buy back day of their common expiration, only one is replaced that day
+    # and the other waits for entry_spacing_days
+    open_dates = [date.fromisoformat(event["date"]) for event in get_events(portfolio, "open")]
+    assert len(open_dates) >= 4
+    assert all((later - earlier).days >= 10 for earlier, later in zip(open_dates, open_dates[1:]))
+    assert [event["date"] for event in get_events(portfolio, "close")][:2] == ["2024-02-12", "2024-02-12"]
+
+# The price drifts down 8% while the volatility triples in six days, then both recover
+spike_volatilities = [0.2] * 10 + [0.2 * 1.2 ** i for i in range(1, 7)] + [0.6] * 10 + [0.3] * 34
+spike_path = [100.0] * 10 + [100 - 0.5 * i for i in range(1, 17)] + [92 + 0.4 * i for i in range(1, 35)]
+
+@pytest.mark.parametrize("roll_strategy", ["short", "delta", "none"])
+@pytest.mark.parametrize("max_loss_multiplier", [0, 1.0, 2.0])
+def test_trigger_gating_keeps_trade_events(roll_strategy, max_loss_multiplier):
+    for market in [SyntheticMarket(rising_path + [116.5] * 36), SyntheticMarket(spike_path, spike_volatilities)]:
+        parameters = {"roll_strategy": roll_strategy, "max_loss_multiplier": max_loss_multiplier, "max_open_trades": 2, "entry_spacing_days": 10}
+        ungated = run_portfolio(market, **parameters)
+        gated = run_portfolio(market, trigger_gating=True, **parameters)
+        assert gated.trade_events == ungated.trade_events
@@ -1,4 +1,5 @@
-import requests
+from polygon_http_client import get_json
+from strike_ladder import StrikeLadder
 from datetime import datetime, timedelta
 
 from credentials import POLYGON_CONFIG
@@ -11,40 +12,26 @@ def get_option_strikes(symbol, expiration_date, maximum_strikes, current_price,
     page = 1
     options_url = f"https://api.polygon.io/v3/reference/options/contracts?underlying_ticker={symbol}&limit=500&expired=true&expiration_date={expiration_date}&apiKey={api_key}"
     while True:
-        response = requests.get(options_url)
-        data = response.json()
-        options += data['results']
+        data = get_json(options_url)
+        options += data.get('results', [])
         if data.get('next_url'):
             options_cursor = data['next_url']
             options_url = f"{options_cursor}&apiKey={api_key}"
         else:
             break
 
-    # Separate the options into puts and calls just in case the strikes are not the same for both
-    put_strikes = [option['strike_price'] for option in options if option['contract_type'] == 'put']
-    call_strikes = [option['strike_price'] for option in options if option['contract_type'] == 'call']
-
-    # Sort the strikes so we can find the middle X strikes
-    call_strikes.sort()
-
-    # Find the index of the current_price in the put_strikes and call_strikes
-    put_index = min(range(len(put_strikes)), key=lambda i: abs(put_strikes[i]-current_price))
-    call_index = min(range(len(call_strikes)), key=lambda i: abs(call_strikes[i]-current_price))
-
-    middle_strike = maximum_strikes // 2
-
-    # Only return maximum_strikes number of put_strikes and call_strikes
-    put_strikes = put_strikes[max(0, put_index-middle_strike):put_index+middle_strike]
-    call_strikes = call_strikes[max(0, call_index-middle_strike):call_index+middle_strike]  
+    # Find the middle X strikes with the sorted strike ladder
+    strike_ladder = StrikeLadder.from_contracts(symbol, expiration_date, options)
+    put_strikes = strike_ladder.get_strike_window("put", current_price, maximum_strikes)
+    call_strikes = strike_ladder.get_strike_window("call", current_price, maximum_strikes)
 
     return put_strikes, call_strikes
 
 def get_historical_price(symbol, date, api_key):
     # Get the historical price data for the stock on the specified date
     url = f"https://api.polygon.io/v2/aggs/ticker/{symbol}/range/1/day/{date}/{date}?apiKey={api_key}"
-    response = requests.get(url)
-    data = response.json()
-    if data['resultsCount'] > 0:
+    data = get_json(url)
+    if data.get('resultsCount', 0) > 0:
         return data['results'][0]['c']  # return the closing price
     else:
         return None  # no data for the specified date
@@ -0,0 +1,69 @@
+# test_vectorized_greeks
+#
+# Description: The vectorized greeks of a fixed strike ladder must match the deltas Lumibot's get_greeks
+# computes with its Black-Scholes model, within greeks_parity_tolerance.  The option prices are Lumibot
+# Black-Scholes prices over a volatility smile, rounded to the cent like market closes.  The ladders are
+# the out of the money strikes the delta search prices, Lumibot gives an in the money put priced under
+# its intrinsic value a volatility of 0.001.
+#
+#   python -m pytest test_vectorized_greeks.py
+
+import math
+
+import pytest
+
+from lumibot.tools.black_scholes import BS
+
+from vectorized_greeks import get_ladder_greeks, greeks_parity_tolerance
+
+underlying_price = 450.0
+ladders = {
+    "call": [float(strike) for strike in range(450, 515, 5)],
+    "put": [float(strike) for strike in range(390, 455, 5)],
+}
+days_to_expiration = 30
+risk_free_rate = 0.05
+
+def get_smile_volatility(strike):
+    # Volatility in percent, higher away from the money and on the put side
+    moneyness = strike / underlying_price - 1
+    return 18 + 60 * moneyness ** 2 - 20 * moneyness
+
+def get_ladder_prices(right):
+    prices = []
+    for strike in ladders[right]:
+        option = BS([underlying_price, strike, risk_free_rate * 100, days_to_expiration], volatility=get_smile_volatility(strike))
+        prices.append(round(option.callPrice if right == "call" else option.putPrice, 2))
+    return prices
+
+def get_lumibot_delta(strike, option_price, right):
+    # The two steps of Lumibot's get_greeks: the implied volatility, then the greeks at it
+    if right == "call":
+        volatility = BS([underlying_price, strike, risk_free_rate * 100, days_to_expiration], callPrice=option_price).impliedVolatility
+        return BS([underlying_price, strike, risk_free_rate * 100, days_to_expiration], volatility=volatility).callDelta
+    volatility = BS([underlying_price, strike, risk_free_rate * 100, days_to_expiration], putPrice=option_price).impliedVolatility
+    return BS([underlying_price, strike, risk_free_rate * 100, days_to_expiration], volatility=volatility).putDelta
+
+@pytest.mark.parametrize("right", ["call", "put"])
+def test_ladder_deltas_match_lumibot(right):
+    option_prices = get_ladder_prices(right)
+    greeks = get_ladder_greeks(underlying_price, ladders[right], option_prices, days_to_expiration, risk_free_rate, right)
+
+    for strike, option_price, delta in zip(ladders[right], option_prices, greeks["delta"]):
+        lumibot_delta = get_lumibot_delta(strike, option_price, right)
+        assert abs(delta - lumibot_delta) <= greeks_parity_tolerance, f"{right} {strike}: vectorized delta {delta:.4f}, Lumibot delta {lumibot_delta:.4f}"
+
+@pytest.mark.parametrize("right", ["call", "put"])
+def test_ladder_volatilities_recover_smile(right):
+    greeks = get_ladder_greeks(underlying_price, ladders[right], get_ladder_prices(right), days_to_expiration, risk_free_rate, right)
+
+    for strike, volatility in zip(ladders[right], greeks["implied_volatility"]):
+        assert volatility * 100 == pytest.approx(get_smile_volatility(strike), abs=0.5)
+
+def test_missing_price_gives_nan_greeks():
+    option_prices = get_ladder_prices("call")
+    option_prices[3] = None
+    greeks = get_ladder_greeks(underlying_price, ladders["call"], option_prices, days_to_expiration, risk_free_rate, "call")
+
+    assert math.isnan(greeks["delta"][3])
+    assert not any(math.isnan(delta) for i, delta in enumerate(greeks["delta"]) if i != 3)
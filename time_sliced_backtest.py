@@ -0,0 +1,273 @@
+"""
+Author:  Irv Shapiro
+License: MIT License
+
+Run one long backtest as several shorter backtests in parallel.  The strategy holds one condor at a
+time and closes it days_before_expiry_to_buy_back days before the monthly expiration, so the days a
+condor is closed for expiry can be predicted from the parameters alone.  Those days split the
+backtest period into windows:
+
+    window 1:  starting_date ............ close 3  (+ a few days to make sure the close happens)
+    window 2:  warm up | close 3 ........ close 6
+    window 3:  warm up | close 6 ........ ending_date
+
+Each window is an ordinary backtest.  Its first_entry_date and last_entry_date parameters keep it
+from opening trades before its start, the days before only warm up the price history used by the
+max move check, and from opening a new trade once it closes the trade open at its end.  The windows
+run in parallel worker processes and their portfolio values are stitched together in dollars, each
+window continuing from the value the previous window ended with.
+
+The trade size depends on the portfolio value, so a window that started with different capital than
+the serial backtest would have could trade a different size.  Every window starts with the normal
+budget.  If the capital carried over from the earlier windows could change a trade size, or the
+portfolio blew up, the window is run again with the carried over capital.
+
+The stitched backtest matches a serial backtest as long as every window boundary is a real expiry
+close.  A max loss or max move close near a boundary can move the serial closes, so --verify-slices
+also runs the serial backtest and reports where the two diverge.
+
+    python backtest_driver.py --time-slices 8 --workers 8 [--verify-slices]
+
+"""
+
+import os
+import time
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import backtest_driver
+from backtest_driver import load_strategy_runs, record_backtest_results, run_strategy_backtest
+from check_for_previous_run import get_parameter_hash, get_previous_run_hashes
+from get_strategy_return import get_strategy_return_from_portfolio_values
+from sweep_journal import SweepJournal
+from sweep_scheduler import get_date, get_monthly_expiration_after_date, get_next_weekday
+import sweep_journal
+
+# Calendar days before a window's first entry used to warm up the price history
+warmup_days = 7
+# Calendar days after a window's last boundary in case the expiry close is delayed by a holiday
+tail_days = 7
+# Stitched values further than this fraction from the serial values are reported as divergent
+divergence_tolerance = 0.01
+
+def predict_expiry_closes(strategy_parameters):
+    '''
+    The days the serial backtest closes its condor for expiry and opens the next one, assuming no
+    max loss, max move or roll limit close moves the chain
+    '''
+    starting_date = get_date(strategy_parameters["starting_date"])
+    ending_date = get_date(strategy_parameters["ending_date"])
+
+    expiry_closes = []
+    day = get_next_weekday(starting_date)
+    while True:
+        expiry = get_monthly_expiration_after_date(day + timedelta(days=strategy_parameters["option_duration"]))
+        close_day = get_next_weekday(max(expiry - timedelta(days=strategy_parameters["days_before_expiry_to_buy_back"]), day + timedelta(days=1)))
+        if close_day >= ending_date - timedelta(days=tail_days):
+            break
+        expiry_closes.append(close_day)
+        day = close_day
+
+    return expiry_closes
+
+def plan_time_slices(strategy_parameters, slices):
+    '''
+    Return the start days of up to slices windows.  The first window starts on the starting_date
+    and the others on the predicted expiry closes closest to equal length windows.
+    '''
+    starting_date = get_date(strategy_parameters["starting_date"])
+    ending_date = get_date(strategy_parameters["ending_date"])
+    expiry_closes = predict_expiry_closes(strategy_parameters)
+
+    slice_starts = [starting_date]
+    slice_days = (ending_date - starting_date).days / max(1, slices)
+    for slice_number in range(1, slices):
+        if len(expiry_closes) == 0:
+            break
+        target_day = starting_date + timedelta(days=slice_days * slice_number)
+        slice_start = min(expiry_closes, key=lambda close_day: abs((close_day - target_day).days))
+        # Each window needs room for its warm up
+        if (slice_start - slice_starts[-1]).days > warmup_days:
+            slice_starts.append(slice_start)
+        expiry_closes = [close_day for close_day in expiry_closes if close_day > slice_start]
+
+    return slice_starts
+
+def get_slice_parameters(strategy_parameters, slice_starts, slice_number):
+    slice_parameters = dict(strategy_parameters)
+    if slice_number > 0:
+        slice_parameters["starting_date"] = slice_starts[slice_number] - timedelta(days=warmup_days)
+        slice_parameters["first_entry_date"] = slice_starts[slice_number]
+    if slice_number < len(slice_starts) - 1:
+        slice_parameters["ending_date"] = slice_starts[slice_number + 1] + timedelta(days=tail_days)
+        slice_parameters["last_entry_date"] = slice_starts[slice_number + 1]
+    return slice_parameters
+
+def get_slice_values(slice_results, slice_start):
+    # Drop the warm up days
+    return [value for value in slice_results["portfolio_values"] if get_date(value["datetime"]) >= slice_start]
+
+def capital_changes_trading(slice_values, capital_budget, carried_value, strategy_parameters):
+    '''
+    True if a window run with capital_budget could trade differently than the same window run with
+    carried_value.  The strategy reduces the trade size when the portfolio value times the maximum
+    portfolio allocation is less than the margin of a full size trade.
+    '''
+    required_value = strategy_parameters["distance_of_wings"] * 100 * strategy_parameters["quantity_to_trade"] / strategy_parameters["maximum_portfolio_allocation"]
+    lowest_value = min(value["portfolio_value"] for value in slice_values)
+    return lowest_value < required_value or lowest_value - capital_budget + carried_value < required_value
+
+def stitch_portfolio_values(slice_values, final_values):
+    '''
+    Join the portfolio values of the windows in dollars.  Each window continues from the value the
+    previous window ended with, and is cut off where the next window starts.
+    '''
+    stitched_values = []
+    carried_value = None
+    for slice_number, values in enumerate(slice_values):
+        if len(values) == 0:
+            continue
+        if carried_value is None:
+            carried_value = values[0]["portfolio_value"]
+        offset = carried_value - values[0]["portfolio_value"]
+
+        next_start = None
+        if slice_number + 1 < len(slice_values) and slice_values[slice_number + 1]:
+            next_start = get_date(slice_values[slice_number + 1][0]["datetime"])
+        for value in values:
+            if next_start is not None and get_date(value["datetime"]) >= next_start:
+                break
+            stitched_values.append({"datetime": value["datetime"], "portfolio_value": value["portfolio_value"] + offset})
+        carried_value = final_values[slice_number] + offset
+
+    return stitched_values
+
+def report_divergence(stitched_values, serial_values, slice_starts, slices_not_flat):
+    '''
+    Print how far the stitched backtest is from the serial backtest
+    '''
+    serial_by_date = {get_date(value["datetime"]): value["portfolio_value"] for value in serial_values}
+    largest_difference = 0.0
+    first_divergence = None
+    for value in stitched_values:
+        serial_value = serial_by_date.get(get_date(value["datetime"]))
+        if serial_value is None:
+            continue
+        difference = value["portfolio_value"] - serial_value
+        largest_difference = max(largest_difference, abs(difference))
+        if first_divergence is None and abs(difference) > abs(serial_value) * divergence_tolerance:
+            first_divergence = (get_date(value["datetime"]), difference)
+
+    stitched_return = get_strategy_return_from_portfolio_values(stitched_values)
+    serial_return = get_strategy_return_from_portfolio_values(serial_values)
+    print(f">>>>> Time sliced return {stitched_return}, serial return {serial_return}, largest daily difference {largest_difference:.2f}")
+    if first_divergence is not None:
+        divergence_day, difference = first_divergence
+        print(f"****** Time sliced backtest diverges from the serial backtest on {divergence_day} by {difference:.2f}")
+        earlier_starts = [slice_start for slice_start in slice_starts if slice_start <= divergence_day]
+        if earlier_starts:
+            print(f"****** The divergence is in the window starting {earlier_starts[-1]}")
+    for slice_start in slices_not_flat:
+        print(f"****** The window ending at {slice_start} still held a trade, the serial backtest did not close for expiry on that day")
+    if first_divergence is None and not slices_not_flat:
+        print(">>>>> Time sliced backtest matches the serial backtest")
+
+    return first_divergence
+
+def run_time_sliced_backtest(strategy_file, strategy_parameters, max_workers, slices, verify=False):
+    '''
+    Run one backtest as up to slices windows in parallel and return results in the same form as
+    run_strategy_backtest.  With verify the serial backtest runs at the same time, the divergence
+    is reported and the serial results are returned since they are the reference.
+    '''
+    run_start_time = time.perf_counter()
+    slice_starts = plan_time_slices(strategy_parameters, slices)
+    capital_budget = strategy_parameters["distance_of_wings"] * 100 * strategy_parameters["quantity_to_trade"] * 1.5
+    strategy_stem = strategy_file.split(".")[0]
+    slice_runs = [(f"{strategy_stem}-slice{slice_number + 1}.toml", get_slice_parameters(strategy_parameters, slice_starts, slice_number)) for slice_number in range(len(slice_starts))]
+
+    print(f">>>>> Running {strategy_file} as {len(slice_runs)} windows starting {', '.join(str(slice_start) for slice_start in slice_starts)}")
+
+    with ProcessPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        serial_future = None
+        if verify:
+            serial_future = executor.submit(run_strategy_backtest, strategy_file, strategy_parameters)
+        slice_futures = [executor.submit(run_strategy_backtest, slice_file, slice_parameters) for slice_file, slice_parameters in slice_runs]
+        slice_results = [future.result() for future in slice_futures]
+
+        # Carry the capital forward one window at a time.  A window whose trading could depend on
+        # the capital it starts with is run again with the capital the earlier windows left it.
+        rerun_count = 0
+        carried_value = None
+        for slice_number, (slice_file, slice_parameters) in enumerate(slice_runs):
+            values = get_slice_values(slice_results[slice_number], slice_starts[slice_number])
+            if carried_value is not None and values and abs(carried_value - capital_budget) > 0.01 and capital_changes_trading(values, capital_budget, carried_value, strategy_parameters):
+                print(f">>>>> Running the window starting {slice_starts[slice_number]} again with the carried over capital {carried_value:.2f}")
+                slice_results[slice_number] = executor.submit(run_strategy_backtest, slice_file, slice_parameters, carried_value).result()
+                rerun_count += 1
+                values = get_slice_values(slice_results[slice_number], slice_starts[slice_number])
+            if values:
+                start_value = values[0]["portfolio_value"]
+                carried_value = (carried_value if carried_value is not None else start_value) + slice_results[slice_number]["portfolio_values"][-1]["portfolio_value"] - start_value
+
+        serial_results = serial_future.result() if serial_future is not None else None
+
+    stitched_values = stitch_portfolio_values(
+        [get_slice_values(results, slice_start) for results, slice_start in zip(slice_results, slice_starts)],
+        [results["portfolio_values"][-1]["portfolio_value"] if results["portfolio_values"] else 0.0 for results in slice_results],
+    )
+    slices_not_flat = [slice_starts[slice_number + 1] for slice_number, results in enumerate(slice_results[:-1]) if not results.get("ended_flat", True)]
+    run_seconds = time.perf_counter() - run_start_time
+    print(f">>>>> Time sliced backtest of {strategy_file} took {run_seconds:.0f} seconds, {rerun_count} windows run again for capital")
+
+    if serial_results is not None:
+        report_divergence(stitched_values, serial_results["portfolio_values"], slice_starts, slices_not_flat)
+        return serial_results
+
+    for slice_start in slices_not_flat:
+        print(f"****** The window ending at {slice_start} still held a trade, run with --verify-slices to compare with a serial backtest")
+
+    return {
+        "strategy_file": strategy_file,
+        "strategy_parameters": strategy_parameters,
+        "stats_file": "",
+        "tearsheet_path": "",
+        "strategy_return": get_strategy_return_from_portfolio_values(stitched_values),
+        "portfolio_values": stitched_values,
+        "backtest_analysis": None,
+        "run_seconds": run_seconds,
+        "ended_flat": slice_results[-1].get("ended_flat", True),
+    }
+
+def run_time_sliced_sweep(max_workers=1, slices=4, verify=False, max_attempts=3, journal_database=None):
+    '''
+    Run the pending backtests one at a time, each split into windows run in parallel
+    '''
+    previous_run_hashes = get_previous_run_hashes()
+    database_hashes = set(previous_run_hashes)
+    pending_runs = []
+    for toml_file in sorted(os.listdir(backtest_driver.strategy_configuration_directory)):
+        if toml_file.endswith('.toml'):
+            pending_runs += load_strategy_runs(toml_file, previous_run_hashes)
+
+    journal = SweepJournal(database=journal_database or sweep_journal.journal_database, max_attempts=max_attempts)
+    journal.reset_interrupted_runs()
+    journal.enqueue_runs(pending_runs)
+
+    for strategy_file, strategy_parameters in journal.get_runnable_runs():
+        if get_parameter_hash(strategy_parameters) in database_hashes:
+            journal.mark_done(strategy_parameters)
+            continue
+
+        journal.mark_running(strategy_parameters)
+        try:
+            record_backtest_results(run_time_sliced_backtest(strategy_file, strategy_parameters, max_workers, slices, verify))
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            print(f"****** Time sliced backtest failed for {strategy_file}: {e!r}")
+            journal.mark_failed(strategy_parameters, e)
+            continue
+        journal.mark_done(strategy_parameters)
+
+    journal.print_summary()
@@ -0,0 +1,162 @@
+# vectorized_greeks
+#
+# Description: Black-Scholes implied volatilities and greeks for a whole strike ladder at once.
+# Lumibot's get_greeks prices one option at a time: it solves the implied volatility with a scalar
+# loop and then computes the greeks in Python.  Here the strikes of one expiry are NumPy arrays, the
+# implied volatility of every strike is solved with the same vectorized bisection and the greeks come
+# out as arrays.
+#
+# The conventions follow Lumibot's Black-Scholes model so the results can replace get_greeks:
+#
+#   - time to expiration is the number of calendar days divided by 365
+#   - theta is per calendar day and vega per 1% change of the volatility
+#
+#   python vectorized_greeks.py     # compare the vectorized greeks with a scalar Black-Scholes
+
+import math
+
+import numpy as np
+
+days_per_year = 365
+
+# The implied volatility is searched between these bounds.  Every bisection step halves the bracket,
+# 40 steps give a precision far below what the delta search needs.
+minimum_volatility = 0.0001
+maximum_volatility = 5.0
+volatility_iterations = 40
+
+# get_strike_deltas prices this many strikes per batch before checking the stop delta
+greeks_batch_size = 10
+# The largest delta difference from get_greeks the parity check accepts
+greeks_parity_tolerance = 0.005
+
+def norm_cdf(x):
+    '''
+    The standard normal cumulative distribution, from the Abramowitz and Stegun 7.1.26 approximation
+    of erf, accurate to about 1e-7
+    '''
+    z = np.abs(x) / math.sqrt(2)
+    t = 1.0 / (1.0 + 0.3275911 * z)
+    polynomial = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - polynomial * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+def get_d1_d2(underlying_price, strikes, years, risk_free_rate, volatilities):
+    volatility_time = volatilities * np.sqrt(years)
+    d1 = (np.log(underlying_price / strikes) + (risk_free_rate + 0.5 * volatilities ** 2) * years) / volatility_time
+    return d1, d1 - volatility_time
+
+def black_scholes_price(underlying_price, strikes, years, risk_free_rate, volatilities, is_call):
+    d1, d2 = get_d1_d2(underlying_price, strikes, years, risk_free_rate, volatilities)
+    discounted_strikes = strikes * np.exp(-risk_free_rate * years)
+    call_prices = underlying_price * norm_cdf(d1) - discounted_strikes * norm_cdf(d2)
+    put_prices = discounted_strikes * norm_cdf(-d2) - underlying_price * norm_cdf(-d1)
+    return np.where(is_call, call_prices, put_prices)
+
+def implied_volatility(option_prices, underlying_price, strikes, years, risk_free_rate, is_call):
+    '''
+    Solve the implied volatility of every option with a vectorized bisection.  The option price
+    rises with the volatility, so each step keeps the half of the bracket holding the market price.
+    Options without a positive price get NaN.
+    '''
+    low = np.full(strikes.shape, minimum_volatility)
+    high = np.full(strikes.shape, maximum_volatility)
+    for i in range(volatility_iterations):
+        middle = (low + high) / 2
+        too_low = black_scholes_price(underlying_price, strikes, years, risk_free_rate, middle, is_call) < option_prices
+        low = np.where(too_low, middle, low)
+        high = np.where(too_low, high, middle)
+
+    volatilities = (low + high) / 2
+    return np.where(np.isfinite(option_prices) & (option_prices > 0), volatilities, np.nan)
+
+def get_years_to_expiration(days_to_expiration):
+    # An option expiring today is priced with one day left, Black-Scholes has no value at zero
+    return max(days_to_expiration, 1) / days_per_year
+
+def get_ladder_greeks(underlying_price, strikes, option_prices, days_to_expiration, risk_free_rate, right):
+    '''
+    The implied volatility, delta, gamma, theta and vega of the options of one expiry and right, as
+    arrays in the order of strikes.  A missing option price, None or NaN, gives NaN greeks.
+    '''
+    strikes = np.asarray(strikes, dtype=float)
+    option_prices = np.array([np.nan if price is None else price for price in option_prices], dtype=float)
+    years = get_years_to_expiration(days_to_expiration)
+
+    volatilities = implied_volatility(option_prices, underlying_price, strikes, years, risk_free_rate, right.lower() == "call")
+    return get_volatility_greeks(underlying_price, strikes, days_to_expiration, risk_free_rate, volatilities, right)
+
+def get_volatility_greeks(underlying_price, strikes, days_to_expiration, risk_free_rate, volatilities, right):
+    '''
+    The greeks of the options of one expiry and right given their implied volatilities, as arrays in
+    the order of strikes.  A NaN volatility gives NaN greeks.
+    '''
+    strikes = np.asarray(strikes, dtype=float)
+    volatilities = np.asarray(volatilities, dtype=float)
+    years = get_years_to_expiration(days_to_expiration)
+
+    d1, d2 = get_d1_d2(underlying_price, strikes, years, risk_free_rate, volatilities)
+    discount = np.exp(-risk_free_rate * years)
+    density = norm_pdf(d1)
+
+    if right.lower() == "call":
+        delta = norm_cdf(d1)
+        theta = -underlying_price * density * volatilities / (2 * math.sqrt(years)) - risk_free_rate * strikes * discount * norm_cdf(d2)
+    else:
+        delta = norm_cdf(d1) - 1
+        theta = -underlying_price * density * volatilities / (2 * math.sqrt(years)) + risk_free_rate * strikes * discount * norm_cdf(-d2)
+
+    return {
+        "implied_volatility": volatilities,
+        "delta": delta,
+        "gamma": density / (underlying_price * volatilities * math.sqrt(years)),
+        "theta": theta / days_per_year,
+        "vega": underlying_price * density * math.sqrt(years) / 100,
+    }
+
+def get_scalar_delta(underlying_price, strike, option_price, days_to_expiration, risk_free_rate, right):
+    '''
+    The delta of one option with math.erf and a scalar bisection, the reference for the parity check
+    '''
+    years = get_years_to_expiration(days_to_expiration)
+    cdf = lambda x: 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+    def get_d1_d2_scalar(volatility):
+        d1 = (math.log(underlying_price / strike) + (risk_free_rate + 0.5 * volatility ** 2) * years) / (volatility * math.sqrt(years))
+        return d1, d1 - volatility * math.sqrt(years)
+
+    def price(volatility):
+        d1, d2 = get_d1_d2_scalar(volatility)
+        discounted_strike = strike * math.exp(-risk_free_rate * years)
+        if right.lower() == "call":
+            return underlying_price * cdf(d1) - discounted_strike * cdf(d2)
+        return discounted_strike * cdf(-d2) - underlying_price * cdf(-d1)
+
+    low, high = minimum_volatility, maximum_volatility
+    for i in range(volatility_iterations):
+        middle = (low + high) / 2
+        if price(middle) < option_price:
+            low = middle
+        else:
+            high = middle
+    d1, _ = get_d1_d2_scalar((low + high) / 2)
+    return cdf(d1) if right.lower() == "call" else cdf(d1) - 1
+
+if __name__ == "__main__":
+    underlying_price, days_to_expiration, risk_free_rate = 450.0, 40, 0.05
+    largest_difference = 0
+    for right in ["call", "put"]:
+        strikes = np.arange(350, 551, 5, dtype=float)
+        # Price the ladder with a volatility smile, then recover the greeks from the prices
+        smile = 0.15 + 0.3 * ((strikes - underlying_price) / underlying_price) ** 2
+        years = days_to_expiration / days_per_year
+        option_prices = black_scholes_price(underlying_price, strikes, years, risk_free_rate, smile, right == "call")
+        greeks = get_ladder_greeks(underlying_price, strikes, option_prices, days_to_expiration, risk_free_rate, right)
+        for strike, option_price, delta in zip(strikes, option_prices, greeks["delta"]):
+            scalar_delta = get_scalar_delta(underlying_price, strike, option_price, days_to_expiration, risk_free_rate, right)
+            largest_difference = max(largest_difference, abs(delta - scalar_delta))
+        print(f">>>>> {right} deltas: {np.round(greeks['delta'], 3)}")
+    print(f">>>>> Largest difference from the scalar deltas: {largest_difference:.2e}")